@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 import string
@@ -18,14 +19,60 @@ app = App(name="dify-to-openai")
 # Create FastAPI app
 fastapi_app = FastAPI()
 
+# Dify keeps running a task after its stream is closed, so an abandoned request has to be stopped explicitly
+STOP_PATHS = {
+    "Chat": "/chat-messages/{task_id}/stop",
+    "Completion": "/completion-messages/{task_id}/stop",
+    "Workflow": "/workflows/tasks/{task_id}/stop",
+}
+
+# References to in-flight stop calls, so they are not garbage collected before they finish
+background_tasks = set()
+
+# Dify sends text, not tokens; the same rough ratio the benchmarks use
+CHARS_PER_TOKEN = 4
+
 # Helper functions
 def generate_id():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=29))
 
+async def stop_dify_task(url: str, token: str):
+    import httpx
+
+    async with httpx.AsyncClient() as client:
+        response = await client.post(url, json={"user": "apiuser"}, headers={"Authorization": f"Bearer {token}"})
+    return response.status_code == 200 and response.json().get("result") == "success"
+
+# Stops an abandoned task and logs what stopping it saved: the tokens of `max_tokens` (the request's, or the Dify
+# app's as `DIFY_MAX_TOKENS`) not generated, estimated from the text streamed before the client left
+async def stop_and_report(url: str, token: str, task_id: str, chunks: int, chars: int, max_tokens: Optional[int]):
+    try:
+        stopped = await stop_dify_task(url, token)
+    except Exception:
+        stopped = False
+    tokens_streamed = -(-chars // CHARS_PER_TOKEN)
+    print(json.dumps({
+        "event": "dify_task_cancelled",
+        "task_id": task_id,
+        "stopped": stopped,
+        "chunks_streamed": chunks,
+        "tokens_streamed": tokens_streamed,
+        "max_tokens": max_tokens,
+        "tokens_saved": max(max_tokens - tokens_streamed, 0) if stopped and max_tokens else None,
+    }))
+
+# Resolves when the client disconnects; the request body has already been read by then
+async def wait_for_disconnect(http_request: Request):
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[dict]
     stream: Optional[bool] = False
+    max_tokens: Optional[int] = None
 
 @fastapi_app.get("/")
 async def root():
@@ -47,7 +94,7 @@ async def get_models():
     return JSONResponse(content=models)
 
 @fastapi_app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, authorization: str = Header(None)):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request, authorization: str = Header(None)):
     import httpx
     import os
 
@@ -97,12 +144,44 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
         "auto_generate_name": False
     }
 
+    max_tokens = request.max_tokens or int(os.environ.get("DIFY_MAX_TOKENS", 0)) or None
+    streamed = {"chars": 0}
+
     async def generate_stream():
+        task_id = None
+        chunks = 0
+        finished = False
+        try:
+            async for chunk in dify_stream():
+                if chunk.startswith("task_id:"):
+                    task_id = chunk[len("task_id:"):]
+                    continue
+                if chunk == "finished":
+                    finished = True
+                    continue
+                chunks += 1
+                yield chunk
+                if not finished and await http_request.is_disconnected():
+                    return
+        finally:
+            # The client went away mid-answer: stop the Dify task instead of letting it generate to the end
+            if not finished and task_id:
+                stop_url = f"{DIFY_API_URL}{STOP_PATHS[BOT_TYPE].format(task_id=task_id)}"
+                task = asyncio.ensure_future(
+                    stop_and_report(stop_url, token, task_id, chunks, streamed["chars"], max_tokens)
+                )
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+
+    # Dify's event stream as OpenAI chunks, with a "task_id:<id>" marker as soon as the task id is known and a
+    # "finished" marker before the final chunk
+    async def dify_stream():
         async with httpx.AsyncClient() as client:
             async with client.stream("POST", f"{DIFY_API_URL}{api_path}", 
                                      json=request_body, 
                                      headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"}) as response:
                 buffer = ""
+                task_id_sent = False
                 async for chunk in response.aiter_bytes():
                     buffer += chunk.decode()
                     lines = buffer.split("\n")
@@ -111,11 +190,16 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
                         if line.startswith("data:"):
                             try:
                                 chunk_obj = json.loads(line[5:].strip())
+                                if chunk_obj.get("task_id") and not task_id_sent:
+                                    task_id_sent = True
+                                    yield f"task_id:{chunk_obj['task_id']}"
                                 if chunk_obj["event"] in ["message", "agent_message", "text_chunk"]:
                                     chunk_content = chunk_obj.get("data", {}).get("text", "") or chunk_obj.get("answer", "")
+                                    streamed["chars"] += len(chunk_content)
                                     chunk_id = f"chatcmpl-{generate_id()}"
                                     yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': chunk_obj.get('created_at'), 'model': request.model, 'choices': [{'index': 0, 'delta': {'content': chunk_content}, 'finish_reason': None}]})}\n\n"
                                 elif chunk_obj["event"] in ["workflow_finished", "message_end"]:
+                                    yield "finished"
                                     chunk_id = f"chatcmpl-{generate_id()}"
                                     yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': chunk_obj.get('created_at'), 'model': request.model, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
                                     yield "data: [DONE]\n\n"
@@ -127,17 +211,37 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
     if stream:
         return StreamingResponse(generate_stream(), media_type="text/event-stream")
     else:
-        full_response = ""
         usage_data = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-        async for chunk in generate_stream():
-            if chunk.startswith("data: "):
-                chunk_data = json.loads(chunk[6:])
-                if "choices" in chunk_data and chunk_data["choices"]:
-                    delta = chunk_data["choices"][0].get("delta", {})
-                    if "content" in delta:
-                        full_response += delta["content"]
-                    if chunk_data["choices"][0].get("finish_reason") == "stop":
-                        break
+
+        async def collect_response():
+            full_response = ""
+            async for chunk in generate_stream():
+                if chunk.startswith("data: "):
+                    chunk_data = json.loads(chunk[6:])
+                    if "choices" in chunk_data and chunk_data["choices"]:
+                        delta = chunk_data["choices"][0].get("delta", {})
+                        if "content" in delta:
+                            full_response += delta["content"]
+                        if chunk_data["choices"][0].get("finish_reason") == "stop":
+                            break
+            return full_response
+
+        # There is no response to notice the client leaving, and a workflow may run a long time before its first
+        # chunk, so the disconnect is watched alongside. Cancelling the collection stops the Dify task.
+        collecting = asyncio.ensure_future(collect_response())
+        disconnect = asyncio.ensure_future(wait_for_disconnect(http_request))
+        try:
+            await asyncio.wait({collecting, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+        if not collecting.done():
+            collecting.cancel()
+            try:
+                await collecting
+            except asyncio.CancelledError:
+                pass
+            return JSONResponse(status_code=499, content={"error": "client disconnected"})
+        full_response = collecting.result()
 
         formatted_response = {
             "id": f"chatcmpl-{generate_id()}",
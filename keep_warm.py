@@ -0,0 +1,23 @@
+# # Keep-warm scheduler
+#
+# Sets the warm pool of every deployment at the top of each hour, from the hourly schedule learned from its request
+# log (see `llm_hosting/keep_warm.py`). The schedules are planned when this app is deployed and baked into its
+# image, so redeploy it after capturing new logs:
+#
+#   python -m llm_hosting.keep_warm          # cold-start rate against GPU-hours of each candidate policy
+#   modal deploy keep_warm.py
+
+from modal import App, Cron, Image
+
+from llm_hosting.keep_warm import apply_schedules, plan_schedules, read_schedules, write_schedules
+
+image = Image.debian_slim(python_version="3.10").run_function(
+    write_schedules, kwargs={"schedules": plan_schedules()}
+)
+
+app = App("llm-keep-warm", image=image)
+
+
+@app.function(schedule=Cron("0 * * * *"))
+def set_warm_pools():
+    apply_schedules(read_schedules())
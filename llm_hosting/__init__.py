@@ -0,0 +1 @@
+# Shared helpers for the Modal model deployments in this repository.
@@ -0,0 +1,650 @@
+# # Admission control
+#
+# A small proxy in front of the vLLM server in each container. vLLM accepts every request and queues what it
+# cannot schedule, so under a spike requests wait until their clients time out and the GPU then works on answers
+# nobody reads. The proxy instead keeps the queue itself:
+#
+# - every generation request reserves its worst-case KV-cache footprint (prompt tokens plus `max_tokens`);
+# - it is passed to vLLM only while the reservations fit in the planned KV cache and under `--max-num-seqs`,
+#   otherwise it waits in a FIFO queue;
+# - the wait is predicted from the tokens queued ahead of it and the rate at which reservations have been freed
+#   recently, or, when nothing has finished recently (a cold or stalled replica), a planned rate of every sequence
+#   slot decoding at a modest speed. If the prediction exceeds the profile's SLO, or the queue is full, the request
+#   gets a 429 with a `Retry-After` header straight away, so the client can back off or try another replica.
+#
+# Requests carry a priority class in the `X-Priority` header: `interactive` (the default) or `batch`. Interactive
+# requests are always admitted ahead of queued batch requests, batch requests may only hold `batch_max_share` of
+# the sequence and token budget, and batch requests are judged against their own, longer SLO. When an interactive
+# request cannot be admitted, the most recently admitted non-streaming batch request is preempted: its vLLM
+# request is aborted, which frees its KV cache, and it goes back to the front of the batch queue to be re-run
+# later. vLLM 0.6.1 has no priority scheduling of its own, so this recompute-style preemption is done here; a
+# streaming batch request has already sent its response headers and is never preempted.
+#
+# Requests whose client disconnects while queued are dropped without reaching vLLM, and a disconnect after that
+# closes the connection to vLLM, which aborts the generation; the `max_tokens` not generated are counted as
+# saved. Queue times, predicted waits, time to first token and outcomes per class are exposed at
+# `/admission/metrics` (Prometheus) and `/admission/metrics/json`, behind the same `VLLM_API_KEY` as vLLM's API.
+#
+# For profiles with prefix caching, each admitted request is also matched against a shadow of vLLM's prefix cache
+# (see `llm_hosting/prefix_cache.py`): the metrics then include the hit rate, the prefill tokens saved and time to
+# first token split by hit and miss, next to the hit rate vLLM reports itself.
+#
+# On a deployment that serves LoRA adapters, request counts, time to first token and request latency are also
+# labelled with the adapter each request asked for (`base` for the base model).
+#
+# When the container is stopped, the proxy drains (`drain_admission_proxy`, called from the launcher's SIGTERM
+# handler): queued and new requests get a 503 with `Retry-After`, which the gateway retries on the load-balanced
+# URL, while the requests in flight get the profile's `shutdown_grace_seconds` to finish. Whatever is still
+# running then is ended: a stream gets a last chunk with `finish_reason: "abort"`, as from a request vLLM aborted,
+# so the client keeps the partial answer and can continue from it, and a request still waiting for its answer gets
+# a 503. The number of requests drained and aborted is logged and counted in `admission_shutdown_requests_total`.
+
+import argparse
+import asyncio
+import collections
+import hmac
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+
+from llm_hosting.capacity import BLOCK_SIZE, CAPACITY_FILE
+from llm_hosting.keep_warm import DECODE_TOKENS_PER_SECOND
+from llm_hosting.metrics import Metrics
+from llm_hosting.prefix_cache import PrefixCacheTracker, engine_hit_rate
+from llm_hosting.profiles import PROFILES, ModelProfile
+from llm_hosting.proxy import (
+    PassthroughResponse,
+    UpstreamPool,
+    error_response,
+    forward_headers,
+    send_unless_disconnected,
+)
+from llm_hosting.ratelimit import UsageCounter
+from llm_hosting.snapshot import MODEL_DIR
+from llm_hosting.traces import DEFAULT_COMPLETION_TOKENS, estimate_tokens, prompt_text
+
+GENERATION_PATHS = {"/v1/chat/completions", "/v1/completions"}
+VLLM_DEFAULT_MAX_NUM_SEQS = 256
+DRAIN_WINDOW = 30.0  # seconds of completions used to estimate the drain rate
+DISCONNECT_POLL = 0.5
+ENGINE_METRICS_TIMEOUT = 2.0
+SHUTDOWN_POLL = 0.1
+SHUTDOWN_RETRY_AFTER = 1.0
+SHUTDOWN_CLOSE_SECONDS = 2.0  # for ended responses to close after the grace period
+
+PRIORITY_HEADER = "x-priority"
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)  # in admission order
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class AdmissionConfig:
+    slo_seconds: float
+    max_queue: int
+    max_sequences: int
+    max_tokens: Optional[int] = None  # None: only the sequence limit applies
+    batch_slo_seconds: float = 300.0
+    batch_max_share: float = 0.5
+    preempt_batch: bool = True
+    # Reservation tokens freed per second assumed while nothing has finished recently; None: every sequence slot
+    # decoding at DECODE_TOKENS_PER_SECOND, which undercounts the prompt tokens freed with each request.
+    planned_tokens_per_second: Optional[float] = None
+
+    def cold_tokens_per_second(self) -> float:
+        return self.planned_tokens_per_second or self.max_sequences * DECODE_TOKENS_PER_SECOND
+
+
+@dataclass(eq=False)  # tickets are tracked by identity
+class Ticket:
+    cost: int
+    priority: str = INTERACTIVE
+    preemptible: bool = False
+    enqueued: float = field(default_factory=time.monotonic)
+    future: Optional[asyncio.Future] = None
+    preempted: asyncio.Event = field(default_factory=asyncio.Event)
+    attempts: int = 0
+
+
+def request_cost(body: dict) -> int:
+    return estimate_tokens(prompt_text(body)) + (body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+def request_priority(headers) -> str:
+    priority = (headers.get(PRIORITY_HEADER) or INTERACTIVE).strip().lower()
+    return priority if priority in PRIORITIES else INTERACTIVE
+
+
+class AdmissionController:
+    def __init__(self, config: AdmissionConfig, metrics: Optional[Metrics] = None):
+        self.config = config
+        self.metrics = metrics or Metrics()
+        self.inflight_requests = {p: 0 for p in PRIORITIES}
+        self.inflight_tokens = {p: 0 for p in PRIORITIES}
+        self.queues: Dict[str, Deque[Ticket]] = {p: collections.deque() for p in PRIORITIES}
+        self.queued_tokens = {p: 0 for p in PRIORITIES}
+        self.released: Deque[Tuple[float, int]] = collections.deque()  # (time, tokens) of recent releases
+        self.preemptible: List[Ticket] = []  # admitted batch tickets, oldest first
+        self.stopping = False
+
+        self.metrics.describe("admission_requests_total", "Generation requests by priority and admission outcome")
+        self.metrics.describe("admission_queue_seconds", "Time spent queued before reaching vLLM")
+        self.metrics.describe("admission_predicted_wait_seconds", "Predicted queueing time at arrival")
+        self.metrics.describe("admission_ttft_seconds", "Arrival to first response chunk, including queueing")
+        self.metrics.describe("admission_request_seconds", "Arrival to end of response")
+        self.metrics.describe("admission_tokens_saved_total", "Completion tokens not generated because the client left")
+
+    def _fits(self, ticket: Ticket) -> bool:
+        requests = sum(self.inflight_requests.values())
+        tokens = sum(self.inflight_tokens.values())
+        if requests == 0:
+            # Always let one request through, however large, so an oversized request cannot block the queue.
+            return True
+        if requests >= self.config.max_sequences:
+            return False
+        if self.config.max_tokens is not None and tokens + ticket.cost > self.config.max_tokens:
+            return False
+        if ticket.priority == BATCH:
+            share = self.config.batch_max_share
+            if self.inflight_requests[BATCH] >= max(1, int(share * self.config.max_sequences)):
+                return False
+            if self.config.max_tokens is not None and self.inflight_tokens[BATCH] + ticket.cost > share * self.config.max_tokens:
+                return self.inflight_requests[BATCH] == 0
+        return True
+
+    # Requests and reservation tokens freed per second over the recent window.
+    def drain_rate(self, now: float) -> Tuple[float, float]:
+        while self.released and now - self.released[0][0] > DRAIN_WINDOW:
+            self.released.popleft()
+        if not self.released:
+            return 0.0, 0.0
+        span = max(now - self.released[0][0], 1.0)
+        return len(self.released) / span, sum(tokens for _, tokens in self.released) / span
+
+    # Interactive requests only wait behind interactive ones; batch requests behind everything.
+    def predicted_wait(self, ticket: Ticket, now: float) -> float:
+        ahead = PRIORITIES[: PRIORITIES.index(ticket.priority) + 1]
+        queued = sum(len(self.queues[p]) for p in ahead)
+        if not queued and self._fits(ticket):
+            return 0.0
+        queued_tokens = sum(self.queued_tokens[p] for p in ahead) + ticket.cost
+        requests_rate, tokens_rate = self.drain_rate(now)
+        if not requests_rate:
+            # Nothing finished recently: everything queued, this request included, at the planned rate.
+            return queued_tokens / self.config.cold_tokens_per_second()
+        free_sequences = max(self.config.max_sequences - sum(self.inflight_requests.values()), 0)
+        waits = [(queued + 1 - free_sequences) / requests_rate]
+        if self.config.max_tokens is not None:
+            free_tokens = max(self.config.max_tokens - sum(self.inflight_tokens.values()), 0)
+            waits.append((queued_tokens - free_tokens) / tokens_rate)
+        return max(0.0, *waits)
+
+    def _update_gauges(self):
+        for p in PRIORITIES:
+            labels = {"priority": p}
+            self.metrics.set("admission_inflight_requests", self.inflight_requests[p], labels)
+            self.metrics.set("admission_inflight_tokens", self.inflight_tokens[p], labels)
+            self.metrics.set("admission_queue_depth", len(self.queues[p]), labels)
+            self.metrics.set("admission_queued_tokens", self.queued_tokens[p], labels)
+
+    def _admit(self, ticket: Ticket):
+        self.inflight_requests[ticket.priority] += 1
+        self.inflight_tokens[ticket.priority] += ticket.cost
+        if ticket.preemptible:
+            ticket.preempted.clear()
+            self.preemptible.append(ticket)
+
+    def _dequeue(self, ticket: Ticket):
+        self.queues[ticket.priority].remove(ticket)
+        self.queued_tokens[ticket.priority] -= ticket.cost
+
+    def _preempt_one(self):
+        if not self.config.preempt_batch or any(t.preempted.is_set() for t in self.preemptible):
+            return  # wait for the pending preemption to free its slot first
+        for ticket in reversed(self.preemptible):  # the newest has done the least work
+            ticket.preempted.set()
+            self.metrics.inc("admission_preempted_total", labels={"priority": ticket.priority})
+            return
+
+    def _wake(self):
+        interactive, batch = self.queues[INTERACTIVE], self.queues[BATCH]
+        while interactive and self._fits(interactive[0]):
+            ticket = interactive[0]
+            self._dequeue(ticket)
+            self._admit(ticket)
+            ticket.future.set_result(None)
+        if interactive:
+            # Interactive requests are still waiting: nothing jumps ahead of them, and batch work makes room.
+            self._preempt_one()
+        else:
+            while batch and self._fits(batch[0]):
+                ticket = batch[0]
+                self._dequeue(ticket)
+                self._admit(ticket)
+                ticket.future.set_result(None)
+        self._update_gauges()
+
+    # Shutdown: nothing is admitted any more and the queued requests are turned away, to be retried elsewhere.
+    # Returns how many were queued.
+    def stop_admitting(self) -> int:
+        self.stopping = True
+        rejected = 0
+        for priority in PRIORITIES:
+            while self.queues[priority]:
+                ticket = self.queues[priority][0]
+                self._dequeue(ticket)
+                ticket.future.set_exception(AdmissionRejected("draining", SHUTDOWN_RETRY_AFTER))
+                rejected += 1
+        self._update_gauges()
+        return rejected
+
+    def reject_or_none(self, ticket: Ticket) -> Optional[AdmissionRejected]:
+        now = time.monotonic()
+        wait = self.predicted_wait(ticket, now)
+        slo = self.config.batch_slo_seconds if ticket.priority == BATCH else self.config.slo_seconds
+        self.metrics.observe("admission_predicted_wait_seconds", wait, {"priority": ticket.priority})
+        if sum(len(q) for q in self.queues.values()) >= self.config.max_queue:
+            return AdmissionRejected("queue_full", wait or slo)
+        if wait > slo:
+            return AdmissionRejected("slo", wait)
+        return None
+
+    # Waits until the request may be sent to vLLM and returns True, or False if the client disconnected while
+    # queued. `disconnected` is polled while waiting. A preempted ticket is queued again at the front of its
+    # class, without another SLO check.
+    async def acquire(self, ticket: Ticket, disconnected=None) -> bool:
+        labels = {"priority": ticket.priority}
+        if self.stopping:
+            # Also a preempted ticket: it is re-run on another container.
+            self.metrics.inc("admission_requests_total", labels={**labels, "outcome": "rejected_draining"})
+            raise AdmissionRejected("draining", SHUTDOWN_RETRY_AFTER)
+        if not ticket.attempts:
+            rejected = self.reject_or_none(ticket)
+            if rejected:
+                self.metrics.inc("admission_requests_total", labels={**labels, "outcome": f"rejected_{rejected.reason}"})
+                raise rejected
+        ticket.attempts += 1
+
+        start = time.monotonic()
+        queue = self.queues[ticket.priority]
+        if not any(self.queues[p] for p in PRIORITIES[: PRIORITIES.index(ticket.priority) + 1]) and self._fits(ticket):
+            self._admit(ticket)
+        else:
+            ticket.future = asyncio.get_running_loop().create_future()
+            if ticket.attempts > 1:
+                queue.appendleft(ticket)
+            else:
+                queue.append(ticket)
+            self.queued_tokens[ticket.priority] += ticket.cost
+            self._wake()
+            while not ticket.future.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.future), DISCONNECT_POLL)
+                except asyncio.TimeoutError:
+                    if disconnected and await disconnected():
+                        self._abandon(ticket)
+                        return False
+                except AdmissionRejected:
+                    self.metrics.inc("admission_requests_total", labels={**labels, "outcome": "rejected_draining"})
+                    raise
+                except asyncio.CancelledError:
+                    self._abandon(ticket)
+                    raise
+
+        self.metrics.observe("admission_queue_seconds", time.monotonic() - start, labels)
+        if ticket.attempts == 1:
+            self.metrics.inc("admission_requests_total", labels={**labels, "outcome": "admitted"})
+        self._update_gauges()
+        return True
+
+    def _abandon(self, ticket: Ticket):
+        if ticket.future.done():
+            # Admitted in the meantime: give the reservation back.
+            self.release(ticket)
+        else:
+            ticket.future.cancel()
+            self._dequeue(ticket)
+            self._wake()
+        self.metrics.inc("admission_requests_total", labels={"priority": ticket.priority, "outcome": "abandoned"})
+        self.metrics.observe("admission_abandoned_queue_seconds", time.monotonic() - ticket.enqueued)
+
+    def release(self, ticket: Ticket, completed: bool = True):
+        self.inflight_requests[ticket.priority] -= 1
+        self.inflight_tokens[ticket.priority] -= ticket.cost
+        if ticket in self.preemptible:
+            self.preemptible.remove(ticket)
+        if completed:
+            self.released.append((time.monotonic(), ticket.cost))
+        self._wake()
+
+
+# Token budget of the KV cache as planned at build time (see `check_snapshot_capacity`).
+def planned_kv_tokens(model_dir: str = MODEL_DIR) -> Optional[int]:
+    path = os.path.join(model_dir, CAPACITY_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get("kv_cache_tokens")
+
+
+def admission_config(profile: ModelProfile, model_dir: str = MODEL_DIR) -> AdmissionConfig:
+    return AdmissionConfig(
+        slo_seconds=profile.admission_slo_seconds,
+        max_queue=profile.admission_max_queue,
+        max_sequences=profile.max_num_seqs or VLLM_DEFAULT_MAX_NUM_SEQS,
+        max_tokens=planned_kv_tokens(model_dir),
+        batch_slo_seconds=profile.admission_batch_slo_seconds,
+        batch_max_share=profile.batch_max_share,
+        preempt_batch=profile.preempt_batch,
+    )
+
+
+# The last chunk of a stream ended by shutdown. Non-streaming responses are just closed.
+def abort_trailer(body: dict) -> bytes:
+    if not body.get("stream"):
+        return b""
+    chat = "messages" in body
+    chunk = {
+        "object": "chat.completion.chunk" if chat else "text_completion",
+        "model": body.get("model"),
+        "choices": [{"index": 0, **({"delta": {}} if chat else {"text": ""}), "finish_reason": "abort"}],
+    }
+    return f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode()
+
+
+def create_app(
+    upstream_url: str,
+    controller: AdmissionController,
+    prefix_cache: Optional[PrefixCacheTracker] = None,
+    adapters: Iterable[str] = (),
+    api_key: Optional[str] = None,
+) -> FastAPI:
+    app = FastAPI()
+    # vLLM is on the same host, so plain HTTP/1.1 keep-alive connections.
+    pool = UpstreamPool(http2=False, max_connections=controller.config.max_sequences + controller.config.max_queue)
+    metrics = controller.metrics
+    app.state.controller = controller
+    prefix_totals = {"prompt": 0, "cached": 0}
+    adapters = set(adapters)
+    # Admitted requests, with their response and its abort trailer once the response has started.
+    active: Dict[Ticket, Optional[Tuple[PassthroughResponse, bytes]]] = {}
+    aborted: Set[Ticket] = set()
+    grace_over = asyncio.Event()
+
+    metrics.describe("prefix_cache_requests_total", "Admitted requests by estimated prefix-cache result")
+    metrics.describe("prefix_cache_saved_prefill_tokens_total", "Prompt tokens estimated to come from the prefix cache")
+    metrics.describe("prefix_cache_hit_rate", "Share of prompt tokens estimated to come from the prefix cache")
+    metrics.describe("prefix_cache_engine_hit_rate", "vLLM's own GPU prefix-cache hit rate")
+    metrics.describe("admission_adapter_requests_total", "Generation requests by LoRA adapter")
+    metrics.describe("admission_shutdown_requests_total", "Requests in flight at shutdown, drained or aborted")
+
+    @app.on_event("startup")
+    async def remember_loop():
+        app.state.loop = asyncio.get_running_loop()
+
+    @app.on_event("shutdown")
+    async def close_pool():
+        await pool.aclose()
+
+    async def drain(grace_seconds: float) -> dict:
+        start = time.monotonic()
+        rejected = controller.stop_admitting()
+        in_flight = len(active)
+        while active and time.monotonic() - start < grace_seconds:
+            await asyncio.sleep(SHUTDOWN_POLL)
+        for ticket, started in list(active.items()):
+            aborted.add(ticket)
+            if started:
+                response, trailer = started
+                response.interrupt(trailer)
+        grace_over.set()
+        closing = time.monotonic()
+        while active and time.monotonic() - closing < SHUTDOWN_CLOSE_SECONDS:
+            await asyncio.sleep(SHUTDOWN_POLL)
+        report = {
+            "in_flight": in_flight,
+            "drained": in_flight - len(aborted),
+            "aborted": len(aborted),
+            "rejected_queued": rejected,
+            "drain_seconds": round(time.monotonic() - start, 3),
+        }
+        metrics.inc("admission_shutdown_requests_total", report["drained"], {"outcome": "drained"})
+        metrics.inc("admission_shutdown_requests_total", report["aborted"], {"outcome": "aborted"})
+        return report
+
+    app.state.drain = drain
+
+    # Copies vLLM's hit rate into the proxy's metrics at scrape time.
+    async def scrape_engine():
+        if prefix_cache is None:
+            return
+        try:
+            response = await pool.client(upstream_url).get("/metrics", timeout=ENGINE_METRICS_TIMEOUT)
+        except Exception:
+            return
+        rate = engine_hit_rate(response.text)
+        if rate is not None:
+            metrics.set("prefix_cache_engine_hit_rate", rate)
+
+    # The metrics show load and queue depth, so they need the key vLLM's own API does.
+    def authorized(request: Request) -> bool:
+        return not api_key or hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {api_key}")
+
+    @app.get("/admission/metrics")
+    async def prometheus_metrics(request: Request):
+        if not authorized(request):
+            return error_response(401, "Invalid API key", "invalid_api_key")
+        await scrape_engine()
+        return PlainTextResponse(metrics.render_prometheus())
+
+    @app.get("/admission/metrics/json")
+    async def json_metrics(request: Request):
+        if not authorized(request):
+            return error_response(401, "Invalid API key", "invalid_api_key")
+        await scrape_engine()
+        return metrics.to_json()
+
+    def match_prefix(body: dict) -> str:
+        match = prefix_cache.match(body)
+        prefix_totals["prompt"] += match.prompt_tokens
+        prefix_totals["cached"] += match.cached_tokens
+        result = "hit" if match.hit else "miss"
+        metrics.inc("prefix_cache_requests_total", labels={"result": result})
+        metrics.inc("prefix_cache_prompt_tokens_total", match.prompt_tokens)
+        metrics.inc("prefix_cache_saved_prefill_tokens_total", match.cached_tokens)
+        metrics.set("prefix_cache_hit_rate", prefix_totals["cached"] / max(prefix_totals["prompt"], 1))
+        return result
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+    async def forward(request: Request, path: str):
+        start = time.monotonic()
+        raw = await request.body()
+        client = pool.client(upstream_url)
+
+        def send():
+            return client.send(
+                client.build_request(
+                    request.method, request.url.path, params=request.query_params, content=raw,
+                    headers=forward_headers(request.headers),
+                ),
+                stream=True,
+            )
+
+        ticket = None
+        if request.method == "POST" and request.url.path in GENERATION_PATHS:
+            try:
+                body = json.loads(raw)
+                priority = request_priority(request.headers)
+                ticket = Ticket(request_cost(body), priority, preemptible=priority == BATCH and not body.get("stream"))
+            except (ValueError, AttributeError):
+                ticket = None  # let vLLM produce the error
+        if ticket is None:
+            try:
+                return PassthroughResponse(await send())
+            except Exception as e:
+                return error_response(502, f"vLLM request failed: {type(e).__name__}", "upstream_error")
+
+        labels = {"priority": ticket.priority}
+        if adapters:
+            labels["adapter"] = body.get("model") if body.get("model") in adapters else "base"
+            metrics.inc("admission_adapter_requests_total", labels={"adapter": labels["adapter"]})
+        ttft_labels = dict(labels)
+        usage = UsageCounter(stream=bool(body.get("stream")))
+        max_tokens = body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+
+        # The client went away after `generated` tokens; vLLM aborts the rest when its connection closes.
+        def cancelled(generated: int):
+            metrics.inc("admission_cancelled_total", labels=labels)
+            metrics.inc("admission_tokens_saved_total", max(max_tokens - generated, 0), labels)
+
+        while True:
+            try:
+                if not await controller.acquire(ticket, request.is_disconnected):
+                    return error_response(499, "Client closed the request while it was queued", "client_closed")
+            except AdmissionRejected as e:
+                retry_after = str(max(1, math.ceil(e.retry_after)))
+                if e.reason == "draining":
+                    return error_response(
+                        503, "Server is shutting down; retry", "draining", headers={"Retry-After": retry_after}
+                    )
+                return error_response(
+                    429,
+                    f"Server is over capacity ({e.reason}); retry after {retry_after}s",
+                    "overloaded",
+                    headers={"Retry-After": retry_after},
+                )
+
+            # Matched once, when first admitted: a preempted request that is re-run would otherwise be counted
+            # again and hit its own blocks. Requests turned away above never reach vLLM's cache.
+            if prefix_cache is not None and "prefix_cache" not in ttft_labels:
+                ttft_labels["prefix_cache"] = match_prefix(body)
+            active[ticket] = None
+
+            # Non-streaming batch responses only start once the generation is done, so until then the request can
+            # be aborted in vLLM and re-run later without the client noticing.
+            preempted = asyncio.ensure_future(ticket.preempted.wait()) if ticket.preemptible else None
+            shutdown = asyncio.ensure_future(grace_over.wait())
+            sending = await send_unless_disconnected(request, send(), shutdown, *([preempted] if preempted else []))
+            shutdown.cancel()
+            if preempted:
+                preempted.cancel()
+            if sending is None:
+                del active[ticket]
+                controller.release(ticket, completed=False)
+                if ticket in aborted:
+                    return error_response(
+                        503, "Server shut down before the response started; retry", "draining",
+                        headers={"Retry-After": str(math.ceil(SHUTDOWN_RETRY_AFTER))},
+                    )
+                if ticket.preempted.is_set():
+                    continue
+                cancelled(0)
+                return error_response(499, "Client closed the request", "client_closed")
+            try:
+                response = sending.result()
+            except Exception as e:
+                del active[ticket]
+                controller.release(ticket)
+                return error_response(502, f"vLLM request failed: {type(e).__name__}", "upstream_error")
+            break
+
+        first_chunk = []
+
+        def on_chunk(chunk: bytes):
+            usage.feed(chunk)
+            if not first_chunk:
+                first_chunk.append(True)
+                metrics.observe("admission_ttft_seconds", time.monotonic() - start, ttft_labels)
+
+        def on_close(completed: bool):
+            active.pop(ticket, None)
+            controller.release(ticket)
+            metrics.observe("admission_request_seconds", time.monotonic() - start, labels)
+            if not completed and ticket not in aborted:
+                cancelled(usage.streamed_chunks)
+
+        passthrough = PassthroughResponse(response, on_close=on_close, on_chunk=on_chunk)
+        active[ticket] = (passthrough, abort_trailer(body))
+        if grace_over.is_set():
+            aborted.add(ticket)
+            passthrough.interrupt(abort_trailer(body))
+        return passthrough
+
+    return app
+
+
+# Serves the proxy on `port` from a background thread and returns its app once it accepts connections.
+def start_admission_proxy(profile: ModelProfile, upstream_port: int, port: int, model_dir: str = MODEL_DIR) -> FastAPI:
+    import uvicorn
+
+    controller = AdmissionController(admission_config(profile, model_dir))
+    prefix_cache = None
+    if profile.enable_prefix_caching:
+        kv_tokens = controller.config.max_tokens
+        prefix_cache = PrefixCacheTracker(kv_tokens // BLOCK_SIZE if kv_tokens else None)
+    app = create_app(
+        f"http://127.0.0.1:{upstream_port}",
+        controller,
+        prefix_cache,
+        profile.lora_adapters or (),
+        api_key=os.environ.get("VLLM_API_KEY"),
+    )
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None  # only possible on the main thread
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"Admission proxy for {profile.name} failed to start on port {port}")
+        time.sleep(0.1)
+    print(json.dumps({"event": "admission_proxy_started", "port": port, "upstream_port": upstream_port,
+                      "prefix_caching": profile.enable_prefix_caching, **asdict(controller.config)}))
+    return app
+
+
+# Drains a proxy started with `start_admission_proxy` from another thread, such as a signal handler, and returns
+# the drain report.
+def drain_admission_proxy(app: FastAPI, grace_seconds: float) -> dict:
+    drained = asyncio.run_coroutine_threadsafe(app.state.drain(grace_seconds), app.state.loop)
+    return drained.result(grace_seconds + SHUTDOWN_CLOSE_SECONDS + 5)
+
+
+# The proxy on its own, in front of a local engine such as the mock one, to try out admission and shutdown:
+#   python -m llm_hosting.mock_server --port 8001 --token-delay 0.05 --default-max-tokens 400
+#   python -m llm_hosting.admission --upstream-port 8001 --port 8000 --shutdown-grace 5
+# then stop it with Ctrl-C or SIGTERM while requests are streaming.
+def main():
+    parser = argparse.ArgumentParser(description="Run the admission proxy in front of a local engine.")
+    parser.add_argument("--profile", default="vllm-llama3-8b", help="Profile for the admission settings")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--upstream-port", type=int, default=8001)
+    parser.add_argument("--shutdown-grace", type=float, help="Seconds in-flight requests get at shutdown")
+    args = parser.parse_args()
+
+    from llm_hosting.launcher import drain_on_shutdown
+
+    profile = PROFILES[args.profile]
+    if args.shutdown_grace is not None:
+        profile = replace(profile, shutdown_grace_seconds=args.shutdown_grace)
+    app = start_admission_proxy(profile, args.upstream_port, args.port)
+    drain_on_shutdown(profile, None, lambda grace_seconds: drain_admission_proxy(app, grace_seconds))
+    while True:
+        time.sleep(60)
+
+
+if __name__ == "__main__":
+    main()
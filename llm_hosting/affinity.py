@@ -0,0 +1,238 @@
+# # Session affinity
+#
+# Modal load-balances every request to any container of a deployment, so the next turn of a conversation usually
+# lands on a container that has none of its prefix cached. To keep a conversation on one container:
+#
+# - each vLLM container opens a Modal tunnel to its public port and registers the tunnel URL, with a heartbeat,
+#   in the `llm-replicas` Modal Dict (`register_replica`);
+# - the gateway reads the registry every few seconds and hashes each request's session key onto the live
+#   containers of its deployment with consistent hashing with bounded loads: a key goes to the first container
+#   clockwise on the ring whose in-flight requests are under `LOAD_FACTOR` times the average, so a hot
+#   conversation spills over to the next container instead of piling up;
+# - the session key is the `X-Session-Id` header or the request's `user` field, or else the prompt up to the
+#   first user message (the system prompt and opening question stay the same on every turn).
+#
+# When a container scales in, only the keys it held move (a container that is shutting down leaves the registry
+# first); when one scales out, it takes over about 1/n of the keys. Requests fall back to the deployment's
+# load-balanced URL while no container is registered, and retry there when a container's tunnel does not answer.
+#
+# Requests through a tunnel are not Modal inputs: Modal's autoscaler does not see them, `allow_concurrent_inputs`
+# does not limit them, and a container serving only pinned conversations looks idle and is stopped after its idle
+# timeout. So a container takes at most its `--max-num-seqs` pinned requests from the gateway, after which
+# conversations spill over to the load-balanced URL where Modal counts them and scales out; and the gateway asks
+# for a warm pool (`request_warm_pool`) as large as the number of containers that had pinned requests within
+# their idle timeout. Modal chooses which containers the warm pool keeps, so a container holding conversations
+# can still be stopped; it drains like any other and its conversations move on.
+
+import bisect
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from llm_hosting.capacity import MAX_NUM_SEQS_LIMIT
+from llm_hosting.keep_warm import request_warm_pool
+from llm_hosting.profiles import ModelProfile
+from llm_hosting.traces import message_text
+
+REGISTRY_NAME = "llm-replicas"
+HEARTBEAT_SECONDS = 10
+STALE_AFTER = 3 * HEARTBEAT_SECONDS  # a container missing this many seconds of heartbeats is left out
+PRUNE_AFTER = 600  # registry entries of containers gone this long are deleted
+REFRESH_SECONDS = 5
+DOWN_SECONDS = 30  # a container whose tunnel failed is skipped for this long
+
+WARM_POOL_SOURCE = "affinity"
+
+SESSION_HEADER = "x-session-id"
+SESSION_PREFIX_CHARS = 4096
+VIRTUAL_NODES = 64
+LOAD_FACTOR = 1.25
+
+
+def uses_affinity(profile: ModelProfile) -> bool:
+    return profile.engine == "vllm" and profile.enable_prefix_caching and profile.session_affinity
+
+
+# Keeps this container in the registry until the returned function is called, at shutdown. Outside Modal there
+# is no tunnel to register.
+def register_replica(profile: ModelProfile) -> Callable[[], None]:
+    stop = threading.Event()
+    task_id = os.environ.get("MODAL_TASK_ID")
+    if not task_id:
+        return stop.set
+    # Both are set on the container at deploy time (see `server_options`).
+    entry = {
+        "deployment": profile.name,
+        "max_num_seqs": profile.max_num_seqs or MAX_NUM_SEQS_LIMIT,
+        "idle_timeout": int(os.environ.get("CONTAINER_IDLE_TIMEOUT") or profile.container_idle_timeout),
+    }
+
+    def run():
+        from modal import Dict, forward
+
+        registry = Dict.from_name(REGISTRY_NAME, create_if_missing=True)
+        key = f"{profile.name}/{task_id}"
+        try:
+            with forward(profile.port) as tunnel:
+                print(json.dumps({"event": "replica_registered", "deployment": profile.name, "replica": task_id,
+                                  "url": tunnel.url}))
+                while not stop.is_set():
+                    registry.put(key, {**entry, "url": tunnel.url, "updated": time.time()})
+                    stop.wait(HEARTBEAT_SECONDS)
+                registry.pop(key)
+                # The tunnel stays open for the requests still streaming through it.
+                while True:
+                    time.sleep(HEARTBEAT_SECONDS)
+        except Exception as e:
+            # Requests still reach this container through the load-balanced URL.
+            print(json.dumps({"event": "replica_registration_failed", "deployment": profile.name,
+                              "error": f"{type(e).__name__}: {e}"}))
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop.set
+
+
+# Registry entries, keyed by `<deployment>/<task id>`. Runs in the gateway container, off the event loop.
+def read_registry() -> Dict[str, dict]:
+    from modal import Dict
+
+    registry = Dict.from_name(REGISTRY_NAME, create_if_missing=True)
+    entries = dict(registry.items())
+    now = time.time()
+    for key, entry in list(entries.items()):
+        if now - entry.get("updated", 0) > PRUNE_AFTER:
+            registry.pop(key)
+            del entries[key]
+    return entries
+
+
+# Keeps the warm pool of `deployment` at no fewer than `size` containers. Runs in the gateway container, off the
+# event loop.
+def hold_warm_pool(deployment: str, function: str, size: int) -> int:
+    return request_warm_pool(deployment, function, WARM_POOL_SOURCE, size)
+
+
+def affinity_enabled() -> bool:
+    return os.environ.get("GATEWAY_AFFINITY", "1") != "0"
+
+
+def session_key(headers, body: dict) -> Optional[str]:
+    explicit = headers.get(SESSION_HEADER) or body.get("user")
+    if explicit:
+        return f"session:{explicit}"
+    if "messages" in body:
+        head = []
+        for message in body["messages"]:
+            head.append(f"{message.get('role')}:{message_text(message)}")
+            if message.get("role") == "user":
+                break
+        text = "\n".join(head)
+    else:
+        prompt = body.get("prompt", "")
+        text = prompt if isinstance(prompt, str) else "".join(map(str, prompt))
+    return f"prefix:{text[:SESSION_PREFIX_CHARS]}" if text else None
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+@dataclass
+class Replica:
+    id: str
+    deployment: str
+    url: str
+    max_in_flight: Optional[int] = None  # the container's --max-num-seqs
+    idle_timeout: float = 0.0
+    in_flight: int = 0
+    down_until: float = 0.0
+    last_leased: float = 0.0
+
+
+class HashRing:
+    def __init__(self, replica_ids: List[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.points = sorted((_hash(f"{r}#{i}"), r) for r in replica_ids for i in range(virtual_nodes))
+
+    # Replica ids in ring order starting from the key's position, each once.
+    def walk(self, key: str) -> List[str]:
+        start = bisect.bisect(self.points, (_hash(key),))
+        order = []
+        for i in range(len(self.points)):
+            replica_id = self.points[(start + i) % len(self.points)][1]
+            if replica_id not in order:
+                order.append(replica_id)
+        return order
+
+
+class ReplicaDirectory:
+    def __init__(self, load_factor: float = LOAD_FACTOR):
+        self.load_factor = load_factor
+        self.replicas: Dict[str, Dict[str, Replica]] = {}  # deployment -> replica id -> replica
+        self.rings: Dict[str, HashRing] = {}
+
+    # Replaces the live replicas with the registry's, keeping the in-flight counts of those still there.
+    def update(self, entries: Dict[str, dict], now: Optional[float] = None):
+        now = now or time.time()
+        live: Dict[str, Dict[str, Replica]] = {}
+        for replica_id, entry in entries.items():
+            if now - entry.get("updated", 0) > STALE_AFTER:
+                continue
+            deployment = entry["deployment"]
+            previous = self.replicas.get(deployment, {}).get(replica_id)
+            replica = previous or Replica(replica_id, deployment, entry["url"].rstrip("/"))
+            replica.url = entry["url"].rstrip("/")
+            replica.max_in_flight = entry.get("max_num_seqs")
+            replica.idle_timeout = entry.get("idle_timeout", 0)
+            live.setdefault(deployment, {})[replica_id] = replica
+        for deployment, replicas in live.items():
+            if set(replicas) != set(self.replicas.get(deployment, {})):
+                self.rings[deployment] = HashRing(sorted(replicas))
+        for deployment in set(self.rings) - set(live):
+            del self.rings[deployment]
+        self.replicas = live
+
+    def count(self, deployment: str) -> int:
+        return len(self.replicas.get(deployment, {}))
+
+    # The replica for `key`, counted as in flight until `release`, or None to use the load-balanced URL. A replica
+    # never gets more pinned requests than its --max-num-seqs.
+    def lease(self, deployment: str, key: Optional[str]) -> Optional[Replica]:
+        replicas = self.replicas.get(deployment)
+        if not key or not replicas:
+            return None
+        now = time.monotonic()
+        up = [r for r in replicas.values() if r.down_until <= now]
+        if not up:
+            return None
+        capacity = math.ceil(self.load_factor * (sum(r.in_flight for r in up) + 1) / len(up))
+        for replica_id in self.rings[deployment].walk(key):
+            replica = replicas[replica_id]
+            full = replica.max_in_flight is not None and replica.in_flight >= replica.max_in_flight
+            if replica.down_until <= now and replica.in_flight < capacity and not full:
+                replica.in_flight += 1
+                replica.last_leased = now
+                return replica
+        return None
+
+    def release(self, replica: Replica):
+        replica.in_flight = max(replica.in_flight - 1, 0)
+        replica.last_leased = time.monotonic()
+
+    # Replicas of `deployment` with pinned requests in flight or within their idle timeout: the warm pool Modal
+    # has to keep, since it sees none of that traffic.
+    def pinned(self, deployment: str) -> int:
+        now = time.monotonic()
+        return sum(
+            1
+            for r in self.replicas.get(deployment, {}).values()
+            if r.in_flight or (r.last_leased and now - r.last_leased < r.idle_timeout)
+        )
+
+    def mark_down(self, replica: Replica):
+        replica.down_until = time.monotonic() + DOWN_SECONDS
+
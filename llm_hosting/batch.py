@@ -0,0 +1,298 @@
+# # Offline batch inference
+#
+# Runs a JSONL file of OpenAI-style requests through vLLM's offline engine instead of the HTTP server. Lines are
+# either bare request bodies (`{"messages": [...], "max_tokens": ...}`) or OpenAI Batch API lines
+# (`{"custom_id": ..., "body": {...}}`). Requests are sorted by prompt length and handed to the engine in chunks;
+# vLLM batches continuously within a chunk. Results are appended to the output JSONL after every chunk, so an
+# interrupted job picks up where it stopped when run again with the same output file. On a profile with LoRA
+# adapters, a request whose `model` names an adapter is generated with it. A line that cannot be run (it does not
+# tokenize, has an empty prompt, does not fit the context length, or the engine refuses it) gets an error result
+# (`"response": null, "error": {...}`) instead of stopping the job.
+
+import collections
+import json
+import os
+import time
+from typing import Callable, Iterable, List, Optional, Set, Tuple, Union
+
+from llm_hosting.profiles import ModelProfile
+from llm_hosting.preshard import LOAD_FORMAT, weights_dir
+from llm_hosting.snapshot import MODEL_DIR, OFFLINE_ENV, lora_path, resolve_snapshot
+from llm_hosting.traces import read_jsonl
+
+CHUNK_SIZE = 2048
+DEFAULT_MAX_TOKENS = 1024
+
+
+# Lines without a `custom_id` are named after their position, with a prefix so they cannot collide with ids
+# given in the file.
+def request_id(index: int, record: dict) -> str:
+    return str(record["custom_id"]) if "custom_id" in record else f"line-{index}"
+
+
+def request_params(record: dict) -> dict:
+    return record.get("body", record)
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+# Drops a trailing line left half-written by an interrupted run, so appended results start on a fresh line.
+def truncate_partial_line(output_path: str):
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+# Results are found by id, on resume and when shards are merged, so two requests with the same one would lose a
+# result.
+def check_unique_ids(ids: Iterable[str]):
+    duplicates = sorted(rid for rid, count in collections.Counter(ids).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Duplicate custom_id in batch input: {duplicates[:5]}")
+
+
+def pending_requests(input_path: str, output_path: str) -> List[Tuple[int, dict]]:
+    records = list(enumerate(read_jsonl(input_path)))
+    check_unique_ids(request_id(index, record) for index, record in records)
+    done = completed_ids(output_path)
+    return [(index, record) for index, record in records if request_id(index, record) not in done]
+
+
+def sampling_params(params: dict):
+    from vllm import SamplingParams
+
+    return SamplingParams(
+        n=params.get("n", 1),
+        temperature=params.get("temperature", 1.0),
+        top_p=params.get("top_p", 1.0),
+        max_tokens=params.get("max_tokens") or DEFAULT_MAX_TOKENS,
+        stop=params.get("stop"),
+        seed=params.get("seed"),
+        presence_penalty=params.get("presence_penalty", 0.0),
+        frequency_penalty=params.get("frequency_penalty", 0.0),
+    )
+
+
+def prompt_token_ids(tokenizer, params: dict) -> List[int]:
+    if "messages" in params:
+        return tokenizer.apply_chat_template(params["messages"], add_generation_prompt=True, tokenize=True)
+    return tokenizer.encode(params.get("prompt", ""))
+
+
+# What the OpenAI server refuses up front and the offline engine raises on in the middle of a chunk.
+def check_request(token_ids: List[int], sampling, max_model_len: int):
+    if not token_ids:
+        raise ValueError("the prompt is empty")
+    if len(token_ids) + sampling.max_tokens > max_model_len:
+        raise ValueError(
+            f"{len(token_ids)} prompt tokens plus max_tokens {sampling.max_tokens} exceed the context length "
+            f"of {max_model_len}"
+        )
+
+
+# Outputs of one chunk, in order. If the engine refuses the chunk, the requests it had already queued are aborted
+# and the chunk is run again one request at a time, so only the request at fault gets its exception back.
+def generate_chunk(llm, chunk: list, loras: dict) -> List[Union[object, Exception]]:
+    def generate(items):
+        adapters = [loras.get(request_params(record).get("model")) for _, record, _, _ in items]
+        first_id = llm.request_counter.counter
+        try:
+            return llm.generate(
+                [{"prompt_token_ids": token_ids} for _, _, token_ids, _ in items],
+                [params for _, _, _, params in items],
+                lora_request=adapters if loras else None,
+                use_tqdm=False,
+            )
+        except ValueError:
+            llm.llm_engine.abort_request([str(i) for i in range(first_id, llm.request_counter.counter)])
+            raise
+
+    try:
+        return generate(chunk)
+    except ValueError:
+        if len(chunk) == 1:
+            raise
+    results: List[Union[object, Exception]] = []
+    for item in chunk:
+        try:
+            results.extend(generate([item]))
+        except ValueError as e:
+            results.append(e)
+    return results
+
+
+def _timing(output) -> dict:
+    metrics = getattr(output, "metrics", None)
+    if metrics is None or metrics.finished_time is None:
+        return {}
+    timing = {"total_seconds": round(metrics.finished_time - metrics.arrival_time, 3)}
+    if metrics.first_token_time is not None:
+        timing["first_token_seconds"] = round(metrics.first_token_time - metrics.arrival_time, 3)
+    return timing
+
+
+def result_line(index: int, record: dict, output, model: str) -> dict:
+    chat = "messages" in request_params(record)
+    choices = []
+    for choice in output.outputs:
+        if chat:
+            content = {"message": {"role": "assistant", "content": choice.text}}
+        else:
+            content = {"text": choice.text}
+        choices.append({"index": choice.index, **content, "finish_reason": choice.finish_reason})
+    prompt_tokens = len(output.prompt_token_ids)
+    completion_tokens = sum(len(choice.token_ids) for choice in output.outputs)
+    return {
+        "id": request_id(index, record),
+        "index": index,
+        "response": {
+            "object": "chat.completion" if chat else "text_completion",
+            "model": model,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        },
+        "timing": _timing(output),
+    }
+
+
+# A request that cannot be run (no chat template, malformed messages, bad sampling parameters, too long for the
+# context) gets an error line in its place, as with the OpenAI Batch API, and the rest of the job goes on. It
+# counts as done on resume.
+def error_line(index: int, record: dict, error: Exception) -> dict:
+    return {
+        "id": request_id(index, record),
+        "index": index,
+        "response": None,
+        "error": {"code": "invalid_request", "message": f"{type(error).__name__}: {error}"},
+    }
+
+
+def engine_kwargs(profile: ModelProfile, model_dir: str = MODEL_DIR) -> dict:
+    kwargs = dict(
+        model=model_dir,
+        served_model_name=profile.base_model,
+        tensor_parallel_size=profile.tensor_parallel_size,
+        gpu_memory_utilization=profile.gpu_memory_utilization,
+        enable_prefix_caching=profile.enable_prefix_caching,
+    )
+    if profile.quantization:
+        kwargs["quantization"] = profile.quantization
+    if profile.max_model_len:
+        kwargs["max_model_len"] = profile.max_model_len
+    if profile.enable_chunked_prefill:
+        kwargs["enable_chunked_prefill"] = True
+    if profile.max_num_batched_tokens:
+        kwargs["max_num_batched_tokens"] = profile.max_num_batched_tokens
+    if profile.preshard:
+        kwargs["load_format"] = LOAD_FORMAT
+    if profile.lora_adapters is not None:
+        kwargs.update(
+            enable_lora=True,
+            max_loras=profile.max_loras,
+            max_lora_rank=profile.max_lora_rank,
+            max_cpu_loras=profile.max_cpu_loras or max(len(profile.lora_adapters), profile.max_loras),
+        )
+    # The profile's max_num_seqs is sized for interactive latency; offline the engine keeps its default and
+    # batches as much as the KV cache allows. Speculative decoding is left off for the same reason: it only pays
+    # at small batch sizes.
+    return kwargs
+
+
+def run_batch(
+    profile: ModelProfile,
+    input_path: str,
+    output_path: str,
+    model_dir: str = MODEL_DIR,
+    chunk_size: int = CHUNK_SIZE,
+    checkpoint: Optional[Callable[[], None]] = None,
+) -> dict:
+    job_start = time.monotonic()
+    os.environ.update(OFFLINE_ENV)
+    model_dir = weights_dir(profile, model_dir)
+    resolve_snapshot(model_dir)
+
+    truncate_partial_line(output_path)
+    pending = pending_requests(input_path, output_path)
+    # `seconds` is generation time; `total_seconds` also covers loading the engine.
+    report = {
+        "requests": len(pending),
+        "errors": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "seconds": 0.0,
+        "total_seconds": 0.0,
+    }
+    if not pending:
+        return report
+
+    from vllm import LLM
+
+    llm = LLM(**engine_kwargs(profile, model_dir))
+    tokenizer = llm.get_tokenizer()
+    loras = {}
+    if profile.lora_adapters:
+        from vllm.lora.request import LoRARequest
+
+        names = sorted(profile.lora_adapters)
+        loras = {name: LoRARequest(name, i + 1, lora_path(name)) for i, name in enumerate(names)}
+
+    # Tokenize once up front; sorting by length keeps each chunk's sequences a similar size.
+    max_model_len = llm.llm_engine.model_config.max_model_len
+    work, errors = [], []
+    for index, record in pending:
+        params = request_params(record)
+        try:
+            token_ids, sampling = prompt_token_ids(tokenizer, params), sampling_params(params)
+            check_request(token_ids, sampling, max_model_len)
+            work.append((index, record, token_ids, sampling))
+        except Exception as e:  # the template and tokenizer raise a variety of errors on bad input
+            errors.append(error_line(index, record, e))
+    work.sort(key=lambda item: len(item[2]))
+
+    start = time.monotonic()
+    with open(output_path, "a") as out:
+        if errors:
+            report["errors"] += len(errors)
+            out.writelines(json.dumps(line) + "\n" for line in errors)
+            out.flush()
+            os.fsync(out.fileno())
+        for offset in range(0, len(work), chunk_size):
+            chunk = work[offset:offset + chunk_size]
+            for (index, record, _, _), output in zip(chunk, generate_chunk(llm, chunk, loras)):
+                if isinstance(output, Exception):
+                    report["errors"] += 1
+                    out.write(json.dumps(error_line(index, record, output)) + "\n")
+                    continue
+                model = request_params(record).get("model")
+                line = result_line(index, record, output, model if model in loras else profile.base_model)
+                report["prompt_tokens"] += line["response"]["usage"]["prompt_tokens"]
+                report["completion_tokens"] += line["response"]["usage"]["completion_tokens"]
+                out.write(json.dumps(line) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            if checkpoint:
+                checkpoint()
+            print(f"{profile.name}: {offset + len(chunk)}/{len(work)} requests done")
+
+    report["seconds"] = round(time.monotonic() - start, 3)
+    report["total_seconds"] = round(time.monotonic() - job_start, 3)
+    print(json.dumps({"event": "batch_done", "deployment": profile.name, **report}))
+    return report
@@ -0,0 +1,443 @@
+# # Load testing
+#
+# Replays a request trace against any OpenAI-compatible endpoint and reports latency percentiles:
+#
+#   python -m llm_hosting.bench run --url https://<workspace>--vllm-llama3-8b-openai-compatible-server.modal.run \
+#       --model meta-llama/Meta-Llama-3-8B-Instruct --trace traces/vllm-llama3-8b.jsonl --rate 2 --label baseline
+#   python -m llm_hosting.bench compare bench_results/baseline.json bench_results/prefix-cache.json
+#
+# The trace is either a request log (see `llm_hosting/traces.py`) or a synthetic one with log-normally distributed
+# prompt and output lengths. Requests are sent either open-loop at a Poisson arrival rate (`--rate`) or closed-loop
+# with a fixed number in flight (`--concurrency`). Every response is streamed, so time to first token (TTFT) and
+# inter-token latency (ITL) are measured on the client side.
+#
+# `--scenario multi-turn` replays conversations instead: every request re-sends a shared system prompt and the
+# whole history so far, as chat UIs and the Dify proxy do, and the turns of a conversation are sent one after the
+# other. The summary then splits TTFT between first turns and later turns, which is where prefix caching shows:
+#
+#   python -m llm_hosting.bench run --url ... --model ... --scenario multi-turn --turns 8 --concurrency 16
+#
+# `--scenario mixed` mixes a share of long-prompt requests (repository dumps, long documents) into short chats and
+# reports TTFT, ITL and end-to-end latency for each kind, to see how much long prefills stall the chats' streams
+# under each chunked-prefill setting.
+#
+# The engine's `/metrics` are read before and after the run. Against a deployment with speculative decoding, the
+# summary includes the share of draft tokens the model accepted during the run; compare it with the plain
+# deployment's ITL to see what speculation buys on a trace.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from llm_hosting.metrics import parse_prometheus
+from llm_hosting.traces import read_jsonl, request_body
+
+RESULTS_DIR = "bench_results"
+REQUEST_TIMEOUT = 600
+PERCENTILES = [50, 90, 95, 99]
+
+# vLLM's speculative decoding counters.
+SPEC_DECODE_COUNTERS = {
+    "draft_tokens": "vllm:spec_decode_num_draft_tokens_total",
+    "accepted_tokens": "vllm:spec_decode_num_accepted_tokens_total",
+    "emitted_tokens": "vllm:spec_decode_num_emitted_tokens_total",
+}
+
+WORDS = "the quick brown fox jumps over the lazy dog while a python script counts tokens".split()
+
+
+@dataclass
+class BenchRequest:
+    body: dict
+    path: str = "/v1/chat/completions"
+    headers: dict = field(default_factory=dict)
+    conversation: Optional[int] = None  # turns of one conversation are sent in order
+    turn: int = 0
+    kind: str = ""  # reported separately when a trace mixes kinds of requests
+
+
+@dataclass
+class RequestResult:
+    ok: bool
+    start: float
+    status: int = 0
+    error: str = ""
+    ttft: Optional[float] = None
+    e2e: Optional[float] = None
+    itl: List[float] = field(default_factory=list)
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    turn: int = 0
+    kind: str = ""
+
+
+def synthetic_text(tokens: int, rng: random.Random) -> str:
+    # About one token per short English word.
+    return " ".join(rng.choice(WORDS) for _ in range(tokens))
+
+
+def synthetic_trace(
+    num_requests: int,
+    model: str,
+    prompt_tokens: int = 512,
+    output_tokens: int = 128,
+    sigma: float = 0.5,
+    seed: int = 0,
+) -> List[BenchRequest]:
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_requests):
+        prompt_len = max(1, int(rng.lognormvariate(math.log(prompt_tokens), sigma)))
+        output_len = max(1, int(rng.lognormvariate(math.log(output_tokens), sigma)))
+        body = {
+            "model": model,
+            "messages": [{"role": "user", "content": synthetic_text(prompt_len, rng)}],
+            "max_tokens": output_len,
+            # Generate exactly output_len tokens so runs are comparable.
+            "ignore_eos": True,
+        }
+        requests.append(BenchRequest(body))
+    return requests
+
+
+# Conversations sharing one system prompt, each request carrying the full history of earlier turns. The assistant
+# turns are synthetic, so the prompts are the same whatever the model answers.
+def multi_turn_trace(
+    num_conversations: int,
+    model: str,
+    turns: int = 8,
+    system_tokens: int = 1024,
+    user_tokens: int = 64,
+    output_tokens: int = 128,
+    seed: int = 0,
+) -> List[BenchRequest]:
+    rng = random.Random(seed)
+    system = {"role": "system", "content": synthetic_text(system_tokens, rng)}
+    requests = []
+    for conversation in range(num_conversations):
+        messages = [system]
+        for turn in range(turns):
+            messages = messages + [{"role": "user", "content": synthetic_text(user_tokens, rng)}]
+            body = {"model": model, "messages": messages, "max_tokens": output_tokens, "ignore_eos": True}
+            requests.append(BenchRequest(body, conversation=conversation, turn=turn))
+            messages = messages + [{"role": "assistant", "content": synthetic_text(output_tokens, rng)}]
+    return requests
+
+
+# Short chats with a `long_share` of long-prompt, short-answer requests mixed in at random.
+def mixed_trace(
+    num_requests: int,
+    model: str,
+    long_share: float = 0.1,
+    long_prompt_tokens: int = 8192,
+    long_output_tokens: int = 64,
+    prompt_tokens: int = 256,
+    output_tokens: int = 256,
+    seed: int = 0,
+) -> List[BenchRequest]:
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_requests):
+        long = rng.random() < long_share
+        content = synthetic_text(long_prompt_tokens if long else prompt_tokens, rng)
+        body = {
+            "model": model,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": long_output_tokens if long else output_tokens,
+            "ignore_eos": True,
+        }
+        requests.append(BenchRequest(body, kind="long" if long else "short"))
+    return requests
+
+
+def load_trace(path: str, model: str, max_requests: Optional[int] = None) -> List[BenchRequest]:
+    requests = []
+    for record in read_jsonl(path):
+        body = dict(request_body(record).get("body", request_body(record)))
+        body["model"] = model
+        requests.append(BenchRequest(body, "/v1/chat/completions" if "messages" in body else "/v1/completions"))
+        if max_requests and len(requests) >= max_requests:
+            break
+    return requests
+
+
+def _chunk_text(chunk: dict) -> str:
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    choice = choices[0]
+    return (choice.get("delta") or {}).get("content") or choice.get("text") or ""
+
+
+async def send_request(client, base_url: str, headers: dict, request: BenchRequest) -> RequestResult:
+    body = {**request.body, "stream": True, "stream_options": {"include_usage": True}}
+    result = RequestResult(ok=False, start=time.monotonic(), turn=request.turn, kind=request.kind)
+    last_token = None
+    try:
+        async with client.stream(
+            "POST", f"{base_url}{request.path}", json=body, headers={**headers, **request.headers}
+        ) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = (await response.aread()).decode()[:200]
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage"):
+                    result.prompt_tokens = chunk["usage"].get("prompt_tokens", 0)
+                    result.output_tokens = chunk["usage"].get("completion_tokens", result.output_tokens)
+                if not _chunk_text(chunk):
+                    continue
+                now = time.monotonic()
+                if last_token is None:
+                    result.ttft = now - result.start
+                else:
+                    result.itl.append(now - last_token)
+                last_token = now
+                if not chunk.get("usage"):
+                    result.output_tokens += 1
+        result.e2e = time.monotonic() - result.start
+        result.ok = True
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+# Requests grouped into the sequences that must run one after the other: a conversation's turns, or a single request.
+def request_sequences(requests: List[BenchRequest]) -> List[List[BenchRequest]]:
+    sequences = []
+    conversations = {}
+    for request in requests:
+        if request.conversation is None:
+            sequences.append([request])
+        elif request.conversation in conversations:
+            conversations[request.conversation].append(request)
+        else:
+            conversations[request.conversation] = [request]
+            sequences.append(conversations[request.conversation])
+    return sequences
+
+
+async def engine_metrics(client, base_url: str, headers: dict) -> dict:
+    try:
+        response = await client.get(f"{base_url}/metrics", headers=headers)
+    except Exception:
+        return {}
+    return parse_prometheus(response.text) if response.status_code == 200 else {}
+
+
+# Draft tokens proposed and accepted between two reads of the engine's metrics, or None without speculation.
+def speculative_summary(before: dict, after: dict) -> Optional[dict]:
+    delta = {key: after.get(name, 0.0) - before.get(name, 0.0) for key, name in SPEC_DECODE_COUNTERS.items()}
+    if not delta["draft_tokens"]:
+        return None
+    return {
+        **{key: int(value) for key, value in delta.items()},
+        "acceptance_rate": round(delta["accepted_tokens"] / delta["draft_tokens"], 4),
+    }
+
+
+async def run_benchmark(
+    base_url: str,
+    requests: List[BenchRequest],
+    api_key: Optional[str] = None,
+    rate: Optional[float] = None,
+    concurrency: Optional[int] = None,
+    seed: int = 0,
+) -> dict:
+    import httpx
+
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    limits = httpx.Limits(max_connections=concurrency or 1000, max_keepalive_connections=concurrency or 1000)
+    results: List[RequestResult] = []
+
+    async def send_sequence(client, sequence: List[BenchRequest]):
+        for request in sequence:
+            results.append(await send_request(client, base_url, headers, request))
+
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        metrics_before = await engine_metrics(client, base_url, headers)
+        start = time.monotonic()
+        if rate:
+            # Open loop: Poisson arrivals (of requests, or of conversations), whatever the server's response times.
+            rng = random.Random(seed)
+            tasks = []
+            for sequence in request_sequences(requests):
+                tasks.append(asyncio.create_task(send_sequence(client, sequence)))
+                await asyncio.sleep(rng.expovariate(rate))
+            await asyncio.gather(*tasks)
+        else:
+            # Closed loop: a fixed number of requests (or conversations) in flight.
+            queue = list(reversed(request_sequences(requests)))
+
+            async def worker():
+                while queue:
+                    await send_sequence(client, queue.pop())
+
+            await asyncio.gather(*(worker() for _ in range(concurrency or 1)))
+        wall_seconds = time.monotonic() - start
+        metrics_after = await engine_metrics(client, base_url, headers)
+
+    summary = summarize(results, wall_seconds)
+    speculative = speculative_summary(metrics_before, metrics_after)
+    if speculative:
+        summary["speculative"] = speculative
+    return {"summary": summary, "results": [asdict(r) for r in results]}
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = {"mean": round(sum(values) / len(values), 4)}
+    for p in PERCENTILES:
+        index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+        summary[f"p{p}"] = round(values[index], 4)
+    return summary
+
+
+def summarize(results: List[RequestResult], wall_seconds: float) -> dict:
+    ok = [r for r in results if r.ok]
+    output_tokens = sum(r.output_tokens for r in ok)
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(ok) / wall_seconds, 3) if wall_seconds else 0.0,
+        "output_tokens_per_second": round(output_tokens / wall_seconds, 2) if wall_seconds else 0.0,
+        "ttft": percentiles([r.ttft for r in ok if r.ttft is not None]),
+        "itl": percentiles([gap for r in ok for gap in r.itl]),
+        "e2e": percentiles([r.e2e for r in ok if r.e2e is not None]),
+    }
+    if any(r.turn for r in results):
+        # First turns only share the system prompt with earlier requests; later turns also share their history.
+        summary["ttft_first_turn"] = percentiles([r.ttft for r in ok if r.ttft is not None and not r.turn])
+        summary["ttft_later_turns"] = percentiles([r.ttft for r in ok if r.ttft is not None and r.turn])
+    kinds = sorted({r.kind for r in results if r.kind})
+    if kinds:
+        summary["by_kind"] = {
+            kind: {
+                "requests": sum(1 for r in results if r.kind == kind),
+                "ttft": percentiles([r.ttft for r in ok if r.kind == kind and r.ttft is not None]),
+                "itl": percentiles([gap for r in ok if r.kind == kind for gap in r.itl]),
+                "e2e": percentiles([r.e2e for r in ok if r.kind == kind and r.e2e is not None]),
+            }
+            for kind in kinds
+        }
+    return summary
+
+
+def save_results(run: dict, label: str, results_dir: str = RESULTS_DIR) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{label}.json")
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    return path
+
+
+def compare(paths: List[str]):
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            run = json.load(f)
+        s = run["summary"]
+        rows.append([
+            run.get("label", os.path.basename(path)),
+            s["requests"],
+            f"{s['error_rate']:.2%}",
+            s["ttft"].get("p50", "-"),
+            s["ttft"].get("p99", "-"),
+            s.get("ttft_later_turns", {}).get("p50", "-"),
+            s["itl"].get("p50", "-"),
+            s["itl"].get("p99", "-"),
+            s.get("by_kind", {}).get("short", {}).get("itl", {}).get("p99", "-"),
+            s["e2e"].get("p50", "-"),
+            s["e2e"].get("p99", "-"),
+            s["output_tokens_per_second"],
+            s.get("speculative", {}).get("acceptance_rate", "-"),
+        ])
+    header = [
+        "label", "requests", "errors", "ttft_p50", "ttft_p99", "ttft_later_p50", "itl_p50", "itl_p99", "short_itl_p99",
+        "e2e_p50", "e2e_p99", "out_tok/s", "accepted",
+    ]
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+def build_requests(args) -> List[BenchRequest]:
+    if args.trace:
+        return load_trace(args.trace, args.model, args.num_requests)
+    if args.scenario == "mixed":
+        return mixed_trace(
+            args.num_requests or 100, args.model, args.long_share, args.long_prompt_tokens, args.long_output_tokens,
+            args.prompt_tokens, args.output_tokens, args.seed,
+        )
+    if args.scenario == "multi-turn":
+        conversations = max(1, (args.num_requests or 100) // args.turns)
+        return multi_turn_trace(
+            conversations, args.model, args.turns, args.system_tokens, args.user_tokens, args.output_tokens, args.seed
+        )
+    return synthetic_trace(args.num_requests or 100, args.model, args.prompt_tokens, args.output_tokens, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark an OpenAI-compatible endpoint.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Replay a trace against an endpoint")
+    run.add_argument("--url", required=True, help="Base URL, without /v1")
+    run.add_argument("--model", required=True)
+    run.add_argument("--api-key", default=os.environ.get("VLLM_API_KEY"))
+    run.add_argument("--trace", help="Request log JSONL; synthetic requests when omitted")
+    run.add_argument("--num-requests", type=int)
+    run.add_argument("--prompt-tokens", type=int, default=512, help="Median prompt length of synthetic requests")
+    run.add_argument("--output-tokens", type=int, default=128, help="Median output length of synthetic requests")
+    run.add_argument(
+        "--scenario", choices=["single", "multi-turn", "mixed"], default="single", help="Shape of synthetic requests"
+    )
+    run.add_argument("--turns", type=int, default=8, help="Turns per multi-turn conversation")
+    run.add_argument("--system-tokens", type=int, default=1024, help="Shared system prompt of multi-turn conversations")
+    run.add_argument("--user-tokens", type=int, default=64, help="User message length of multi-turn conversations")
+    run.add_argument("--long-share", type=float, default=0.1, help="Share of long-prompt requests (mixed scenario)")
+    run.add_argument("--long-prompt-tokens", type=int, default=8192, help="Prompt length of long requests")
+    run.add_argument("--long-output-tokens", type=int, default=64, help="Output length of long requests")
+    load = run.add_mutually_exclusive_group()
+    load.add_argument("--rate", type=float, help="Poisson arrival rate in requests/s")
+    load.add_argument("--concurrency", type=int, help="Requests kept in flight")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--label", default=time.strftime("run-%Y%m%d-%H%M%S"))
+    run.add_argument("--results-dir", default=RESULTS_DIR)
+
+    cmp = commands.add_parser("compare", help="Compare saved runs")
+    cmp.add_argument("paths", nargs="+")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args.paths)
+        return
+
+    requests = build_requests(args)
+    result = asyncio.run(
+        run_benchmark(args.url.rstrip("/"), requests, args.api_key, args.rate, args.concurrency or (None if args.rate else 1), args.seed)
+    )
+    result.update({"label": args.label, "url": args.url, "model": args.model, "rate": args.rate, "concurrency": args.concurrency})
+    path = save_results(result, args.label, args.results_dir)
+    print(json.dumps(result["summary"], indent=2))
+    print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# # Capacity planner
+#
+# Works out, from a model's `config.json` and the size of its safetensors shards, how much GPU memory the
+# weights take per tensor-parallel rank and how many tokens of KV cache are left over for a given GPU request.
+# Everything here is plain arithmetic on dictionaries, so it runs locally without a GPU.
+#
+# It is used in three places:
+# - at deploy time, `check_profile` refuses a profile whose GPUs cannot hold the model (pinned configs);
+# - at image build time, `check_snapshot_capacity` repeats the check against the downloaded snapshot;
+# - from the command line, `python -m llm_hosting.capacity [profile ...]` prints the plan for each profile.
+
+import argparse
+import glob
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+
+from llm_hosting.model_configs import MODEL_CONFIGS
+from llm_hosting.profiles import PROFILES, ModelProfile
+from llm_hosting.snapshot import MODEL_DIR
+from llm_hosting.traces import RequestStats, load_request_stats
+
+GIB = 1024**3
+CAPACITY_FILE = ".capacity.json"
+
+# Memory per GPU (GiB) for each GPU type Modal offers.
+GPU_MEMORY = {
+    "T4": [16],
+    "L4": [24],
+    "A10G": [24],
+    "A100": [40, 80],
+    "H100": [80],
+}
+GPU_COUNTS = [1, 2, 4, 8]
+
+DTYPE_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2}
+
+# Quantization methods applied by vLLM at load time to an unquantized checkpoint.
+RUNTIME_QUANTIZATION_BITS = {"fp8": 8, "deepspeedfp": 8}
+
+# Memory vLLM keeps out of the KV cache on every GPU: activations during the profiling run, CUDA graphs and
+# the sampler's logits buffer.
+ACTIVATION_RESERVE_GIB = 2.0
+BLOCK_SIZE = 16
+
+# Share of the KV cache handed out to concurrent sequences; the rest absorbs requests that run longer than
+# average so vLLM does not have to preempt.
+KV_CACHE_HEADROOM = 0.9
+MAX_NUM_SEQS_LIMIT = 256  # vLLM's default --max-num-seqs
+
+
+class CapacityError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ModelShape:
+    num_layers: int
+    num_attention_heads: int
+    num_kv_heads: int
+    head_dim: int
+    max_position_embeddings: int
+    dtype_bytes: int
+    weight_bytes: int  # as loaded on the GPU, after quantization
+
+    def kv_bytes_per_token(self, tensor_parallel_size: int = 1) -> int:
+        # K and V for every layer. KV heads are split across ranks, or replicated when there are fewer
+        # heads than ranks.
+        kv_heads_per_rank = max(1, self.num_kv_heads // tensor_parallel_size)
+        return 2 * self.num_layers * kv_heads_per_rank * self.head_dim * self.dtype_bytes
+
+
+@dataclass(frozen=True)
+class CapacityPlan:
+    gpu_type: str
+    gpu_memory: int
+    gpu_count: int
+    tensor_parallel_size: int
+    max_model_len: int
+    weight_gib_per_gpu: float
+    kv_cache_gib_per_gpu: float
+    kv_cache_tokens: int
+    kv_cache_blocks: int
+    max_concurrent_sequences: int  # sequences of max_model_len that fit in the KV cache at once
+    fits: bool
+    reason: str = ""
+
+
+def model_shape(config: dict, weight_bytes: int, quantization: Optional[str] = None) -> ModelShape:
+    num_attention_heads = config["num_attention_heads"]
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_attention_heads
+    dtype_bytes = DTYPE_BYTES.get(config.get("torch_dtype", "float16"), 2)
+
+    checkpoint_quantized = "quantization_config" in config
+    if quantization in RUNTIME_QUANTIZATION_BITS and not checkpoint_quantized:
+        params = weight_bytes / dtype_bytes
+        weight_bytes = int(params * RUNTIME_QUANTIZATION_BITS[quantization] / 8)
+
+    return ModelShape(
+        num_layers=config["num_hidden_layers"],
+        num_attention_heads=num_attention_heads,
+        num_kv_heads=config.get("num_key_value_heads", num_attention_heads),
+        head_dim=head_dim,
+        max_position_embeddings=config.get("max_position_embeddings", 2048),
+        dtype_bytes=dtype_bytes,
+        weight_bytes=weight_bytes,
+    )
+
+
+def plan_capacity(
+    shape: ModelShape,
+    gpu_type: str,
+    gpu_memory: int,
+    gpu_count: int,
+    max_model_len: Optional[int] = None,
+    gpu_memory_utilization: float = 0.90,
+    draft: Optional[ModelShape] = None,
+) -> CapacityPlan:
+    max_model_len = max_model_len or shape.max_position_embeddings
+    tp = gpu_count
+
+    reason = ""
+    if shape.num_attention_heads % tp:
+        reason = f"{shape.num_attention_heads} attention heads cannot be split across {tp} GPUs"
+    elif shape.num_kv_heads % tp and tp % shape.num_kv_heads:
+        reason = f"{shape.num_kv_heads} KV heads cannot be split across {tp} GPUs"
+
+    weight_gib = shape.weight_bytes / tp / GIB
+    kv_bytes_per_token = shape.kv_bytes_per_token(tp)
+    if draft:
+        # A speculative decoding draft model runs on a single GPU, and vLLM gives it a KV cache with as many
+        # blocks as the target's.
+        weight_gib += draft.weight_bytes / GIB
+        kv_bytes_per_token += draft.kv_bytes_per_token()
+    kv_gib = gpu_memory * gpu_memory_utilization - weight_gib - ACTIVATION_RESERVE_GIB
+    kv_tokens = max(0, int(kv_gib * GIB / kv_bytes_per_token))
+    kv_blocks = kv_tokens // BLOCK_SIZE
+
+    if not reason and kv_gib <= 0:
+        reason = f"weights need {weight_gib:.1f} GiB per GPU, more than {gpu_memory}GB x {gpu_memory_utilization} allows"
+    elif not reason and kv_tokens < max_model_len:
+        reason = f"KV cache holds {kv_tokens} tokens, less than one sequence of max_model_len={max_model_len}"
+
+    return CapacityPlan(
+        gpu_type=gpu_type,
+        gpu_memory=gpu_memory,
+        gpu_count=gpu_count,
+        tensor_parallel_size=tp,
+        max_model_len=max_model_len,
+        weight_gib_per_gpu=round(weight_gib, 2),
+        kv_cache_gib_per_gpu=round(max(kv_gib, 0.0), 2),
+        kv_cache_tokens=kv_tokens,
+        kv_cache_blocks=kv_blocks,
+        max_concurrent_sequences=kv_tokens // max_model_len,
+        fits=not reason,
+        reason=reason,
+    )
+
+
+# The smallest GPU request (fewest GPUs, then least memory) that fits the model. `GPU_MEMORY` is ordered by
+# memory per GPU, so within a count the first fitting type is the cheapest.
+def minimum_gpu_config(
+    shape: ModelShape,
+    max_model_len: Optional[int] = None,
+    gpu_memory_utilization: float = 0.90,
+    min_concurrent_sequences: int = 1,
+    draft: Optional[ModelShape] = None,
+) -> Optional[CapacityPlan]:
+    candidates = sorted(
+        ((count, memory, gpu_type) for gpu_type, memories in GPU_MEMORY.items() for memory in memories for count in GPU_COUNTS),
+        key=lambda c: (c[0], c[1]),
+    )
+    for count, memory, gpu_type in candidates:
+        plan = plan_capacity(shape, gpu_type, memory, count, max_model_len, gpu_memory_utilization, draft)
+        if plan.fits and plan.max_concurrent_sequences >= min_concurrent_sequences:
+            return plan
+    return None
+
+
+# How many sequences of the average observed length the KV cache can hold at once. This is used both as
+# vLLM's --max-num-seqs and as Modal's allow_concurrent_inputs, so Modal starts another container instead of
+# queueing requests the engine cannot batch.
+def concurrency_for(plan: CapacityPlan, stats: RequestStats) -> int:
+    blocks_per_sequence = math.ceil(stats.avg_sequence_tokens / BLOCK_SIZE)
+    sequences = int(plan.kv_cache_blocks * KV_CACHE_HEADROOM) // blocks_per_sequence
+    return max(1, min(sequences, MAX_NUM_SEQS_LIMIT))
+
+
+def pinned_model_config(base_model: str) -> Tuple[dict, int]:
+    if base_model not in MODEL_CONFIGS:
+        raise CapacityError(f"No pinned config for {base_model}; add it to llm_hosting/model_configs.py")
+    entry = MODEL_CONFIGS[base_model]
+    return entry["config"], entry["safetensors_total_size"]
+
+
+def read_snapshot_config(model_dir: str = MODEL_DIR) -> Tuple[dict, int]:
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    shards = glob.glob(os.path.join(model_dir, "*.safetensors"))
+    if shards:
+        weight_bytes = sum(os.path.getsize(path) for path in shards)
+    else:
+        with open(os.path.join(model_dir, "model.safetensors.index.json")) as f:
+            weight_bytes = json.load(f)["metadata"]["total_size"]
+    return config, weight_bytes
+
+
+# The draft model is always planned from its pinned config; it is small next to the model it serves.
+def draft_shape(profile: ModelProfile) -> Optional[ModelShape]:
+    if not profile.draft_model:
+        return None
+    return model_shape(*pinned_model_config(profile.draft_model))
+
+
+def plan_profile(profile: ModelProfile, config: Optional[dict] = None, weight_bytes: Optional[int] = None) -> CapacityPlan:
+    if config is None:
+        config, weight_bytes = pinned_model_config(profile.base_model)
+    shape = model_shape(config, weight_bytes, profile.quantization)
+    return plan_capacity(
+        shape,
+        profile.gpu_type,
+        profile.gpu_memory,
+        profile.gpu_count,
+        profile.max_model_len,
+        profile.gpu_memory_utilization,
+        draft_shape(profile),
+    )
+
+
+def check_profile(profile: ModelProfile, config: Optional[dict] = None, weight_bytes: Optional[int] = None) -> CapacityPlan:
+    plan = plan_profile(profile, config, weight_bytes)
+    if not plan.fits:
+        if config is None:
+            config, weight_bytes = pinned_model_config(profile.base_model)
+        suggestion = minimum_gpu_config(
+            model_shape(config, weight_bytes, profile.quantization),
+            profile.max_model_len,
+            profile.gpu_memory_utilization,
+            draft=draft_shape(profile),
+        )
+        hint = (
+            f"; smallest config that fits is {suggestion.gpu_count}x {suggestion.gpu_type} {suggestion.gpu_memory}GB"
+            if suggestion
+            else "; no single-node GPU configuration fits"
+        )
+        raise CapacityError(
+            f"Profile {profile.name} cannot be served on {profile.gpu_count}x {profile.gpu_type} "
+            f"{profile.gpu_memory}GB: {plan.reason}{hint}"
+        )
+    return plan
+
+
+# Image build step: runs after the download, against the real snapshot, and fails the build when the
+# profile does not fit. The plan is kept next to the weights for the launcher.
+def check_snapshot_capacity(profile: ModelProfile, model_dir: str = MODEL_DIR) -> dict:
+    config, weight_bytes = read_snapshot_config(model_dir)
+    plan = asdict(check_profile(profile, config, weight_bytes))
+    with open(os.path.join(model_dir, CAPACITY_FILE), "w") as f:
+        json.dump(plan, f, indent=2)
+    print(json.dumps({"event": "capacity_plan", "profile": profile.name, **plan}))
+    return plan
+
+
+def profile_concurrency(profile: ModelProfile, stats: Optional[RequestStats] = None) -> int:
+    if stats is None:
+        stats = load_request_stats(profile.name)
+    return concurrency_for(plan_profile(profile), stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan GPU capacity for deployment profiles.")
+    parser.add_argument("profiles", nargs="*", help="Profile names (default: every vLLM profile)")
+    parser.add_argument("--snapshot", help="Read config.json and shards from this directory instead of the pinned configs")
+    args = parser.parse_args()
+
+    names = args.profiles or [name for name, p in PROFILES.items() if p.engine == "vllm"]
+    for name in names:
+        profile = PROFILES[name]
+        config = weight_bytes = None
+        if args.snapshot:
+            config, weight_bytes = read_snapshot_config(args.snapshot)
+        plan = plan_profile(profile, config, weight_bytes)
+        stats = load_request_stats(name)
+        print(json.dumps({"profile": name, **asdict(plan), **asdict(stats), "max_num_seqs": concurrency_for(plan, stats)}))
+
+
+if __name__ == "__main__":
+    main()
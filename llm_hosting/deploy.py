@@ -0,0 +1,274 @@
+# # Modal images and function settings
+#
+# One image recipe per engine, with a single set of pinned versions. The weights for the profile's model are
+# fixed at build time, so the container never goes to the Huggingface hub at start-up: by default the image holds
+# links into the shared, content-addressed weight store volume (`store_model_snapshot`), so deployments of the
+# same model share one copy and a rebuild only fetches what changed; with `weight_store=False` they are baked
+# into the image itself with `download_model_to_folder`.
+
+import json
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from modal import Image, Secret, Volume, gpu
+
+from llm_hosting.batch import run_batch
+from llm_hosting.capacity import check_profile, check_snapshot_capacity, profile_concurrency
+from llm_hosting.keep_warm import idle_timeout
+from llm_hosting.launcher import check_vllm_flags
+from llm_hosting.preshard import preshard_model
+from llm_hosting.profiles import ModelProfile, override_env, with_overrides
+from llm_hosting.sharding import merge_results, split_shards, throughput_report
+from llm_hosting.snapshot import DRAFT_MODEL_DIR, MODEL_DIR, download_model_to_folder, lora_path
+from llm_hosting.traces import read_jsonl
+from llm_hosting.warmup import sample_warmup_batch_sizes, sample_warmup_requests, write_warmup_requests
+from llm_hosting.weight_store import VOLUME_NAME, WEIGHTS_DIR, store_model_snapshot
+
+CUDA_IMAGE = "nvidia/cuda:12.1.1-devel-ubuntu22.04"
+
+# Inputs and outputs of offline batch jobs, shared by every deployment.
+BATCH_DIR = "/batch"
+BATCH_TIMEOUT = 24 * 60 * 60
+batch_volume = Volume.from_name("llm-batch", create_if_missing=True)
+LOAD_BENCH_TIMEOUT = 2 * 60 * 60
+weights_volume = Volume.from_name(VOLUME_NAME, create_if_missing=True)
+
+VLLM_PACKAGES = [
+    "vllm==0.6.1.post2",
+    "wheel==0.44.0",
+    "packaging==24.1",
+    "huggingface_hub==0.25.0",
+    "hf-transfer==0.1.8",
+    "torch==2.4.0",
+]
+VLLM_FLASH_ATTN = "flash-attn==2.6.3"
+
+# outlines[serve] 0.0.34 is tied to the vLLM 0.4 engine API, so it keeps its own pins.
+OUTLINES_PACKAGES = [
+    "vllm==0.4.3",
+    "wheel==0.43.0",
+    "packaging==24.0",
+    "huggingface_hub==0.23.3",
+    "hf-transfer==0.1.6",
+    "torch==2.3.0",
+    "autoawq==0.2.5",
+    "outlines[serve]==0.0.34",
+]
+OUTLINES_FLASH_ATTN = "flash-attn==2.5.8"
+
+INFINITY_PACKAGES = [
+    "wheel==0.44.0",
+    "huggingface_hub==0.25.0",
+    "hf-transfer==0.1.8",
+    "torch==2.4.1",
+    "transformers==4.44.2",
+    "sentence-transformers==3.1.0",
+    "infinity_emb[all]==0.0.56",
+]
+
+GPU_TYPES = {
+    "A100": lambda profile: gpu.A100(size=f"{profile.gpu_memory}GB", count=profile.gpu_count),
+    "H100": lambda profile: gpu.H100(count=profile.gpu_count),
+    "A10G": lambda profile: gpu.A10G(count=profile.gpu_count),
+    "L4": lambda profile: gpu.L4(count=profile.gpu_count),
+    "T4": lambda profile: gpu.T4(count=profile.gpu_count),
+}
+
+
+def gpu_config(profile: ModelProfile):
+    if profile.gpu_type not in GPU_TYPES:
+        raise ValueError(f"Unsupported GPU type {profile.gpu_type!r} for profile {profile.name}")
+    return GPU_TYPES[profile.gpu_type](profile)
+
+
+def _base_image(packages, flash_attn=None) -> Image:
+    image = (
+        Image.from_registry(CUDA_IMAGE, add_python="3.10")
+        .pip_install(*packages)
+        .apt_install("git")
+    )
+    if flash_attn:
+        image = image.run_commands(f"pip install {flash_attn} --no-build-isolation")
+    return image
+
+
+# vLLM-based profiles are checked against the capacity planner before anything is built, and again against the
+# downloaded snapshot during the build; a profile whose GPUs cannot hold the model never gets deployed.
+def build_image(profile: ModelProfile) -> Image:
+    profile = with_overrides(profile)
+    if profile.engine in ("vllm", "outlines"):
+        check_profile(profile)
+    if profile.engine == "vllm":
+        check_vllm_flags(profile)
+
+    if profile.engine == "vllm":
+        image = _base_image(VLLM_PACKAGES, VLLM_FLASH_ATTN)
+    elif profile.engine == "outlines":
+        image = _base_image(OUTLINES_PACKAGES, OUTLINES_FLASH_ATTN)
+    elif profile.engine == "infinity":
+        image = _base_image(INFINITY_PACKAGES)
+    else:
+        raise ValueError(f"Unknown engine {profile.engine!r} for profile {profile.name}")
+
+    image = add_weights(
+        image,
+        profile,
+        {
+            "base_model": profile.base_model,
+            "model_dir": MODEL_DIR,
+            "quant_config": profile.quant_config,
+            "revision": profile.revision,
+        },
+    )
+    if profile.draft_model:
+        image = add_weights(image, profile, {"base_model": profile.draft_model, "model_dir": DRAFT_MODEL_DIR})
+    for name, repo in sorted((profile.lora_adapters or {}).items()):
+        # Adapters are often only published as `adapter_model.bin`.
+        image = add_weights(
+            image, profile, {"base_model": repo, "model_dir": lora_path(name), "ignore_patterns": ["*.pt"]}
+        )
+    if profile.engine in ("vllm", "outlines"):
+        image = image.run_function(
+            check_snapshot_capacity,
+            volumes=weight_volumes(profile),
+            kwargs={"profile": profile, "model_dir": MODEL_DIR},
+        )
+    if profile.preshard:
+        image = image.run_function(
+            preshard_model,
+            gpu=gpu_config(profile),
+            secrets=[Secret.from_name("huggingface")],
+            volumes=weight_volumes(profile),
+            timeout=profile.download_timeout,
+            kwargs={"profile": profile},
+        )
+
+    warmup_requests = sample_warmup_requests(profile)
+    warmup_batch_sizes = sample_warmup_batch_sizes(profile, serving_concurrency(profile)[0])
+    if warmup_requests or warmup_batch_sizes:
+        image = image.run_function(
+            write_warmup_requests, kwargs={"requests": warmup_requests, "batch_sizes": warmup_batch_sizes}
+        )
+    return image
+
+
+def weight_volumes(profile: ModelProfile) -> dict:
+    return {WEIGHTS_DIR: weights_volume} if profile.weight_store else {}
+
+
+# One model snapshot for the image, from the weight store or baked in.
+def add_weights(image: Image, profile: ModelProfile, kwargs: dict) -> Image:
+    return image.run_function(
+        store_model_snapshot if profile.weight_store else download_model_to_folder,
+        secrets=[Secret.from_name("huggingface")],
+        volumes=weight_volumes(profile),
+        timeout=profile.download_timeout,
+        kwargs=kwargs,
+    )
+
+
+# vLLM's --max-num-seqs and Modal's input concurrency, unless the profile pins them. Both default to the number
+# of average-length sequences (from `traces/<profile>.jsonl`) the planned KV cache holds at once.
+def serving_concurrency(profile: ModelProfile) -> Tuple[Optional[int], int]:
+    max_num_seqs = profile.max_num_seqs
+    if max_num_seqs is None and profile.engine == "vllm":
+        max_num_seqs = profile_concurrency(profile)
+    concurrent_inputs = profile.concurrent_inputs or max_num_seqs or 100
+    return max_num_seqs, concurrent_inputs
+
+
+# Keyword arguments for `app.function` on the web server of a profile. The idle timeout is learned from the
+# request log when there is one (the hourly warm pool is set separately by `keep_warm.py`); the container is told
+# it too, for the replica registry.
+def server_options(profile: ModelProfile) -> dict:
+    profile = with_overrides(profile)
+    max_num_seqs, concurrent_inputs = serving_concurrency(profile)
+    container_idle_timeout = idle_timeout(profile)
+    secrets = [
+        Secret.from_name("huggingface"),
+        Secret.from_dotenv(),
+    ]
+    engine_env = {**override_env(), "CONTAINER_IDLE_TIMEOUT": str(container_idle_timeout)}
+    if max_num_seqs:
+        engine_env["MAX_NUM_SEQS"] = str(max_num_seqs)
+    secrets.append(Secret.from_dict(engine_env))
+    return dict(
+        allow_concurrent_inputs=concurrent_inputs,
+        container_idle_timeout=container_idle_timeout,
+        gpu=gpu_config(profile),
+        volumes=weight_volumes(profile),
+        secrets=secrets,
+    )
+
+
+# Keyword arguments for `app.function` on the offline batch function of a profile.
+def batch_options(profile: ModelProfile) -> dict:
+    secrets = [Secret.from_name("huggingface")]
+    if override_env():
+        secrets.append(Secret.from_dict(override_env()))
+    return dict(
+        gpu=gpu_config(profile),
+        timeout=BATCH_TIMEOUT,
+        volumes={BATCH_DIR: batch_volume, **weight_volumes(profile)},
+        secrets=secrets,
+    )
+
+
+# Keyword arguments for `app.function` on the weight loading benchmark of a pre-sharded profile.
+def load_bench_options(profile: ModelProfile) -> dict:
+    return dict(
+        gpu=gpu_config(profile),
+        timeout=LOAD_BENCH_TIMEOUT,
+        volumes=weight_volumes(profile),
+        secrets=[Secret.from_name("huggingface")],
+    )
+
+
+# Runs in the batch container. Paths are relative to the batch volume; the volume is committed after every
+# chunk so finished results survive an interrupted job.
+def batch_job(profile: ModelProfile, input_name: str, output_name: str) -> dict:
+    batch_volume.reload()
+    return run_batch(
+        with_overrides(profile),
+        os.path.join(BATCH_DIR, input_name),
+        os.path.join(BATCH_DIR, output_name),
+        checkpoint=batch_volume.commit,
+    )
+
+
+# Runs locally: splits the input into `shards` length-balanced shards, uploads them, runs one batch container
+# per shard in parallel and merges the results back into input order. Each shard keeps its own results on the
+# volume, so re-running the same command only redoes the requests that had not finished.
+def run_batch_job(batch_function, profile: ModelProfile, input_path: str, output_path: str, shards: int = 1) -> dict:
+    job = os.path.splitext(os.path.basename(input_path))[0]
+    job_dir = f"{profile.name}/{job}/shards-{shards}"
+
+    shard_records, order = split_shards(read_jsonl(input_path), shards)
+    names = [(f"{job_dir}/input-{i:04d}.jsonl", f"{job_dir}/output-{i:04d}.jsonl") for i in range(len(shard_records))]
+
+    with tempfile.TemporaryDirectory() as tmp, batch_volume.batch_upload(force=True) as upload:
+        for (input_name, _), records in zip(names, shard_records):
+            local = os.path.join(tmp, os.path.basename(input_name))
+            with open(local, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            upload.put_file(local, input_name)
+
+    start = time.monotonic()
+    shard_reports = list(batch_function.starmap(names))
+    wall_seconds = time.monotonic() - start
+
+    def shard_lines(output_name):
+        data = b"".join(batch_volume.read_file(output_name))
+        return data.decode().splitlines()
+
+    with open(output_path, "w") as out:
+        written = merge_results((shard_lines(output_name) for _, output_name in names), order, out)
+
+    report = throughput_report(
+        shard_reports, wall_seconds, profile.gpu_type, profile.gpu_memory, profile.gpu_count, requests_total=len(order)
+    )
+    print(json.dumps({"event": "batch_done", "deployment": profile.name, "output": output_path, "written": written, **report}))
+    return report
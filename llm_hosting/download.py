@@ -0,0 +1,236 @@
+# # Weight downloads
+#
+# Fetches a model repository from the Huggingface hub for the image build, in place of `snapshot_download`:
+#
+# - only the files serving needs: configs, tokenizer files and the weights, as safetensors (`*.bin` only for repos
+#   without safetensors, unless ignored), at the top level of the repo, plus the module directories of
+#   sentence-transformers models. Extra checkpoints (`original/*.pth`), ONNX exports and READMEs are skipped;
+# - several files at once, each streamed to `<file>.incomplete` and resumed with a byte range after a dropped
+#   connection, including one left behind by an earlier, interrupted run into the same directory;
+# - each LFS file checked against the SHA256 the hub lists for it, and every shard named in
+#   `model.safetensors.index.json` checked to be present, so a corrupt or partial snapshot fails the build;
+# - one `download_file` JSON line per file with its size and throughput, and a `download_done` summary.
+#
+# The hub is reached at `HF_ENDPOINT` (as with `huggingface_hub`), so `llm_hosting/mock_hub.py` can stand in for it.
+
+import fnmatch
+import hashlib
+import http.client
+import json
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_ENDPOINT = "https://huggingface.co"
+DOWNLOAD_WORKERS = 8
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 1.0
+CHUNK_SIZE = 8 * 1024 * 1024
+REQUEST_TIMEOUT = 60
+INCOMPLETE_SUFFIX = ".incomplete"
+SAFETENSORS_INDEX = "model.safetensors.index.json"
+
+WEIGHT_PATTERNS = ["*.safetensors"]
+FALLBACK_WEIGHT_PATTERNS = ["*.bin"]
+SUPPORT_PATTERNS = ["*.json", "*.model", "*.tiktoken", "*.txt", "*.py"]
+# sentence-transformers keep their pooling and normalization settings in numbered module directories.
+MODULE_DIR_PATTERNS = ["[0-9]_*/*.json"]
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RepoFile:
+    path: str
+    size: int
+    sha256: Optional[str] = None  # LFS files only
+
+
+@dataclass
+class FileReport:
+    path: str
+    bytes: int
+    resumed_bytes: int
+    seconds: float
+    attempts: int
+
+    @property
+    def mb_per_second(self) -> float:
+        return (self.bytes - self.resumed_bytes) / 1e6 / self.seconds if self.seconds else 0.0
+
+
+def hub_endpoint() -> str:
+    return os.environ.get("HF_ENDPOINT", DEFAULT_ENDPOINT).rstrip("/")
+
+
+def _token() -> Optional[str]:
+    return os.environ.get("HF_TOKEN") or os.environ.get("HUGGING_FACE_HUB_TOKEN")
+
+
+# File downloads redirect to a CDN with signed URLs, which must not also get the hub token.
+class _RedirectWithoutAuth(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None and urllib.parse.urlsplit(newurl).netloc != urllib.parse.urlsplit(req.full_url).netloc:
+            new.remove_header("Authorization")
+        return new
+
+
+_opener = urllib.request.build_opener(_RedirectWithoutAuth)
+
+
+def _open(url: str, headers: Optional[Dict[str, str]] = None):
+    headers = dict(headers or {})
+    token = _token()
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return _opener.open(urllib.request.Request(url, headers=headers), timeout=REQUEST_TIMEOUT)
+
+
+# The commit a revision points to and the repo's files at that commit.
+def list_repo_files(repo: str, revision: str = "main") -> Tuple[str, List[RepoFile]]:
+    url = f"{hub_endpoint()}/api/models/{repo}/revision/{urllib.parse.quote(revision, safe='')}?blobs=true"
+    with _open(url) as response:
+        info = json.load(response)
+    files = []
+    for sibling in info.get("siblings", []):
+        lfs = sibling.get("lfs") or {}
+        files.append(RepoFile(sibling["rfilename"], lfs.get("size", sibling.get("size") or 0), lfs.get("sha256")))
+    return info["sha"], files
+
+
+def _matches(path: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def select_files(files: List[RepoFile], ignore_patterns: Optional[List[str]] = None) -> List[RepoFile]:
+    ignore = ignore_patterns or []
+    top = [f for f in files if "/" not in f.path and not _matches(f.path, ignore)]
+    weights = [f for f in top if _matches(f.path, WEIGHT_PATTERNS)]
+    if not weights:
+        weights = [f for f in top if _matches(f.path, FALLBACK_WEIGHT_PATTERNS)]
+    support = [f for f in top if _matches(f.path, SUPPORT_PATTERNS)]
+    modules = [f for f in files if _matches(f.path, MODULE_DIR_PATTERNS) and not _matches(f.path, ignore)]
+    return sorted({f.path: f for f in weights + support + modules}.values(), key=lambda f: f.path)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sha256_matches(path: str, sha256: Optional[str]) -> bool:
+    return not sha256 or file_sha256(path) == sha256
+
+
+# Streams one file of the repo into `<target>.incomplete`, resuming from what is already there, and moves it to
+# `target` once its size and hash check out.
+def download_file(repo: str, commit: str, entry: RepoFile, target: str) -> FileReport:
+    if os.path.exists(target) and os.path.getsize(target) == entry.size and _sha256_matches(target, entry.sha256):
+        return FileReport(entry.path, entry.size, entry.size, 0.0, 0)  # finished by an earlier run
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = target + INCOMPLETE_SUFFIX
+    url = f"{hub_endpoint()}/{repo}/resolve/{commit}/{urllib.parse.quote(entry.path)}"
+
+    start = time.monotonic()
+    resumed = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if resumed > entry.size:
+        os.remove(partial)
+        resumed = 0
+    attempts = 0
+    while True:
+        attempts += 1
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        try:
+            if offset < entry.size or not entry.size:
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                with _open(url, headers) as response:
+                    if offset and response.status != 206:
+                        offset = resumed = 0  # the server ignored the range: start over, nothing was resumed
+                    with open(partial, "ab" if offset else "wb") as f:
+                        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                            f.write(chunk)
+                if os.path.getsize(partial) < entry.size:
+                    raise ConnectionError("connection closed before the end of the file")
+            break
+        except (OSError, http.client.HTTPException) as e:  # dropped connections and HTTP errors alike
+            if isinstance(e, urllib.error.HTTPError) and e.code == 416:
+                break  # nothing left to fetch
+            if isinstance(e, urllib.error.HTTPError) and e.code < 500 and e.code != 429:
+                raise DownloadError(f"{repo}/{entry.path}: HTTP {e.code}") from e
+            if attempts >= MAX_ATTEMPTS:
+                raise DownloadError(f"{repo}/{entry.path}: {type(e).__name__}: {e}") from e
+            time.sleep(RETRY_BACKOFF * attempts)
+
+    size = os.path.getsize(partial)
+    if entry.size and size != entry.size:
+        raise DownloadError(f"{repo}/{entry.path}: got {size} bytes, expected {entry.size}")
+    if not _sha256_matches(partial, entry.sha256):
+        os.remove(partial)  # a resumed file with a bad prefix would never recover
+        raise DownloadError(f"{repo}/{entry.path}: SHA256 mismatch")
+    os.replace(partial, target)
+    report = FileReport(entry.path, size, resumed, round(time.monotonic() - start, 3), attempts)
+    print(json.dumps({"event": "download_file", "repo": repo, **asdict(report),
+                      "mb_per_second": round(report.mb_per_second, 1)}), flush=True)
+    return report
+
+
+# Every shard the safetensors index maps a tensor to has to be part of the snapshot.
+def check_safetensors_index(model_dir: str):
+    path = os.path.join(model_dir, SAFETENSORS_INDEX)
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        shards = set(json.load(f).get("weight_map", {}).values())
+    missing = sorted(s for s in shards if not os.path.exists(os.path.join(model_dir, s)))
+    if missing:
+        raise DownloadError(f"{model_dir}: shards in {SAFETENSORS_INDEX} not downloaded: {missing[:5]}")
+
+
+# Downloads `repo` at `revision` into `model_dir` and returns a summary, including the resolved commit and the
+# SHA256 of every LFS file (so the manifest does not have to hash them again).
+def download_repo(
+    repo: str,
+    model_dir: str,
+    revision: str = "main",
+    ignore_patterns: Optional[List[str]] = None,
+    workers: int = DOWNLOAD_WORKERS,
+) -> dict:
+    start = time.monotonic()
+    commit, files = list_repo_files(repo, revision)
+    selected = select_files(files, ignore_patterns)
+    if not selected:
+        raise DownloadError(f"{repo}@{revision}: no files to download")
+    os.makedirs(model_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        reports = list(pool.map(
+            lambda entry: download_file(repo, commit, entry, os.path.join(model_dir, entry.path)), selected
+        ))
+    check_safetensors_index(model_dir)
+
+    seconds = time.monotonic() - start
+    fetched = sum(r.bytes - r.resumed_bytes for r in reports)
+    summary = {
+        "repo": repo,
+        "revision": revision,
+        "commit": commit,
+        "files": len(reports),
+        "skipped_files": len(files) - len(selected),
+        "bytes": sum(r.bytes for r in reports),
+        "fetched_bytes": fetched,
+        "seconds": round(seconds, 3),
+        "mb_per_second": round(fetched / 1e6 / seconds, 1) if seconds else 0.0,
+    }
+    print(json.dumps({"event": "download_done", **summary}), flush=True)
+    summary["sha256"] = {f.path: f.sha256 for f in selected if f.sha256}
+    return summary
@@ -0,0 +1,405 @@
+# # Gateway
+#
+# One OpenAI-compatible endpoint in front of every vLLM and Infinity deployment. Requests are routed by their
+# `model` field, which may be either the deployment name (`vllm-llama3-8b`) or the model it serves
+# (`meta-llama/Meta-Llama-3-8B-Instruct`); the upstream always receives the served model name. The LoRA adapters
+# of a deployment are routed by their own names, which the upstream receives unchanged.
+#
+# Each upstream gets one long-lived HTTP/2 client, so requests reuse a handful of multiplexed TLS connections
+# instead of opening a new one per call. Responses are passed through as raw bytes while they arrive, so
+# streaming clients see every token as soon as the engine sends it. When a client disconnects, the upstream
+# request is cancelled straight away, which makes vLLM abort the generation.
+#
+# When `GATEWAY_API_KEYS` is set, clients use gateway keys with per-key token and concurrency budgets (see
+# `llm_hosting/ratelimit.py`) and the gateway calls the upstreams with their own API keys.
+#
+# Given a replica registry, generation requests of one conversation keep going to the vLLM container that holds
+# its prefix cache (see `llm_hosting/affinity.py`), and with `warm_pool_setter` the deployment's warm pool is held
+# at the number of containers with pinned conversations; `GATEWAY_AFFINITY=0` turns the routing off while still
+# reporting each container's prefix-cache hit rate, to compare the two.
+#
+# Upstream URLs follow Modal's `https://<workspace>--<app>-<function>.modal.run` scheme. Set `MODAL_WORKSPACE`,
+# or point routes elsewhere with `GATEWAY_UPSTREAMS`, a JSON object of deployment name to base URL (Modal
+# shortens labels longer than 63 characters, so those deployments need an explicit URL). Locally, against the
+# mock server:
+#
+#   python -m llm_hosting.gateway --upstream vllm-llama3-8b=http://127.0.0.1:8000 --port 8080
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from llm_hosting.admission import PRIORITY_HEADER
+from llm_hosting.affinity import REFRESH_SECONDS, ReplicaDirectory, affinity_enabled, session_key
+from llm_hosting.metrics import Metrics
+from llm_hosting.profiles import PROFILES, ModelProfile
+from llm_hosting.proxy import (
+    PassthroughResponse,
+    UpstreamPool,
+    error_response,
+    forward_headers,
+    send_unless_disconnected,
+)
+from llm_hosting.ratelimit import KeyPolicy, RateLimited, RateLimiter, UsageCounter, load_api_keys, request_tokens
+from llm_hosting.token_counter import TokenCounter
+from llm_hosting.traces import DEFAULT_COMPLETION_TOKENS
+
+DEFAULT_WORKSPACE = "dwarvesf"
+
+# Web server function of each engine's deployment script.
+SERVER_FUNCTIONS = {
+    "vllm": "openai_compatible_server",
+    "infinity": "infinity_embeddings_server",
+}
+
+# Environment variable holding the API key each engine's servers expect.
+UPSTREAM_KEYS = {
+    "vllm": "VLLM_API_KEY",
+    "infinity": "INFINITY_API_KEY",
+}
+
+# Statuses with which a replica's tunnel answers when the container behind it is gone or broken; the request was
+# not processed, so it is retried on the load-balanced URL.
+REPLICA_DOWN_STATUSES = {404, 502, 503}
+REPLICA_METRICS_TIMEOUT = 2.0
+
+API_PATHS = ["/v1/chat/completions", "/v1/completions", "/v1/embeddings", "/embeddings", "/v1/rerank", "/rerank"]
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str  # deployment name
+    model: str  # served model name
+    url: str  # upstream base URL
+    engine: str = "vllm"
+    adapters: Tuple[str, ...] = ()  # LoRA adapter names served next to the model
+
+
+def modal_url(workspace: str, app_name: str, function_name: str) -> str:
+    label = re.sub(r"[^a-z0-9-]", "-", f"{app_name}-{function_name}".lower().replace("_", "-"))
+    return f"https://{workspace}--{label}.modal.run"
+
+
+def profile_route(profile: ModelProfile, workspace: str, url: Optional[str] = None) -> Route:
+    url = url or modal_url(workspace, profile.name, SERVER_FUNCTIONS[profile.engine])
+    adapters = tuple(sorted(profile.lora_adapters or {}))
+    return Route(profile.name, profile.base_model, url.rstrip("/"), profile.engine, adapters)
+
+
+def load_routes(upstreams: Optional[Dict[str, str]] = None, workspace: Optional[str] = None) -> List[Route]:
+    if upstreams is None:
+        upstreams = json.loads(os.environ.get("GATEWAY_UPSTREAMS") or "{}")
+    workspace = workspace or os.environ.get("MODAL_WORKSPACE") or DEFAULT_WORKSPACE
+    return [
+        profile_route(profile, workspace, upstreams.get(profile.name))
+        for profile in PROFILES.values()
+        if profile.engine in SERVER_FUNCTIONS and not profile.missing_adapters
+    ]
+
+
+def bearer_token(headers) -> Optional[str]:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else None
+
+
+# With gateway keys configured, clients authenticate to the gateway and the gateway to the upstream with the
+# engine's own key. Responses are requested uncompressed so their token usage can be read on the way through.
+def upstream_headers(headers: Dict[str, str], route: Route) -> Dict[str, str]:
+    headers = {k: v for k, v in headers.items() if k.lower() not in ("authorization", "accept-encoding")}
+    key = os.environ.get(UPSTREAM_KEYS.get(route.engine, ""))
+    if key:
+        headers["authorization"] = f"Bearer {key}"
+    headers["accept-encoding"] = "identity"
+    return headers
+
+
+def create_app(
+    routes: Optional[List[Route]] = None,
+    api_keys: Optional[Dict[str, KeyPolicy]] = None,
+    token_counter: Optional[TokenCounter] = None,
+    replica_source: Optional[Callable[[], Dict[str, dict]]] = None,
+    warm_pool_setter: Optional[Callable[[str, str, int], int]] = None,
+) -> FastAPI:
+    routes = routes if routes is not None else load_routes()
+    api_keys = api_keys if api_keys is not None else load_api_keys()
+    app = FastAPI()
+    pool = UpstreamPool()
+    metrics = Metrics()
+    # Without gateway keys the client's Authorization header goes to the upstream unchanged and nothing is limited.
+    limiter = RateLimiter(api_keys) if api_keys else None
+    counter = token_counter or TokenCounter()
+    directory = ReplicaDirectory() if replica_source else None
+    affinity = directory is not None and affinity_enabled()
+
+    # Deployment names first, so they win over a served model name shared by two deployments.
+    by_model: Dict[str, Route] = {}
+    for route in routes:
+        by_model.setdefault(route.model, route)
+    by_model.update({route.name: route for route in routes})
+    by_model.update({adapter: route for route in routes for adapter in route.adapters})
+
+    metrics.describe("gateway_requests_total", "Requests handled, by route and upstream status")
+    metrics.describe("gateway_overhead_seconds", "Time spent in the gateway outside the upstream call")
+    metrics.describe("gateway_upstream_headers_seconds", "Upstream time to response headers")
+    metrics.describe("gateway_request_seconds", "Total request time including the streamed body")
+    metrics.describe("gateway_rate_limited_total", "Requests refused by a per-key limit")
+    metrics.describe("gateway_tokens_total", "Tokens used, by API key name")
+    metrics.describe("gateway_cancelled_total", "Requests whose client left before the response was done")
+    metrics.describe("gateway_tokens_saved_total", "Completion tokens not generated because the client left")
+    metrics.describe("gateway_affinity_requests_total", "Generation requests by target: a pinned replica or load-balanced")
+    metrics.describe("gateway_replicas", "Live replicas in the registry")
+    metrics.describe("gateway_pinned_replicas", "Live replicas with pinned requests within their idle timeout")
+    metrics.describe("gateway_prefix_cache_hit_rate", "Prefix-cache hit rate across a deployment's live replicas")
+
+    app.state.routes = routes
+    app.state.pool = pool
+    app.state.metrics = metrics
+
+    held_warm_pools: Dict[str, int] = {}
+
+    # Modal does not see pinned requests, so it is asked to keep the containers serving them; only on changes.
+    async def hold_warm_pools():
+        for route in routes:
+            pinned = directory.pinned(route.name)
+            metrics.set("gateway_pinned_replicas", pinned, {"route": route.name})
+            if not warm_pool_setter or held_warm_pools.get(route.name) == pinned:
+                continue
+            if route.name not in held_warm_pools and not directory.count(route.name):
+                continue  # never had a replica registered
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, warm_pool_setter, route.name, SERVER_FUNCTIONS[route.engine], pinned
+                )
+                held_warm_pools[route.name] = pinned
+            except Exception as e:
+                print(json.dumps({"event": "warm_pool_failed", "route": route.name, "pinned": pinned,
+                                  "error": f"{type(e).__name__}: {e}"}))
+
+    async def refresh_replicas():
+        while True:
+            try:
+                directory.update(await asyncio.get_running_loop().run_in_executor(None, replica_source))
+            except Exception as e:
+                print(json.dumps({"event": "replica_refresh_failed", "error": f"{type(e).__name__}: {e}"}))
+            for route in routes:
+                metrics.set("gateway_replicas", directory.count(route.name), {"route": route.name})
+            if affinity:
+                await hold_warm_pools()
+            await asyncio.sleep(REFRESH_SECONDS)
+
+    @app.on_event("startup")
+    async def start_refresh():
+        if directory:
+            app.state.refresh = asyncio.ensure_future(refresh_replicas())
+
+    @app.on_event("shutdown")
+    async def close_pool():
+        if directory:
+            app.state.refresh.cancel()
+        await pool.aclose()
+
+    # Each replica's prefix-cache counters from its admission proxy, summed per deployment at scrape time.
+    async def scrape_replicas():
+        if not directory:
+            return
+
+        key = os.environ.get(UPSTREAM_KEYS["vllm"])
+        headers = {"authorization": f"Bearer {key}"} if key else {}
+
+        async def counters(replica):
+            try:
+                response = await pool.client(replica.url).get(
+                    "/admission/metrics/json", headers=headers, timeout=REPLICA_METRICS_TIMEOUT
+                )
+                found = response.json()["counters"]
+            except Exception:
+                return 0, 0
+            return tuple(
+                sum(series["value"] for series in found.get(name, []))
+                for name in ("prefix_cache_prompt_tokens_total", "prefix_cache_saved_prefill_tokens_total")
+            )
+
+        for deployment, replicas in list(directory.replicas.items()):
+            results = await asyncio.gather(*(counters(r) for r in replicas.values()))
+            prompt, saved = sum(p for p, _ in results), sum(s for _, s in results)
+            if prompt:
+                metrics.set("gateway_prefix_cache_hit_rate", saved / prompt, {"route": deployment})
+
+    @app.get("/health")
+    async def health():
+        return JSONResponse({})
+
+    @app.get("/v1/models")
+    async def models():
+        data = [{"id": route.name, "object": "model", "owned_by": "llm-hosting", "root": route.model} for route in routes]
+        data += [
+            {"id": adapter, "object": "model", "owned_by": "llm-hosting", "root": route.model, "parent": route.name}
+            for route in routes
+            for adapter in route.adapters
+        ]
+        return {"object": "list", "data": data}
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        await scrape_replicas()
+        return PlainTextResponse(metrics.render_prometheus())
+
+    @app.get("/metrics/json")
+    async def json_metrics():
+        await scrape_replicas()
+        return metrics.to_json()
+
+    async def proxy(request: Request):
+        start = time.monotonic()
+        raw = await request.body()
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            return error_response(400, "Request body must be JSON", "invalid_json")
+        model = body.get("model") if isinstance(body, dict) else None
+        if not model:
+            return error_response(400, "Request is missing the `model` field", "missing_model")
+        route = by_model.get(model)
+        if route is None:
+            return error_response(404, f"The model `{model}` does not exist", "model_not_found")
+
+        if model != route.model and model not in route.adapters:
+            raw = json.dumps({**body, "model": route.model}).encode()
+        labels = {"route": route.name}
+        headers = forward_headers(request.headers)
+
+        reservation = None
+        if limiter:
+            api_key = bearer_token(request.headers)
+            policy = limiter.policy(api_key)
+            if policy is None:
+                return error_response(401, "Invalid API key", "invalid_api_key")
+            headers = upstream_headers(headers, route)
+            if policy.priority:
+                # The key's class overrides whatever the client asked for (see `llm_hosting/admission.py`).
+                headers[PRIORITY_HEADER] = policy.priority
+            prompt_tokens, max_completion = request_tokens(body, lambda text: counter.count(route.model, text))
+            try:
+                reservation = limiter.acquire(api_key, prompt_tokens + max_completion)
+            except RateLimited as e:
+                metrics.inc("gateway_rate_limited_total", labels={"key": policy.name, "reason": e.reason})
+                retry_after = str(max(1, math.ceil(e.retry_after)))
+                return error_response(
+                    429,
+                    f"Rate limit exceeded for key {policy.name} ({e.reason}); retry after {retry_after}s",
+                    "rate_limit_exceeded",
+                    headers={"Retry-After": retry_after},
+                )
+
+        usage = UsageCounter(stream=bool(body.get("stream")))
+        generation = "messages" in body or "prompt" in body
+
+        # The client went away after `generated` tokens; closing the upstream connection aborts the rest.
+        def cancelled(generated: int):
+            metrics.inc("gateway_cancelled_total", labels=labels)
+            if generation:
+                max_tokens = body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+                metrics.inc("gateway_tokens_saved_total", max(max_tokens - generated, 0), labels)
+
+        replica = directory.lease(route.name, session_key(request.headers, body)) if affinity and generation else None
+
+        def release_replica():
+            if replica is not None:
+                directory.release(replica)
+
+        async def send_to(url: str):
+            client = pool.client(url)
+            return await client.send(
+                client.build_request(request.method, request.url.path, content=raw, headers=headers), stream=True
+            )
+
+        async def send_upstream():
+            nonlocal replica
+            if replica is not None:
+                import httpx
+
+                try:
+                    response = await send_to(replica.url)
+                    if response.status_code not in REPLICA_DOWN_STATUSES:
+                        return response
+                    await response.aclose()
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    pass
+                directory.mark_down(replica)
+                release_replica()
+                replica = None
+            return await send_to(route.url)
+
+        sent = time.monotonic()
+        sending = await send_unless_disconnected(request, send_upstream())
+        if sending is None:
+            if reservation:
+                limiter.release(reservation, 0)
+            release_replica()
+            cancelled(0)
+            return error_response(499, "Client closed the request", "client_closed")
+        try:
+            response = sending.result()
+        except Exception as e:
+            if reservation:
+                limiter.release(reservation, 0)
+            release_replica()
+            metrics.inc("gateway_requests_total", labels={**labels, "status": "upstream_error"})
+            return error_response(502, f"Upstream {route.name} failed: {type(e).__name__}", "upstream_error")
+        received = time.monotonic()
+
+        def finish(completed: bool):
+            metrics.observe("gateway_request_seconds", time.monotonic() - start, labels)
+            release_replica()
+            if not completed:
+                cancelled(usage.streamed_chunks)
+            if reservation:
+                # Failed requests are not charged.
+                used = usage.total(prompt_tokens) if response.status_code < 400 else 0
+                limiter.release(reservation, used)
+                metrics.inc("gateway_tokens_total", used, labels={"key": reservation.policy.name, "route": route.name})
+
+        metrics.inc("gateway_requests_total", labels={**labels, "status": str(response.status_code)})
+        if affinity and generation:
+            target = "replica" if replica is not None else "load_balanced"
+            metrics.inc("gateway_affinity_requests_total", labels={**labels, "target": target})
+        metrics.observe("gateway_upstream_headers_seconds", received - sent, labels)
+        metrics.observe("gateway_overhead_seconds", (sent - start) + (time.monotonic() - received), labels)
+        return PassthroughResponse(response, on_close=finish, on_chunk=usage.feed)
+
+    for path in API_PATHS:
+        app.add_api_route(path, proxy, methods=["POST"])
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the OpenAI-compatible gateway locally.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workspace", default=os.environ.get("MODAL_WORKSPACE", DEFAULT_WORKSPACE))
+    parser.add_argument("--upstream", action="append", default=[], metavar="DEPLOYMENT=URL")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    upstreams = json.loads(os.environ.get("GATEWAY_UPSTREAMS") or "{}")
+    upstreams.update(dict(item.split("=", 1) for item in args.upstream))
+    routes = load_routes(upstreams, args.workspace)
+    if args.upstream:
+        # Only the routes given on the command line, so nothing is sent to the real deployments by accident.
+        routes = [route for route in routes if route.name in upstreams]
+    uvicorn.run(create_app(routes), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+# # Keep-warm scheduling
+#
+# Modal stops a container `container_idle_timeout` seconds after its last request, and the next request pays a
+# 30-60s cold start. With a fixed 15s timeout every pause in a conversation becomes a cold start; a fixed long
+# one pays for idle GPUs all night. Instead, each deployment's captured request log (`traces/<profile>.jsonl`,
+# records with a `timestamp`) gives its arrival rate for every hour of the week, and from it:
+#
+# - `plan_policy` replays the log under candidate policies, each an idle timeout plus a warm pool (containers
+#   kept running with no traffic) for the hours whose rate is above a threshold, and picks the cheapest in
+#   GPU-hours whose share of requests hitting a cold start is within the profile's `cold_start_slo`;
+# - the chosen idle timeout is set on the server function at deploy time, and the hourly warm pools are baked
+#   into `keep_warm.py`, a scheduled function that sets each deployment's warm pool at the top of every hour;
+# - `python -m llm_hosting.keep_warm <profile>` prints cold-start rate against GPU-hours for every candidate.
+#
+# Hours are in UTC, Monday 00:00 first. Without a log with timestamps a profile keeps its fixed
+# `container_idle_timeout` and no warm pool.
+
+import argparse
+import heapq
+import json
+import math
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from llm_hosting.profiles import PROFILES, ModelProfile
+from llm_hosting.traces import completion_tokens, read_jsonl, trace_path
+
+HOUR = 3600
+WEEK_HOURS = 7 * 24
+SCHEDULE_FILE = "/keep_warm.json"
+WARM_POOLS_NAME = "llm-warm-pools"
+
+COLD_START_SECONDS = 60.0  # upper end of what the README reports; `startup_timeline` logs have the real figure
+DECODE_TOKENS_PER_SECOND = 30.0  # per stream, to turn a logged completion into time holding the container
+MIN_REQUESTS = 50  # fewer timestamped requests than this are not a traffic pattern
+
+IDLE_TIMEOUTS = (15, 60, 120, 300, 600, 1200)
+# Requests per hour from which an hour of the week gets a warm pool; None: never.
+WARM_THRESHOLDS = (None, 30.0, 10.0, 3.0, 1.0)
+
+# The web server function of each engine's scripts, whose warm pool the scheduler sets.
+SERVER_FUNCTIONS = {
+    "vllm": "openai_compatible_server",
+    "outlines": "outlines_server",
+    "infinity": "infinity_embeddings_server",
+}
+
+
+@dataclass(frozen=True)
+class KeepWarmPolicy:
+    idle_timeout: int
+    warm_pool: Tuple[int, ...] = ()  # containers kept running in each hour of the week; empty: none
+    name: str = ""
+
+    def warm_at(self, t: float) -> int:
+        return self.warm_pool[hour_of_week(t)] if self.warm_pool else 0
+
+
+@dataclass
+class SimulationResult:
+    policy: str
+    idle_timeout: int
+    warm_hours: int  # hours of the week with a warm pool
+    requests: int
+    cold_starts: int
+    containers_started: int
+    gpu_hours: float
+
+    @property
+    def cold_start_rate(self) -> float:
+        return self.cold_starts / self.requests if self.requests else 0.0
+
+
+def hour_of_week(t: float) -> int:
+    moment = time.gmtime(t)
+    return moment.tm_wday * 24 + moment.tm_hour
+
+
+# Epoch seconds (or milliseconds) or an ISO 8601 string; None if the record has no usable timestamp.
+def record_time(record: dict) -> Optional[float]:
+    value = record.get("timestamp")
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+@dataclass(frozen=True)
+class Arrival:
+    time: float
+    service_seconds: float  # time the request holds a container once it runs
+
+
+def arrivals(records: Iterable[dict]) -> List[Arrival]:
+    found = []
+    for record in records:
+        t = record_time(record)
+        if t is not None:
+            found.append(Arrival(t, completion_tokens(record) / DECODE_TOKENS_PER_SECOND))
+    return sorted(found, key=lambda a: a.time)
+
+
+def load_arrivals(deployment: str) -> List[Arrival]:
+    path = trace_path(deployment)
+    if not os.path.exists(path):
+        return []
+    return arrivals(read_jsonl(path))
+
+
+# Mean requests per hour for each hour of the week, over the weeks the log covers.
+def hourly_rates(log: List[Arrival]) -> List[float]:
+    counts = [0] * WEEK_HOURS
+    seen = [0] * WEEK_HOURS
+    for a in log:
+        counts[hour_of_week(a.time)] += 1
+    if log:
+        start = math.floor(log[0].time / HOUR) * HOUR
+        for hour_start in range(int(start), int(log[-1].time) + 1, HOUR):
+            seen[hour_of_week(hour_start)] += 1
+    return [c / s if s else 0.0 for c, s in zip(counts, seen)]
+
+
+def container_concurrency(profile: ModelProfile) -> int:
+    if profile.concurrent_inputs or profile.max_num_seqs:
+        return profile.concurrent_inputs or profile.max_num_seqs
+    if profile.engine == "vllm":
+        from llm_hosting.capacity import profile_concurrency
+
+        return profile_concurrency(profile)
+    return 100
+
+
+# Warm containers for an hour: enough for its mean load, at least one, at most `max_warm_containers`.
+def warm_pool(rates: List[float], threshold: Optional[float], service_seconds: float, concurrency: int,
+              max_warm: int) -> Tuple[int, ...]:
+    if threshold is None or max_warm < 1:
+        return ()
+    pool = []
+    for rate in rates:
+        busy = rate * service_seconds / HOUR / concurrency
+        pool.append(min(max_warm, max(1, math.ceil(busy))) if rate >= threshold else 0)
+    return tuple(pool) if any(pool) else ()
+
+
+def candidate_policies(profile: ModelProfile, log: List[Arrival]) -> List[KeepWarmPolicy]:
+    rates = hourly_rates(log)
+    service = sum(a.service_seconds for a in log) / len(log) if log else 0.0
+    concurrency = container_concurrency(profile)
+    policies = [KeepWarmPolicy(profile.container_idle_timeout, name="fixed")]
+    # The fixed timeout is usually on the grid too, and two thresholds can give the same pool: each distinct
+    # policy is simulated and listed once.
+    seen = {(profile.container_idle_timeout, ())}
+    for threshold in WARM_THRESHOLDS:
+        pool = warm_pool(rates, threshold, service, concurrency, profile.max_warm_containers)
+        if threshold is not None and not pool:
+            continue
+        for idle_timeout in IDLE_TIMEOUTS:
+            if (idle_timeout, pool) in seen:
+                continue
+            seen.add((idle_timeout, pool))
+            name = f"idle={idle_timeout}" + (f",warm>={threshold:g}/h" if threshold is not None else "")
+            policies.append(KeepWarmPolicy(idle_timeout, pool, name))
+    return policies
+
+
+@dataclass
+class _Container:
+    started: float
+    free_at: float  # when its last assigned request finishes (or it becomes ready)
+    ends: List[float] = field(default_factory=list)  # heap of the end times of its requests
+
+
+# Replays `log` against a deployment scaled the way Modal does it: a request goes to a ready container with a free
+# input slot, else waits for one that is starting, else starts a new one and waits `cold_start_seconds`. Idle
+# containers stop `idle_timeout` seconds after their last request unless the warm pool for the hour needs them,
+# and the warm pool is topped up at the start of each hour. GPU-hours count every second a container runs, over
+# the whole hours the log covers.
+def simulate(log: List[Arrival], policy: KeepWarmPolicy, concurrency: int = 1, gpu_count: int = 1,
+             cold_start_seconds: float = COLD_START_SECONDS) -> SimulationResult:
+    containers: List[_Container] = []
+    container_seconds = 0.0
+    cold_starts = started = 0
+
+    def stop(container: _Container, at: float):
+        nonlocal container_seconds
+        containers.remove(container)
+        container_seconds += at - container.started
+
+    def expire(until: float):
+        while True:
+            idle = [c for c in containers if c.free_at + policy.idle_timeout <= until]
+            if not idle:
+                return
+            container = min(idle, key=lambda c: c.free_at)
+            at = container.free_at + policy.idle_timeout
+            if len(containers) > policy.warm_at(at):
+                stop(container, at)
+            else:
+                # Kept for the warm pool; looked at again when the next hour may shrink it.
+                container.free_at = (math.floor(at / HOUR) + 1) * HOUR - policy.idle_timeout
+
+    def top_up(at: float):
+        nonlocal started
+        for _ in range(policy.warm_at(at) - len(containers)):
+            containers.append(_Container(at, at + cold_start_seconds))
+            started += 1
+
+    if not log:
+        return SimulationResult(policy.name, policy.idle_timeout, 0, 0, 0, 0, 0.0)
+    start = math.floor(log[0].time / HOUR) * HOUR
+    end = (math.floor(log[-1].time / HOUR) + 1) * HOUR
+    top_up(start)
+    boundary = start + HOUR
+
+    for arrival in log:
+        t = arrival.time
+        while boundary <= t:
+            expire(boundary)
+            top_up(boundary)
+            boundary += HOUR
+        expire(t)
+        for c in containers:
+            while c.ends and c.ends[0] <= t:
+                heapq.heappop(c.ends)
+        open_slots = [c for c in containers if len(c.ends) < concurrency]
+        ready = [c for c in open_slots if c.started + cold_start_seconds <= t]
+        if ready:
+            container = max(ready, key=lambda c: len(c.ends))  # pack requests so spare containers can idle out
+            begin = t
+        else:
+            cold_starts += 1
+            if open_slots:
+                container = min(open_slots, key=lambda c: c.started)
+            else:
+                container = _Container(t, t + cold_start_seconds)
+                containers.append(container)
+                started += 1
+            begin = container.started + cold_start_seconds
+        finish = begin + arrival.service_seconds
+        heapq.heappush(container.ends, finish)
+        container.free_at = max(container.free_at, finish)
+
+    while boundary <= end:
+        expire(boundary)
+        top_up(boundary)
+        boundary += HOUR
+    for container in list(containers):
+        stop(container, max(container.started, end))
+
+    warm_hours = sum(1 for n in policy.warm_pool if n)
+    return SimulationResult(
+        policy.name, policy.idle_timeout, warm_hours, len(log), cold_starts, started,
+        container_seconds * gpu_count / HOUR,
+    )
+
+
+def evaluate(profile: ModelProfile, log: List[Arrival],
+             cold_start_seconds: float = COLD_START_SECONDS) -> List[Tuple[KeepWarmPolicy, SimulationResult]]:
+    concurrency = container_concurrency(profile)
+    return [
+        (policy, simulate(log, policy, concurrency, profile.gpu_count, cold_start_seconds))
+        for policy in candidate_policies(profile, log)
+    ]
+
+
+# The cheapest candidate that meets the profile's cold-start SLO, or the one with the fewest cold starts if none
+# does. None when the profile opts out or there is no usable log.
+def plan_policy(profile: ModelProfile, log: Optional[List[Arrival]] = None,
+                cold_start_seconds: float = COLD_START_SECONDS) -> Optional[KeepWarmPolicy]:
+    if profile.cold_start_slo is None:
+        return None
+    log = load_arrivals(profile.name) if log is None else log
+    if len(log) < MIN_REQUESTS:
+        return None
+    results = evaluate(profile, log, cold_start_seconds)
+    meeting = [(p, r) for p, r in results if r.cold_start_rate <= profile.cold_start_slo]
+    if meeting:
+        return min(meeting, key=lambda pr: (pr[1].gpu_hours, pr[1].cold_start_rate))[0]
+    return min(results, key=lambda pr: (pr[1].cold_start_rate, pr[1].gpu_hours))[0]
+
+
+# Deploy time: the idle timeout for the profile's server function.
+def idle_timeout(profile: ModelProfile) -> int:
+    policy = plan_policy(profile)
+    return policy.idle_timeout if policy else profile.container_idle_timeout
+
+
+# Deploy time: the hourly warm pools of every deployment that has one, to bake into the scheduler's image.
+def plan_schedules(profiles: Optional[Dict[str, ModelProfile]] = None) -> Dict[str, dict]:
+    schedules = {}
+    for name, profile in (profiles or PROFILES).items():
+        policy = plan_policy(profile)
+        if policy and policy.warm_pool:
+            schedules[name] = {"function": SERVER_FUNCTIONS[profile.engine], **asdict(policy)}
+    return schedules
+
+
+# Runs during the image build of the scheduler.
+def write_schedules(schedules: Dict[str, dict]):
+    with open(SCHEDULE_FILE, "w") as f:
+        json.dump(schedules, f)
+
+
+def read_schedules() -> Dict[str, dict]:
+    if not os.path.exists(SCHEDULE_FILE):
+        return {}
+    with open(SCHEDULE_FILE) as f:
+        return json.load(f)
+
+
+# Warm pools are asked for by more than one source: the hourly schedule and the gateway, for the containers
+# holding pinned conversations (see `llm_hosting/affinity.py`). Each source's size is kept in the `llm-warm-pools`
+# Modal Dict and the deployment gets the largest; returns that size.
+def request_warm_pool(deployment: str, function: str, source: str, size: int) -> int:
+    from modal import Dict, Function
+
+    pools = Dict.from_name(WARM_POOLS_NAME, create_if_missing=True)
+    requested = {**pools.get(deployment, {}), source: size}
+    pools.put(deployment, requested)
+    size = max(requested.values())
+    Function.lookup(deployment, function).keep_warm(size)
+    return size
+
+
+# Sets each deployment's warm pool for the current hour. Runs in the scheduler's container.
+def apply_schedules(schedules: Dict[str, dict], now: Optional[float] = None) -> Dict[str, int]:
+    now = time.time() if now is None else now
+    applied = {}
+    for deployment, schedule in schedules.items():
+        size = KeepWarmPolicy(schedule["idle_timeout"], tuple(schedule["warm_pool"])).warm_at(now)
+        try:
+            size = request_warm_pool(deployment, schedule["function"], "schedule", size)
+        except Exception as e:
+            # One deployment that is not deployed (or renamed) must not keep the others from being scaled.
+            print(json.dumps({"event": "keep_warm_failed", "deployment": deployment,
+                              "error": f"{type(e).__name__}: {e}"}))
+            continue
+        applied[deployment] = size
+    print(json.dumps({"event": "keep_warm", "hour_of_week": hour_of_week(now), "warm_pools": applied}))
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay request logs under keep-warm policies.")
+    parser.add_argument("profiles", nargs="*", help="Profile names (default: every profile with a request log)")
+    parser.add_argument("--trace", help="Request log JSONL to replay instead of traces/<profile>.jsonl")
+    parser.add_argument("--cold-start-seconds", type=float, default=COLD_START_SECONDS)
+    args = parser.parse_args()
+
+    names = args.profiles or [name for name in PROFILES if os.path.exists(trace_path(name))]
+    for name in names:
+        profile = PROFILES[name]
+        log = arrivals(read_jsonl(args.trace)) if args.trace else load_arrivals(name)
+        if len(log) < MIN_REQUESTS:
+            print(json.dumps({"profile": name, "error": f"{len(log)} timestamped requests, need {MIN_REQUESTS}"}))
+            continue
+        chosen = plan_policy(profile, log, args.cold_start_seconds)
+        for policy, result in evaluate(profile, log, args.cold_start_seconds):
+            print(json.dumps({
+                "profile": name, **asdict(result), "cold_start_rate": round(result.cold_start_rate, 4),
+                "gpu_hours": round(result.gpu_hours, 2), "chosen": policy == chosen,
+            }))
+
+
+if __name__ == "__main__":
+    main()
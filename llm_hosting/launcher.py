@@ -0,0 +1,234 @@
+# # Server launcher
+#
+# Builds the server command line for a profile and starts it inside the container. This module only uses the
+# standard library so the command lines can be inspected locally without Modal or a GPU.
+
+import atexit
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import replace
+from functools import partial
+from typing import Callable, List, Optional
+
+from llm_hosting.affinity import register_replica, uses_affinity
+from llm_hosting.profiles import NGRAM, ModelProfile, with_overrides
+from llm_hosting.preshard import LOAD_FORMAT, weights_dir
+from llm_hosting.snapshot import DRAFT_MODEL_DIR, MODEL_DIR, lora_path, resolve_snapshot, serving_env
+from llm_hosting.supervisor import StartupTimeline, start_supervised, wait_until_ready
+from llm_hosting.warmup import warm_up
+
+
+# Flag combinations vLLM 0.6.1 refuses or fails on at the first request, caught before anything is built.
+def check_vllm_flags(profile: ModelProfile):
+    problems = []
+    if profile.enable_chunked_prefill and profile.enable_prefix_caching:
+        problems.append("chunked prefill cannot be combined with prefix caching")
+    if profile.enable_chunked_prefill and profile.speculative_model:
+        problems.append("chunked prefill cannot be combined with speculative decoding")
+    if profile.enable_prefix_caching and profile.speculative_model:
+        problems.append("prefix caching cannot be combined with speculative decoding")
+    if (
+        not profile.enable_chunked_prefill
+        and profile.max_num_batched_tokens
+        and profile.max_model_len
+        and profile.max_num_batched_tokens < profile.max_model_len
+    ):
+        problems.append("without chunked prefill, max_num_batched_tokens must be at least max_model_len")
+    if profile.missing_adapters:
+        problems.append("no LoRA adapters declared; the deployment would only serve a second copy of the base model")
+    if profile.preshard and profile.draft_model:
+        problems.append("pre-sharded weights cannot be combined with a draft model, which gets the same load format")
+    if problems:
+        raise ValueError(f"Profile {profile.name}: " + "; ".join(problems))
+
+
+def vllm_command(profile: ModelProfile, model_dir: str = MODEL_DIR) -> List[str]:
+    check_vllm_flags(profile)
+    cmd = [
+        "python", "-m", "vllm.entrypoints.openai.api_server",
+        "--model", model_dir,
+        "--served-model-name", profile.base_model,
+        "--port", str(profile.port),
+        "--gpu-memory-utilization", str(profile.gpu_memory_utilization),
+    ]
+    if profile.max_num_seqs:
+        cmd += ["--max-num-seqs", str(profile.max_num_seqs)]
+    if profile.tensor_parallel_size > 1:
+        cmd += ["--tensor-parallel-size", str(profile.tensor_parallel_size)]
+    if profile.quantization:
+        cmd += ["--quantization", profile.quantization]
+    if profile.max_model_len:
+        cmd += ["--max-model-len", str(profile.max_model_len)]
+    if profile.enable_prefix_caching:
+        cmd.append("--enable-prefix-caching")
+    if profile.enable_chunked_prefill:
+        cmd.append("--enable-chunked-prefill")
+    if profile.max_num_batched_tokens:
+        cmd += ["--max-num-batched-tokens", str(profile.max_num_batched_tokens)]
+    if profile.speculative_model:
+        cmd += speculative_args(profile)
+    if profile.lora_adapters is not None:
+        cmd += lora_args(profile)
+    if profile.preshard:
+        cmd += ["--load-format", LOAD_FORMAT]
+    return cmd
+
+
+def lora_args(profile: ModelProfile) -> List[str]:
+    adapters = profile.lora_adapters
+    args = [
+        "--enable-lora",
+        "--max-loras", str(profile.max_loras),
+        "--max-lora-rank", str(profile.max_lora_rank),
+        "--max-cpu-loras", str(profile.max_cpu_loras or max(len(adapters), profile.max_loras)),
+    ]
+    if adapters:
+        args += ["--lora-modules", *(f"{name}={lora_path(name)}" for name in sorted(adapters))]
+    return args
+
+
+def speculative_args(profile: ModelProfile) -> List[str]:
+    args = [
+        "--speculative-model", DRAFT_MODEL_DIR if profile.draft_model else NGRAM,
+        "--num-speculative-tokens", str(profile.num_speculative_tokens),
+        "--use-v2-block-manager",  # required by speculative decoding
+    ]
+    if not profile.draft_model:
+        args += ["--ngram-prompt-lookup-max", str(profile.ngram_prompt_lookup_max)]
+    elif profile.tensor_parallel_size > 1:
+        # The draft model is small enough for one GPU, which saves its all-reduces on every proposed token.
+        args += ["--speculative-draft-tensor-parallel-size", "1"]
+    if profile.speculative_disable_batch_size:
+        args += ["--speculative-disable-by-batch-size", str(profile.speculative_disable_batch_size)]
+    return args
+
+
+def infinity_command(profile: ModelProfile, model_dir: str = MODEL_DIR) -> List[str]:
+    return [
+        "infinity_emb", "v2",
+        "--device", "cuda",
+        "--engine", "torch",
+        "--model-id", model_dir,
+        "--served-model-name", profile.base_model,
+        "--port", str(profile.port),
+    ]
+
+
+def outlines_command(profile: ModelProfile, model_dir: str = MODEL_DIR) -> List[str]:
+    return ["python", "-m", "outlines.serve.serve", "--model", model_dir, "--port", str(profile.port)]
+
+
+COMMANDS = {
+    "vllm": vllm_command,
+    "infinity": infinity_command,
+    "outlines": outlines_command,
+}
+
+
+def server_command(profile: ModelProfile, model_dir: str = MODEL_DIR) -> List[str]:
+    if profile.engine not in COMMANDS:
+        raise ValueError(f"Unknown engine {profile.engine!r} for profile {profile.name}")
+    return COMMANDS[profile.engine](profile, model_dir)
+
+
+def uses_admission(profile: ModelProfile) -> bool:
+    return profile.engine == "vllm" and profile.admission_slo_seconds is not None
+
+
+ENGINE_STOP_SECONDS = 3  # for the engine to exit after a drain before it is killed
+
+
+# Modal sends SIGTERM when it stops a container (scale-down, preemption, a new deployment) and kills it once its
+# grace period is over. On that signal the container leaves the replica registry (`deregister`), `drain` stops
+# new requests and gives those in flight up to `shutdown_grace_seconds` to finish, and the engine is then stopped;
+# a `shutdown` JSON line reports how many requests were drained and aborted. Without a drain (no admission
+# proxy), the engine's own server finishes its requests on SIGTERM within the same grace period.
+#
+# Signal handlers can only be installed from the main thread; elsewhere the same steps run at interpreter exit.
+def drain_on_shutdown(
+    profile: ModelProfile,
+    proc: Optional[subprocess.Popen],
+    drain: Optional[Callable[[float], dict]] = None,
+    deregister: Optional[Callable[[], None]] = None,
+):
+    done = threading.Event()
+
+    def shut_down(reason: str):
+        if done.is_set():
+            return
+        done.set()
+        start = time.monotonic()
+        if deregister:
+            deregister()
+        report = drain(profile.shutdown_grace_seconds) if drain else {}
+        if proc and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=ENGINE_STOP_SECONDS if drain else profile.shutdown_grace_seconds)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        print(json.dumps({"event": "shutdown", "deployment": profile.name, "reason": reason, **report,
+                          "shutdown_seconds": round(time.monotonic() - start, 3)}), flush=True)
+
+    if threading.current_thread() is not threading.main_thread():
+        atexit.register(shut_down, "exit")
+        return
+
+    previous = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    def handle(signum, frame):
+        shut_down(signal.Signals(signum).name)
+        if callable(previous[signum]):
+            previous[signum](signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    for signum in previous:
+        signal.signal(signum, handle)
+
+
+# Starts the server and blocks until it has answered a real request and been warmed up, so the `web_server`
+# function only returns (and Modal only routes traffic to the container) once the model is actually serving.
+def launch_server(profile: ModelProfile, model_dir: str = MODEL_DIR) -> subprocess.Popen:
+    timeline = StartupTimeline(profile.name)
+
+    # Derived or overridden at deploy time (see `server_options`) and passed to the container through the environment.
+    profile = with_overrides(profile)
+
+    engine_model_dir = weights_dir(profile, model_dir)
+    snapshot = resolve_snapshot(engine_model_dir)
+    timeline.mark("snapshot_resolved", seconds=snapshot["resolve_seconds"])
+    if profile.draft_model:
+        draft = resolve_snapshot(DRAFT_MODEL_DIR)
+        timeline.mark("draft_snapshot_resolved", seconds=draft["resolve_seconds"])
+    for name in sorted(profile.lora_adapters or {}):
+        resolve_snapshot(lora_path(name))
+
+    # With admission control, vLLM listens on the next port up and the proxy takes the public one once the
+    # engine is ready and warm.
+    engine_profile = replace(profile, port=profile.port + 1) if uses_admission(profile) else profile
+
+    cmd = server_command(engine_profile, engine_model_dir)
+    print(f"Launching {profile.name}: {' '.join(cmd)}")
+    proc = start_supervised(cmd, serving_env(), profile.engine, timeline)
+    drain = deregister = None
+    try:
+        wait_until_ready(engine_profile, proc, timeline, timeout=profile.startup_timeout)
+        warm_up(engine_profile, timeline)
+        if engine_profile is not profile:
+            from llm_hosting.admission import drain_admission_proxy, start_admission_proxy
+
+            proxy = start_admission_proxy(profile, engine_profile.port, profile.port, model_dir)
+            drain = partial(drain_admission_proxy, proxy)
+            timeline.mark("admission_proxy_started")
+        if uses_affinity(profile):
+            deregister = register_replica(profile)
+    finally:
+        timeline.emit()
+    drain_on_shutdown(profile, proc, drain, deregister)
+    return proc
@@ -0,0 +1,94 @@
+# # Weight loading benchmark
+#
+# Starts the vLLM server of a pre-sharded profile once per load format and run, alternating between the plain
+# safetensors snapshot in `/model` and the pre-sharded one in `/model_sharded`, and times each start with the
+# startup timeline: weight loading (from vLLM's "Starting to load model" to "Loading model weights took" lines)
+# and the whole start up to the first answered request. Prints one `load_benchmark` JSON line per start and a
+# `load_benchmark_summary` with the median of each format. The first start of each format reads its files cold;
+# later ones may be served from the page cache, which the per-run lines show.
+#
+#   modal run vllm_llama3_70b.py::load_bench --runs 3
+#   python -m llm_hosting.load_bench vllm-llama-3-70b --runs 3  # inside a GPU container of that profile
+
+import argparse
+import json
+import statistics
+import subprocess
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+from llm_hosting.launcher import server_command
+from llm_hosting.preshard import LOAD_FORMAT, weights_dir
+from llm_hosting.profiles import PROFILES, ModelProfile
+from llm_hosting.snapshot import MODEL_DIR, resolve_snapshot, serving_env
+from llm_hosting.supervisor import StartupTimeline, start_supervised, wait_until_ready
+
+ENGINE_STOP_SECONDS = 30
+
+
+def _phase_time(report: dict, phase: str) -> Optional[float]:
+    return next((p["t"] for p in report["phases"] if p["phase"] == phase), None)
+
+
+def _seconds_between(report: dict, start: str, end: str) -> Optional[float]:
+    t0, t1 = _phase_time(report, start), _phase_time(report, end)
+    return round(t1 - t0, 3) if t0 is not None and t1 is not None else None
+
+
+# Starts the server for `profile` from `model_dir`, waits for its first answered request and stops it again.
+def time_load(profile: ModelProfile, model_dir: str, load_format: str) -> dict:
+    resolve_snapshot(model_dir)
+    timeline = StartupTimeline(f"{profile.name}:{load_format}")
+    proc = start_supervised(server_command(profile, model_dir), serving_env(), profile.engine, timeline)
+    try:
+        wait_until_ready(profile, proc, timeline, timeout=profile.startup_timeout)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=ENGINE_STOP_SECONDS)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    report = timeline.report()
+    return {
+        "load_format": load_format,
+        "weights_seconds": _seconds_between(report, "weights_load_started", "weights_loaded"),
+        "ready_seconds": _seconds_between(report, "process_spawned", "test_request_ok"),
+    }
+
+
+def benchmark_load(profile: ModelProfile, runs: int = 2, model_dir: str = MODEL_DIR) -> dict:
+    if profile.engine != "vllm" or not profile.preshard:
+        raise ValueError(f"Profile {profile.name} has no pre-sharded weights to compare")
+    variants = [
+        ("safetensors", replace(profile, preshard=False), model_dir),
+        (LOAD_FORMAT, profile, weights_dir(profile, model_dir)),
+    ]
+    results: Dict[str, List[dict]] = {name: [] for name, _, _ in variants}
+    for run in range(runs):
+        # Alternate which format goes first, so neither always finds the other's pages cached.
+        for name, variant, directory in variants if run % 2 == 0 else variants[::-1]:
+            result = {"run": run, **time_load(variant, directory, name)}
+            print(json.dumps({"event": "load_benchmark", "profile": profile.name, **result}), flush=True)
+            results[name].append(result)
+
+    summary = {"profile": profile.name, "runs": runs}
+    for name, measured in results.items():
+        for key in ("weights_seconds", "ready_seconds"):
+            values = [r[key] for r in measured if r[key] is not None]
+            summary[f"{name}_{key}"] = round(statistics.median(values), 3) if values else None
+    baseline, sharded = summary["safetensors_weights_seconds"], summary[f"{LOAD_FORMAT}_weights_seconds"]
+    summary["weights_speedup"] = round(baseline / sharded, 2) if baseline and sharded else None
+    print(json.dumps({"event": "load_benchmark_summary", **summary}), flush=True)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare weight load times of plain and pre-sharded snapshots.")
+    parser.add_argument("profile", help="Profile name, e.g. vllm-llama-3-70b")
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+    benchmark_load(PROFILES[args.profile], args.runs)
+
+
+if __name__ == "__main__":
+    main()
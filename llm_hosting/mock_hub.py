@@ -0,0 +1,120 @@
+# # Mock Huggingface hub
+#
+# A local stand-in for the parts of the hub `llm_hosting/download.py` uses: the repo file listing with LFS hashes
+# and file downloads with byte ranges. Repos are directories under `--root` (`<root>/<org>/<name>/...`), served
+# as if every revision were the same commit. `--drop-after-bytes` cuts each download off after that many bytes,
+# to exercise resuming:
+#
+#   python -m llm_hosting.mock_hub --root /tmp/hub --port 8300 --drop-after-bytes 50000000
+#   HF_ENDPOINT=http://127.0.0.1:8300 python -c "from llm_hosting.download import download_repo; \
+#       download_repo('org/model', '/tmp/model')"
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from llm_hosting.download import file_sha256
+
+MOCK_COMMIT = "0" * 40
+LFS_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".gguf", ".onnx", ".model")
+LFS_MIN_BYTES = 10 * 1024 * 1024
+REVISION_PATH = re.compile(r"^/api/models/(?P<repo>[^/]+/[^/]+)/revision/(?P<revision>[^/?]+)")
+RESOLVE_PATH = re.compile(r"^/(?P<repo>[^/]+/[^/]+)/resolve/(?P<revision>[^/]+)/(?P<path>.+)$")
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+def repo_listing(repo_dir: str) -> dict:
+    siblings = []
+    for root, _, names in os.walk(repo_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, repo_dir)
+            size = os.path.getsize(path)
+            sibling = {"rfilename": rel_path, "size": size, "blobId": hashlib.sha1(rel_path.encode()).hexdigest()}
+            if rel_path.endswith(LFS_SUFFIXES) or size >= LFS_MIN_BYTES:
+                sibling["lfs"] = {"sha256": file_sha256(path), "size": size, "pointerSize": 134}
+            siblings.append(sibling)
+    siblings.sort(key=lambda s: s["rfilename"])
+    return {"id": os.path.basename(repo_dir), "sha": MOCK_COMMIT, "siblings": siblings}
+
+
+def make_handler(root: str, drop_after_bytes: Optional[int]):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, payload: dict):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+            listing = REVISION_PATH.match(path)
+            if listing:
+                repo_dir = os.path.join(root, listing.group("repo"))
+                if not os.path.isdir(repo_dir):
+                    return self._json(404, {"error": "Repository not found"})
+                return self._json(200, repo_listing(repo_dir))
+            resolve = RESOLVE_PATH.match(path)
+            file_path = resolve and os.path.join(root, resolve.group("repo"), resolve.group("path"))
+            if not file_path or not os.path.isfile(file_path):
+                return self._json(404, {"error": "Entry not found"})
+            self._send_file(file_path)
+
+        def _send_file(self, file_path: str):
+            size = os.path.getsize(file_path)
+            start, end = 0, size - 1
+            requested = RANGE.match(self.headers.get("Range") or "")
+            if requested:
+                start = int(requested.group(1))
+                end = int(requested.group(2)) if requested.group(2) else size - 1
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.end_headers()
+                    return
+            self.send_response(206 if requested else 200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if requested:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            remaining = end - start + 1
+            limit = remaining if drop_after_bytes is None else min(remaining, drop_after_bytes)
+            with open(file_path, "rb") as f:
+                f.seek(start)
+                while limit > 0:
+                    chunk = f.read(min(limit, 1024 * 1024))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    limit -= len(chunk)
+            if limit == 0 and drop_after_bytes is not None and drop_after_bytes < remaining:
+                self.close_connection = True  # the client sees the body end short of Content-Length
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve local directories as Huggingface hub repos.")
+    parser.add_argument("--root", required=True, help="Directory holding <org>/<name> repos")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--drop-after-bytes", type=int, help="End every download after this many bytes")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.root, args.drop_after_bytes))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
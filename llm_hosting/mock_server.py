@@ -0,0 +1,345 @@
+# # Mock engine
+#
+# A CPU-only stand-in for the vLLM and Infinity servers. It speaks the same HTTP API (chat completions,
+# completions, embeddings, rerank, /health) with a configurable time to first token, per-token delay, error rate
+# and concurrency limit, so the layers in front of the models (the Dify proxy, gateway, benchmark harness) can be
+# measured and regression-tested without a GPU:
+#
+#   python -m llm_hosting.mock_server --port 8000 --ttft 0.2 --token-delay 0.02 --max-concurrency 32
+#   python -m llm_hosting.bench run --url http://127.0.0.1:8000 --model mock --concurrency 16
+#
+# Requests over the concurrency limit, generation, embedding and rerank alike, wait in a queue, as they would in
+# vLLM or Infinity, unless `--reject-when-full` is set, in which case they get a 429. `GET /mock/stats` returns
+# counters for what the mock has seen.
+#
+# `--prefill-delay` adds time to first token per prompt token, and with `--prefix-caching` only for prompt tokens
+# not already seen in an earlier prompt, to measure what prefix caching gains on a trace (`bench run --scenario
+# multi-turn`).
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from llm_hosting.prefix_cache import PrefixCacheTracker
+from llm_hosting.traces import estimate_tokens, prompt_text
+
+
+@dataclass
+class MockConfig:
+    model: str = "mock"
+    ttft: float = 0.1  # seconds before the first token
+    token_delay: float = 0.02  # seconds between tokens
+    prefill_delay: float = 0.0  # extra seconds to first token per uncached prompt token
+    prefix_caching: bool = False
+    default_max_tokens: int = 16
+    error_rate: float = 0.0
+    error_status: int = 500
+    max_concurrency: int = 256
+    reject_when_full: bool = False
+    embedding_dim: int = 1024
+    embedding_delay: float = 0.01
+    seed: Optional[int] = None
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    completed: int = 0
+    errors: int = 0
+    rejected: int = 0
+    cancelled: int = 0
+    tokens_generated: int = 0
+    tokens_not_generated: int = 0  # max_tokens left over on cancelled requests
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    admitted: int = 0
+    queue_seconds_total: float = 0.0
+
+
+def _completion_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex}"
+
+
+def _embedding(text: str, dim: int) -> List[float]:
+    # Deterministic per input, so callers can check that results come back in the right order.
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    return [rng.uniform(-1, 1) for _ in range(dim)]
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI()
+    stats = MockStats()
+    slots = asyncio.Semaphore(config.max_concurrency)
+    rng = random.Random(config.seed)
+    prefix_cache = PrefixCacheTracker() if config.prefix_caching else None
+
+    app.state.config = config
+    app.state.stats = stats
+
+    def error_response() -> Optional[JSONResponse]:
+        if config.error_rate and rng.random() < config.error_rate:
+            stats.errors += 1
+            return JSONResponse({"error": {"message": "injected error", "type": "mock"}}, status_code=config.error_status)
+        return None
+
+    async def acquire_slot() -> bool:
+        if config.reject_when_full and slots.locked():
+            stats.rejected += 1
+            return False
+        start = time.monotonic()
+        await slots.acquire()
+        stats.admitted += 1
+        stats.queue_seconds_total += time.monotonic() - start
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        return True
+
+    def release_slot():
+        stats.in_flight -= 1
+        slots.release()
+
+    def busy_response() -> JSONResponse:
+        return JSONResponse({"error": {"message": "server busy", "type": "mock"}}, status_code=429)
+
+    @app.get("/health")
+    async def health():
+        return JSONResponse({})
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": config.model, "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/mock/stats")
+    async def get_stats():
+        summary = asdict(stats)
+        summary["avg_queue_seconds"] = round(stats.queue_seconds_total / stats.admitted, 4) if stats.admitted else 0.0
+        return summary
+
+    async def generate(request: Request, body: dict, chat: bool):
+        stats.requests += 1
+        error = error_response()
+        if error:
+            return error
+        if not await acquire_slot():
+            return busy_response()
+
+        max_tokens = body.get("max_tokens") or config.default_max_tokens
+        prompt_tokens = estimate_tokens(prompt_text(body))
+        cached_tokens = prefix_cache.match(body).cached_tokens if prefix_cache else 0
+        stats.prompt_tokens += prompt_tokens
+        stats.cached_prompt_tokens += cached_tokens
+        ttft = config.ttft + config.prefill_delay * max(prompt_tokens - cached_tokens, 0)
+        model = body.get("model", config.model)
+        created = int(time.time())
+        completion_id = _completion_id("chatcmpl" if chat else "cmpl")
+        obj = "chat.completion" if chat else "text_completion"
+
+        def choice(text: str, finish_reason: Optional[str], stream: bool) -> dict:
+            if not chat:
+                return {"index": 0, "text": text, "finish_reason": finish_reason}
+            if stream:
+                return {"index": 0, "delta": {"content": text} if text else {}, "finish_reason": finish_reason}
+            return {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
+
+        def usage(completion_tokens: int) -> dict:
+            return {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+
+        if not body.get("stream"):
+            # Like vLLM, abort a non-streaming generation when the client disconnects.
+            generation = asyncio.ensure_future(asyncio.sleep(ttft + config.token_delay * (max_tokens - 1)))
+            started = time.monotonic()
+            try:
+                while not generation.done():
+                    await asyncio.wait({generation}, timeout=0.1)
+                    if not generation.done() and await request.is_disconnected():
+                        generation.cancel()
+                        elapsed = max(time.monotonic() - started - ttft, 0)
+                        generated = min(int(elapsed / config.token_delay), max_tokens) if config.token_delay else 0
+                        stats.cancelled += 1
+                        stats.tokens_generated += generated
+                        stats.tokens_not_generated += max(max_tokens - generated, 0)
+                        return JSONResponse({}, status_code=499)
+            finally:
+                release_slot()
+            stats.completed += 1
+            stats.tokens_generated += max_tokens
+            return JSONResponse({
+                "id": completion_id,
+                "object": obj,
+                "created": created,
+                "model": model,
+                "choices": [choice("tok " * max_tokens, "length", stream=False)],
+                "usage": usage(max_tokens),
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        chunk_obj = "chat.completion.chunk" if chat else "text_completion"
+        released = []
+
+        # From the generator when it ends, or after the response when the generator never started.
+        def release_stream_slot():
+            if not released:
+                released.append(True)
+                release_slot()
+
+        async def stream():
+            generated = 0
+            try:
+                await asyncio.sleep(ttft)
+                for i in range(max_tokens):
+                    if i:
+                        await asyncio.sleep(config.token_delay)
+                    generated += 1
+                    stats.tokens_generated += 1
+                    finish_reason = "length" if i == max_tokens - 1 else None
+                    chunk = {
+                        "id": completion_id,
+                        "object": chunk_obj,
+                        "created": created,
+                        "model": model,
+                        "choices": [choice("tok ", finish_reason, stream=True)],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                if include_usage:
+                    chunk = {"id": completion_id, "object": chunk_obj, "created": created, "model": model,
+                             "choices": [], "usage": usage(generated)}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+                stats.completed += 1
+            finally:
+                if generated < max_tokens:
+                    stats.cancelled += 1
+                    stats.tokens_not_generated += max_tokens - generated
+                release_stream_slot()
+
+        return StreamingResponse(
+            stream(), media_type="text/event-stream", background=BackgroundTask(release_stream_slot)
+        )
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await generate(request, await request.json(), chat=True)
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        return await generate(request, await request.json(), chat=False)
+
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        error = error_response()
+        if error:
+            return error
+        if not await acquire_slot():
+            return busy_response()
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        try:
+            await asyncio.sleep(config.embedding_delay)
+        finally:
+            release_slot()
+        stats.completed += 1
+        tokens = sum(estimate_tokens(text) for text in inputs)
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "embedding": _embedding(text, config.embedding_dim), "index": i}
+                for i, text in enumerate(inputs)
+            ],
+            "model": body.get("model", config.model),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    async def rerank(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        error = error_response()
+        if error:
+            return error
+        if not await acquire_slot():
+            return busy_response()
+        query, documents = body.get("query", ""), body.get("documents", [])
+        try:
+            await asyncio.sleep(config.embedding_delay)
+        finally:
+            release_slot()
+        stats.completed += 1
+        scores = [(_embedding(query + doc, 1)[0] + 1) / 2 for doc in documents]
+        results = [
+            {"relevance_score": score, "index": i, **({"document": documents[i]} if body.get("return_documents") else {})}
+            for i, score in sorted(enumerate(scores), key=lambda item: -item[1])
+        ]
+        tokens = sum(estimate_tokens(query + doc) for doc in documents)
+        return {
+            "object": "rerank",
+            "results": results,
+            "model": body.get("model", config.model),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    # Infinity serves these both with and without the /v1 prefix.
+    for path in ("/embeddings", "/v1/embeddings"):
+        app.add_api_route(path, embeddings, methods=["POST"])
+    for path in ("/rerank", "/v1/rerank"):
+        app.add_api_route(path, rerank, methods=["POST"])
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock vLLM/Infinity server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default=MockConfig.model)
+    parser.add_argument("--ttft", type=float, default=MockConfig.ttft)
+    parser.add_argument("--token-delay", type=float, default=MockConfig.token_delay)
+    parser.add_argument("--prefill-delay", type=float, default=MockConfig.prefill_delay)
+    parser.add_argument("--prefix-caching", action="store_true")
+    parser.add_argument("--default-max-tokens", type=int, default=MockConfig.default_max_tokens)
+    parser.add_argument("--error-rate", type=float, default=MockConfig.error_rate)
+    parser.add_argument("--error-status", type=int, default=MockConfig.error_status)
+    parser.add_argument("--max-concurrency", type=int, default=MockConfig.max_concurrency)
+    parser.add_argument("--reject-when-full", action="store_true")
+    parser.add_argument("--embedding-dim", type=int, default=MockConfig.embedding_dim)
+    parser.add_argument("--embedding-delay", type=float, default=MockConfig.embedding_delay)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = MockConfig(
+        model=args.model,
+        ttft=args.ttft,
+        token_delay=args.token_delay,
+        prefill_delay=args.prefill_delay,
+        prefix_caching=args.prefix_caching,
+        default_max_tokens=args.default_max_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        max_concurrency=args.max_concurrency,
+        reject_when_full=args.reject_when_full,
+        embedding_dim=args.embedding_dim,
+        embedding_delay=args.embedding_delay,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
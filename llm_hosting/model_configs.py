@@ -0,0 +1,139 @@
+# # Pinned model architecture summaries
+#
+# The fields of each model's `config.json` that the capacity planner needs, plus the total size of its
+# safetensors shards. They let `llm_hosting.capacity` check a profile before anything is built; the build
+# re-runs the same check against the real snapshot, so a stale entry here cannot produce a bad deployment.
+
+MODEL_CONFIGS = {
+    "meta-llama/Meta-Llama-3-8B-Instruct": {
+        "config": {
+            "architectures": ["LlamaForCausalLM"],
+            "hidden_size": 4096,
+            "intermediate_size": 14336,
+            "num_hidden_layers": 32,
+            "num_attention_heads": 32,
+            "num_key_value_heads": 8,
+            "vocab_size": 128256,
+            "max_position_embeddings": 8192,
+            "torch_dtype": "bfloat16",
+        },
+        "safetensors_total_size": 16060522496,
+    },
+    "CohereForAI/aya-23-8B": {
+        "config": {
+            "architectures": ["CohereForCausalLM"],
+            "hidden_size": 4096,
+            "intermediate_size": 14336,
+            "num_hidden_layers": 32,
+            "num_attention_heads": 32,
+            "num_key_value_heads": 8,
+            "vocab_size": 256000,
+            "max_position_embeddings": 8192,
+            "torch_dtype": "float16",
+        },
+        "safetensors_total_size": 16056078336,
+    },
+    "defog/sqlcoder-7b-2": {
+        "config": {
+            "architectures": ["LlamaForCausalLM"],
+            "hidden_size": 4096,
+            "intermediate_size": 11008,
+            "num_hidden_layers": 32,
+            "num_attention_heads": 32,
+            "num_key_value_heads": 32,
+            "vocab_size": 32016,
+            "max_position_embeddings": 16384,
+            "torch_dtype": "float16",
+        },
+        "safetensors_total_size": 13477093376,
+    },
+    "motherduckdb/DuckDB-NSQL-7B-v0.1": {
+        "config": {
+            "architectures": ["LlamaForCausalLM"],
+            "hidden_size": 4096,
+            "intermediate_size": 11008,
+            "num_hidden_layers": 32,
+            "num_attention_heads": 32,
+            "num_key_value_heads": 32,
+            "vocab_size": 32016,
+            "max_position_embeddings": 16384,
+            "torch_dtype": "bfloat16",
+        },
+        "safetensors_total_size": 13477093376,
+    },
+    "SeaLLMs/SeaLLM-7B-v2.5": {
+        "config": {
+            "architectures": ["GemmaForCausalLM"],
+            "hidden_size": 3072,
+            "intermediate_size": 24576,
+            "num_hidden_layers": 28,
+            "num_attention_heads": 16,
+            "num_key_value_heads": 16,
+            "head_dim": 256,
+            "vocab_size": 256000,
+            "max_position_embeddings": 8192,
+            "torch_dtype": "bfloat16",
+        },
+        "safetensors_total_size": 17075361792,
+    },
+    "PrunaAI/Meta-Llama-3-70b-instruct-AWQ-smashed": {
+        "config": {
+            "architectures": ["LlamaForCausalLM"],
+            "hidden_size": 8192,
+            "intermediate_size": 28672,
+            "num_hidden_layers": 80,
+            "num_attention_heads": 64,
+            "num_key_value_heads": 8,
+            "vocab_size": 128256,
+            "max_position_embeddings": 8192,
+            "torch_dtype": "float16",
+            "quantization_config": {"quant_method": "awq", "bits": 4, "group_size": 128},
+        },
+        "safetensors_total_size": 39770000000,
+    },
+    "TheBloke/deepseek-coder-33B-instruct-AWQ": {
+        "config": {
+            "architectures": ["LlamaForCausalLM"],
+            "hidden_size": 7168,
+            "intermediate_size": 19200,
+            "num_hidden_layers": 62,
+            "num_attention_heads": 56,
+            "num_key_value_heads": 8,
+            "vocab_size": 32256,
+            "max_position_embeddings": 16384,
+            "torch_dtype": "float16",
+            "quantization_config": {"quant_method": "awq", "bits": 4, "group_size": 128},
+        },
+        "safetensors_total_size": 18010000000,
+    },
+    "Qwen/Qwen1.5-110B-Chat-AWQ": {
+        "config": {
+            "architectures": ["Qwen2ForCausalLM"],
+            "hidden_size": 8192,
+            "intermediate_size": 49152,
+            "num_hidden_layers": 80,
+            "num_attention_heads": 64,
+            "num_key_value_heads": 8,
+            "vocab_size": 152064,
+            "max_position_embeddings": 32768,
+            "torch_dtype": "float16",
+            "quantization_config": {"quant_method": "awq", "bits": 4, "group_size": 128},
+        },
+        "safetensors_total_size": 61500000000,
+    },
+    "Snowflake/snowflake-arctic-instruct": {
+        "config": {
+            "architectures": ["ArcticForCausalLM"],
+            "hidden_size": 7168,
+            "intermediate_size": 4864,
+            "num_hidden_layers": 35,
+            "num_attention_heads": 56,
+            "num_key_value_heads": 8,
+            "num_local_experts": 128,
+            "vocab_size": 32000,
+            "max_position_embeddings": 4096,
+            "torch_dtype": "bfloat16",
+        },
+        "safetensors_total_size": 963270000000,
+    },
+}
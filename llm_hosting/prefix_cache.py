@@ -0,0 +1,83 @@
+# # Prefix cache tracking
+#
+# With `--enable-prefix-caching`, vLLM keeps the KV cache of finished requests in 16-token blocks keyed by a hash
+# of the whole prefix up to that block, and a new request whose prompt starts with cached blocks skips their
+# prefill. Chat traffic re-sends the same system prompt and, through the Dify proxy, the whole conversation on
+# every turn, so most of a prompt is usually cached.
+#
+# vLLM 0.6.1 only reports one engine-wide hit rate (the `vllm:gpu_prefix_cache_hit_rate` gauge) and nothing per
+# request. To split time to first token by hit and miss and to count the prefill tokens saved, the admission
+# proxy keeps a shadow of the cache: the same chained block hashes over the prompt text (with the character
+# estimate of tokens), evicted least recently used at the planned KV-cache size. It does not see evictions forced
+# by running sequences, so it slightly overestimates hits under memory pressure; the engine gauge is exported
+# alongside it to keep it honest.
+
+import collections
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+from llm_hosting.capacity import BLOCK_SIZE
+from llm_hosting.traces import CHARS_PER_TOKEN, estimate_tokens, message_text
+
+BLOCK_CHARS = BLOCK_SIZE * CHARS_PER_TOKEN
+ENGINE_HIT_RATE = re.compile(r"^vllm:gpu_prefix_cache_hit_rate(?:\{[^}]*\})?\s+(\S+)", re.MULTILINE)
+
+
+# The prompt as the engine sees it, up to the chat template: messages in order with their roles, so two
+# conversations only share blocks where they really share a prefix.
+def prompt_prefix_text(body: dict) -> str:
+    if "messages" in body:
+        return "".join(f"<{m.get('role', '')}>{message_text(m)}\n" for m in body["messages"])
+    prompt = body.get("prompt", "")
+    return prompt if isinstance(prompt, str) else "".join(map(str, prompt))
+
+
+# Chained hashes of the full blocks of `text`; only full blocks are cached by vLLM. Blocks computed with different
+# LoRA adapters are not shared, so the chain starts from the requested model.
+def block_hashes(text: str, model: Optional[str] = None) -> List[int]:
+    hashes = []
+    previous = model
+    for start in range(0, len(text) - BLOCK_CHARS + 1, BLOCK_CHARS):
+        previous = hash((previous, text[start : start + BLOCK_CHARS]))
+        hashes.append(previous)
+    return hashes
+
+
+@dataclass
+class PrefixMatch:
+    prompt_tokens: int
+    cached_tokens: int
+
+    @property
+    def hit(self) -> bool:
+        return self.cached_tokens > 0
+
+
+class PrefixCacheTracker:
+    def __init__(self, capacity_blocks: Optional[int] = None):
+        self.capacity_blocks = capacity_blocks  # None: unbounded
+        self.blocks = collections.OrderedDict()
+
+    # Matches a prompt against the cache and then adds its blocks, as vLLM does once the request is scheduled.
+    def match(self, body: dict) -> PrefixMatch:
+        text = prompt_prefix_text(body)
+        hashes = block_hashes(text, body.get("model"))
+        cached = 0
+        for h in hashes:
+            if h not in self.blocks:
+                break
+            cached += 1
+        for h in hashes:
+            self.blocks[h] = None
+            self.blocks.move_to_end(h)
+        while self.capacity_blocks is not None and len(self.blocks) > self.capacity_blocks:
+            self.blocks.popitem(last=False)
+        prompt_tokens = estimate_tokens(text)
+        return PrefixMatch(prompt_tokens, min(cached * BLOCK_SIZE, prompt_tokens))
+
+
+# vLLM's own hit rate from its Prometheus metrics, or None if the engine does not report one.
+def engine_hit_rate(metrics_text: str) -> Optional[float]:
+    found = ENGINE_HIT_RATE.search(metrics_text)
+    return float(found.group(1)) if found else None
@@ -0,0 +1,135 @@
+# # Pre-sharded weights
+#
+# Loading a checkpoint the usual way reads every safetensors shard of the whole model on every tensor-parallel rank
+# and runs each tensor through its layer's weight loader, which slices out the rank's part (and, for quantized
+# layers, the packed scales and zeros). For the 70B AWQ model that is a large share of the cold start.
+#
+# For profiles with `preshard=True`, an extra GPU step at image build time loads the model once with vLLM and saves
+# each rank's tensors exactly as they sit in GPU memory, as `model-rank-<rank>-part-<part>.safetensors` files next
+# to copies of the config and tokenizer, in `/model_sharded`. The server then starts with `--load-format
+# sharded_state`: each rank memory-maps only its own files and copies the tensors straight into its parameters,
+# without slicing. With the weight store, the saved files go into the store like any other snapshot, keyed by the
+# source commit, the tensor-parallel size, the quantization and the vLLM version, so the GPU step is skipped when a
+# matching one is already there.
+#
+# `python -m llm_hosting.load_bench` (or `modal run vllm_llama3_70b.py::load_bench`) compares load times with
+# the plain safetensors snapshot in `/model`.
+
+import json
+import os
+import shutil
+import time
+
+from llm_hosting.download import SAFETENSORS_INDEX
+from llm_hosting.profiles import ModelProfile
+from llm_hosting.snapshot import MODEL_DIR, SHARDED_MODEL_DIR, load_manifest, write_manifest
+from llm_hosting.weight_store import (
+    VOLUME_NAME,
+    WEIGHTS_DIR,
+    commit_volume,
+    link_snapshot,
+    load_snapshot,
+    snapshot_bytes,
+    staging_path,
+    store_directory,
+)
+
+LOAD_FORMAT = "sharded_state"
+MAX_FILE_BYTES = 5 * 1024**3
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth")
+# Only the weights are saved, so the engine is started with a short context to keep its KV-cache profiling quick.
+PRESHARD_MAX_MODEL_LEN = 2048
+
+
+# The store key of a profile's pre-sharded weights: they only fit the same rank layout, quantization and engine.
+def sharded_repo(profile: ModelProfile, vllm_version: str) -> str:
+    return (
+        f"{profile.base_model}@sharded-tp{profile.tensor_parallel_size}"
+        f"-{profile.quantization or 'none'}-vllm{vllm_version}"
+    )
+
+
+# Where the engine loads the profile's weights from; the original snapshot still holds the capacity plan.
+def weights_dir(profile: ModelProfile, model_dir: str = MODEL_DIR) -> str:
+    return SHARDED_MODEL_DIR if profile.preshard else model_dir
+
+
+# Loads the model from `model_dir` on the profile's GPUs and writes each rank's tensors, plus the files vLLM
+# needs besides the weights, to `output_dir`.
+def save_sharded_state(profile: ModelProfile, model_dir: str, output_dir: str):
+    from vllm import LLM
+
+    llm = LLM(
+        model=model_dir,
+        tensor_parallel_size=profile.tensor_parallel_size,
+        quantization=profile.quantization,
+        max_model_len=PRESHARD_MAX_MODEL_LEN,
+        gpu_memory_utilization=profile.gpu_memory_utilization,
+        enforce_eager=True,
+    )
+    executor = llm.llm_engine.model_executor
+    # Multi-GPU executors save on every worker; the single-GPU one leaves it to its worker.
+    save = getattr(executor, "save_sharded_state", None) or executor.driver_worker.save_sharded_state
+    os.makedirs(output_dir, exist_ok=True)
+    save(path=output_dir, max_size=MAX_FILE_BYTES)
+
+    for name in os.listdir(model_dir):
+        if name.startswith(".") or name == SAFETENSORS_INDEX or name.endswith(WEIGHT_SUFFIXES):
+            continue
+        source = os.path.join(model_dir, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(output_dir, name))
+        else:
+            shutil.copy(source, os.path.join(output_dir, name))
+
+
+# ### Pre-shard the weights
+# Image build step, after the weights are in `model_dir`; runs on the profile's GPUs. Writes a manifest for
+# `output_dir` like the other snapshots, so the container checks it at start.
+def preshard_model(
+    profile: ModelProfile,
+    model_dir: str = MODEL_DIR,
+    output_dir: str = SHARDED_MODEL_DIR,
+    root: str = WEIGHTS_DIR,
+    volume_name: str = VOLUME_NAME,
+):
+    import vllm
+
+    start = time.monotonic()
+    source = load_manifest(model_dir)
+    revision, commit = source.get("revision", "main"), source.get("commit", "unknown")
+    known = {}
+    cached = False
+    if profile.weight_store:
+        repo = sharded_repo(profile, vllm.__version__)
+        snapshot = load_snapshot(repo, commit, root)
+        cached = snapshot is not None
+        if not cached:
+            staging = staging_path(f"{repo.replace('/', '--')}--{commit}", root)
+            save_sharded_state(profile, model_dir, staging)
+            snapshot = store_directory(staging, repo, revision, commit, root)
+            commit_volume(volume_name)
+        link_snapshot(snapshot, output_dir, root)
+        known = {path: entry["sha256"] for path, entry in snapshot["files"].items()}
+    else:
+        save_sharded_state(profile, model_dir, output_dir)
+
+    manifest = write_manifest(
+        output_dir,
+        profile.base_model,
+        known,
+        revision=revision,
+        commit=commit,
+        load_format=LOAD_FORMAT,
+        tensor_parallel_size=profile.tensor_parallel_size,
+    )
+    print(json.dumps({
+        "event": "preshard",
+        "profile": profile.name,
+        "commit": commit,
+        "tensor_parallel_size": profile.tensor_parallel_size,
+        "cached": cached,
+        "files": len(manifest["files"]),
+        "bytes": snapshot_bytes(manifest),
+        "seconds": round(time.monotonic() - start, 3),
+    }), flush=True)
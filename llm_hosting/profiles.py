@@ -0,0 +1,242 @@
+# # Model deployment profiles
+#
+# Every deployment in this repository is described by one `ModelProfile`. The scripts at the top level only
+# pick a profile by name; the image, GPU request and server flags are all derived from it in
+# `llm_hosting/deploy.py` and `llm_hosting/launcher.py`, so a serving change lands in every deployment at once.
+
+import os
+from dataclasses import dataclass, replace
+from typing import Dict, Mapping, Optional, Tuple
+
+NGRAM = "[ngram]"  # speculative model that proposes tokens by looking them up in the prompt
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    name: str  # Modal app name
+    base_model: str  # Huggingface repo, also the model name clients send
+    engine: str = "vllm"  # "vllm", "infinity" or "outlines"
+    task: str = "generate"  # "generate", "embed" or "rerank"
+    port: int = 8000
+
+    # GPU request
+    gpu_type: str = "A100"
+    gpu_memory: int = 40  # GB per GPU
+    gpu_count: int = 1
+
+    # vLLM engine knobs
+    quantization: Optional[str] = None
+    quant_config: Optional[dict] = None  # written to quant_config.json for load-time quantization methods
+    max_model_len: Optional[int] = None
+    gpu_memory_utilization: float = 0.90
+    max_num_seqs: Optional[int] = None  # None: derived from the KV-cache plan and the request log
+    enable_prefix_caching: bool = False
+    # Chunked prefill splits long prompts into chunks of at most `max_num_batched_tokens` tokens per engine step,
+    # batched together with the decode steps of running requests, so a long prompt no longer stalls every other
+    # stream while it is prefilled. Smaller chunks keep inter-token latency flatter at some cost in prefill
+    # throughput. vLLM 0.6.1 cannot combine it with prefix caching or speculative decoding.
+    enable_chunked_prefill: bool = False
+    max_num_batched_tokens: Optional[int] = None  # None: vLLM's default (512 with chunked prefill)
+    # Speculative decoding: a small model with the same tokenizer (Huggingface repo), or `NGRAM`, proposes
+    # `num_speculative_tokens` tokens per step and the model verifies them in a single forward pass. It lowers
+    # per-token latency at small batch sizes, so vLLM stops speculating above `speculative_disable_batch_size`
+    # running requests.
+    speculative_model: Optional[str] = None
+    num_speculative_tokens: int = 5
+    ngram_prompt_lookup_max: int = 4
+    speculative_disable_batch_size: Optional[int] = 8
+    # LoRA adapters served next to the base model, by the model name clients send (Huggingface repo of an adapter
+    # trained on `base_model`). vLLM keeps up to `max_loras` adapters in GPU memory for the running batch and up to
+    # `max_cpu_loras` in CPU memory, evicting the least recently used, so each request can pick its adapter.
+    lora_adapters: Optional[Dict[str, str]] = None
+    max_loras: int = 4
+    max_lora_rank: int = 16
+    max_cpu_loras: Optional[int] = None  # None: as many as there are adapters
+
+    # Modal function settings
+    concurrent_inputs: Optional[int] = None  # None: same as max_num_seqs
+    container_idle_timeout: int = 15  # used as is without a timestamped request log
+    startup_timeout: int = 300
+    # When Modal stops a container, requests in flight get this long to finish before they are cut off; it has
+    # to fit in Modal's shutdown grace period (30s).
+    shutdown_grace_seconds: float = 25.0
+    # Keep-warm policy learned from the request log (see `llm_hosting/keep_warm.py`): the cheapest idle timeout and
+    # hourly warm pool that keep the share of requests hitting a cold start within `cold_start_slo`. None: fixed
+    # `container_idle_timeout` and no warm pool. `max_warm_containers` bounds the warm pool, and so its cost.
+    cold_start_slo: Optional[float] = 0.02
+    max_warm_containers: int = 1
+
+    # Admission control in front of vLLM (see `llm_hosting/admission.py`): requests predicted to queue for longer
+    # than the SLO are turned away with a 429. None serves vLLM directly.
+    admission_slo_seconds: Optional[float] = 10.0
+    admission_max_queue: int = 512
+    # Requests sent with `X-Priority: batch` wait behind interactive ones, hold at most this share of the slots
+    # and KV cache, and may be preempted (aborted and re-run) when interactive requests are waiting.
+    admission_batch_slo_seconds: float = 300.0
+    batch_max_share: float = 0.5
+    preempt_batch: bool = True
+    # Register each container with the gateway so a conversation keeps going to the container holding its prefix
+    # cache (see `llm_hosting/affinity.py`). Only with prefix caching.
+    session_affinity: bool = True
+
+    # Warm-up after the readiness check: representative requests replayed at each batch size. The sizes are taken
+    # from the request log's concurrency when it has timestamps; these are the fallback. Empty: no warm-up.
+    warmup_batch_sizes: Tuple[int, ...] = (1, 8, 32)
+    warmup_max_tokens: int = 16
+
+    # Weights: the Huggingface revision (branch, tag or commit) to serve, pinned to its commit at build time, and
+    # whether the files live in the shared weight store volume (see `llm_hosting/weight_store.py`) rather than
+    # being baked into the image.
+    revision: str = "main"
+    weight_store: bool = True
+    # Serve from weights pre-sharded per tensor-parallel rank at build time (see `llm_hosting/preshard.py`).
+    preshard: bool = False
+    download_timeout: int = 60 * 20
+
+    # vLLM shards the model across every GPU in the request.
+    @property
+    def tensor_parallel_size(self) -> int:
+        return self.gpu_count
+
+    # The draft model to download next to the weights, if speculation uses one.
+    @property
+    def draft_model(self) -> Optional[str]:
+        return self.speculative_model if self.speculative_model != NGRAM else None
+
+    # A LoRA deployment with no adapters listed yet: it cannot be deployed, so nothing routes to it.
+    @property
+    def missing_adapters(self) -> bool:
+        return self.lora_adapters is not None and not self.lora_adapters
+
+
+# Engine settings that can be changed for one deployment without editing its profile, to compare settings on the
+# same model, e.g. `ENABLE_CHUNKED_PREFILL=1 ENABLE_PREFIX_CACHING=0 MAX_NUM_BATCHED_TOKENS=1024 modal deploy ...`.
+# They are read when deploying and passed on to the containers through the environment.
+PROFILE_OVERRIDES = {
+    "MAX_NUM_SEQS": ("max_num_seqs", int),
+    "MAX_MODEL_LEN": ("max_model_len", int),
+    "MAX_NUM_BATCHED_TOKENS": ("max_num_batched_tokens", int),
+    "ENABLE_CHUNKED_PREFILL": ("enable_chunked_prefill", lambda value: value == "1"),
+    "ENABLE_PREFIX_CACHING": ("enable_prefix_caching", lambda value: value == "1"),
+}
+
+
+def override_env(environ: Optional[Mapping[str, str]] = None) -> Dict[str, str]:
+    environ = os.environ if environ is None else environ
+    return {key: environ[key] for key in PROFILE_OVERRIDES if environ.get(key)}
+
+
+def with_overrides(profile: ModelProfile, environ: Optional[Mapping[str, str]] = None) -> ModelProfile:
+    changes = {}
+    for key, value in override_env(environ).items():
+        field_name, parse = PROFILE_OVERRIDES[key]
+        changes[field_name] = parse(value)
+    return replace(profile, **changes) if changes else profile
+
+
+# Chat clients re-send the system prompt and the whole conversation on every turn, so vLLM deployments cache
+# prompt prefixes unless a profile opts out.
+def _vllm(name: str, base_model: str, enable_prefix_caching: bool = True, **kwargs) -> ModelProfile:
+    return ModelProfile(
+        name=name,
+        base_model=base_model,
+        engine="vllm",
+        port=8000,
+        enable_prefix_caching=enable_prefix_caching,
+        **kwargs,
+    )
+
+
+def _infinity(name: str, base_model: str, task: str = "embed", **kwargs) -> ModelProfile:
+    return ModelProfile(
+        name=name,
+        base_model=base_model,
+        engine="infinity",
+        port=7997,
+        gpu_type="T4",
+        gpu_memory=16,
+        concurrent_inputs=100,
+        task=task,
+        **kwargs,
+    )
+
+
+PROFILES: Dict[str, ModelProfile] = {
+    profile.name: profile
+    for profile in [
+        _vllm("vllm-llama3-8b", "meta-llama/Meta-Llama-3-8B-Instruct"),
+        # One warm container for the Llama 3 8B fine-tunes, each a LoRA adapter chosen by the request's `model`:
+        # add adapters as `"<model name>": "<Huggingface repo>"`. Deploying is refused while there are none, and
+        # the gateway has no route to it.
+        _vllm(
+            "vllm-llama3-8b-lora",
+            "meta-llama/Meta-Llama-3-8B-Instruct",
+            lora_adapters={},
+            container_idle_timeout=300,
+        ),
+        _vllm("vllm-aya-8b", "CohereForAI/aya-23-8B"),
+        _vllm("vllm-defog-sqlcoder-7b-2", "defog/sqlcoder-7b-2"),
+        _vllm("vllm-duckdb-nsql-7b", "motherduckdb/DuckDB-NSQL-7B-v0.1"),
+        _vllm("vllm-seallm-7b-v2.5", "SeaLLMs/SeaLLM-7B-v2.5"),
+        _vllm(
+            "vllm-llama-3-70b",
+            "PrunaAI/Meta-Llama-3-70b-instruct-AWQ-smashed",
+            gpu_memory=80,
+            quantization="awq",
+            preshard=True,
+        ),
+        # The 70B model with Llama 3 8B as its speculative decoding draft (same tokenizer), next to the plain
+        # deployment above so the two can be benchmarked against each other. Without prefix caching, which vLLM
+        # 0.6.1 does not support together with speculative decoding.
+        _vllm(
+            "vllm-llama-3-70b-spec",
+            "PrunaAI/Meta-Llama-3-70b-instruct-AWQ-smashed",
+            gpu_memory=80,
+            quantization="awq",
+            speculative_model="meta-llama/Meta-Llama-3-8B-Instruct",
+            num_speculative_tokens=5,
+            enable_prefix_caching=False,
+        ),
+        # Fed whole repositories by `dify/git_traverse.py`: chunked prefill keeps those prompts from stalling the
+        # other streams, at the cost of prefix caching.
+        _vllm(
+            "vllm-deepseek-coder-33b",
+            "TheBloke/deepseek-coder-33B-instruct-AWQ",
+            gpu_memory=80,
+            quantization="awq",
+            max_model_len=16384,
+            enable_prefix_caching=False,
+            enable_chunked_prefill=True,
+            max_num_batched_tokens=2048,
+        ),
+        _vllm(
+            "vllm-codeqwen-110b-v1.5",
+            "Qwen/Qwen1.5-110B-Chat-AWQ",
+            gpu_memory=80,
+            gpu_count=2,
+            quantization="awq",
+            startup_timeout=900,
+        ),
+        # ~480B parameters: only fits as FP8 (DeepSpeed FP quantization at load time) across 8x H100.
+        _vllm(
+            "vllm-arctic",
+            "Snowflake/snowflake-arctic-instruct",
+            gpu_type="H100",
+            gpu_memory=80,
+            gpu_count=8,
+            quantization="deepspeedfp",
+            quant_config={"bits": 8, "group_size": 128},
+            startup_timeout=1800,
+            download_timeout=60 * 60,
+        ),
+        ModelProfile(
+            name="outlines-llama3-8b",
+            base_model="meta-llama/Meta-Llama-3-8B-Instruct",
+            engine="outlines",
+            concurrent_inputs=100,
+        ),
+        _infinity("infinity-mxbai-embed-large-v1", "mixedbread-ai/mxbai-embed-large-v1"),
+        _infinity("infinity-mxbai-rerank-large-v1", "mixedbread-ai/mxbai-rerank-large-v1", task="rerank"),
+        _infinity("infinity-snowflake-arctic-embed-l-335m", "Snowflake/snowflake-arctic-embed-l"),
+    ]
+}
@@ -0,0 +1,152 @@
+# # HTTP pass-through
+#
+# The pieces shared by the HTTP layers in front of the engines (the gateway and the per-container admission
+# proxy): pooled upstream clients, a response that streams the upstream body through untouched, and cancelling
+# the upstream request as soon as the client goes away.
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi.responses import JSONResponse, StreamingResponse
+
+UPSTREAM_TIMEOUT = 600
+CONNECT_TIMEOUT = 10
+MAX_CONNECTIONS = 100
+KEEPALIVE_EXPIRY = 300
+
+# Connection-level headers that must not be forwarded between hops.
+HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+def error_response(status: int, message: str, code: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    return JSONResponse(
+        {"error": {"message": message, "type": "invalid_request_error", "code": code}},
+        status_code=status,
+        headers=headers,
+    )
+
+
+# HTTP/2 needs the optional `h2` package (`httpx[http2]`); without it the pools fall back to HTTP/1.1 keep-alive.
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def forward_headers(headers) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_HEADERS}
+
+
+class UpstreamPool:
+    def __init__(self, http2: bool = True, max_connections: int = MAX_CONNECTIONS):
+        self.http2 = http2 and http2_available()
+        self.max_connections = max_connections
+        self.clients = {}
+
+    def client(self, url: str):
+        if url not in self.clients:
+            import httpx
+
+            self.clients[url] = httpx.AsyncClient(
+                base_url=url,
+                http2=self.http2,
+                timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self.clients[url]
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+
+# Resolves when the client disconnects. Only for use once the request body has been read, and cancelled before
+# the response starts (the response then listens for the disconnect itself).
+async def _wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+# Sends the upstream request but gives up, cancelling it, if the client disconnects (or one of `others`
+# finishes) before the upstream response headers arrive. For a non-streaming request those only come once
+# generation is done, so without this an abandoned request would keep the GPU busy until `max_tokens`. Returns
+# the finished send task, or None if it was cancelled.
+async def send_unless_disconnected(request, sending: Awaitable, *others: asyncio.Future) -> Optional[asyncio.Future]:
+    sending = asyncio.ensure_future(sending)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({sending, disconnect, *others}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+    if sending.done():
+        return sending
+    sending.cancel()
+    return None
+
+
+# Streams an upstream response to the client as it arrives, showing each chunk to `on_chunk` on the way. The
+# upstream response is closed and `on_close(completed)` called however the response ends: `completed` is False
+# when the client went away before the upstream body was done, or the response was interrupted, in which case
+# closing the upstream response aborts the generation upstream.
+class PassthroughResponse(StreamingResponse):
+    def __init__(
+        self,
+        upstream,
+        on_close: Optional[Callable[[bool], None]] = None,
+        on_chunk: Optional[Callable[[bytes], None]] = None,
+    ):
+        self.upstream = upstream
+        self.on_close = on_close
+        self.on_chunk = on_chunk
+        self.completed = False
+        self.trailer: Optional[bytes] = None  # set once interrupted
+        super().__init__(
+            self._body(),
+            status_code=upstream.status_code,
+            headers=forward_headers(upstream.headers),
+        )
+
+    # Ends the response early: the upstream response is closed, which aborts the generation, and `trailer` is
+    # sent to the client in place of the rest of the body.
+    def interrupt(self, trailer: bytes = b""):
+        if self.trailer is None:
+            self.trailer = trailer
+            asyncio.ensure_future(self.upstream.aclose())
+
+    async def _body(self):
+        try:
+            async for chunk in self.upstream.aiter_raw():
+                if self.trailer is not None:
+                    break
+                if self.on_chunk:
+                    self.on_chunk(chunk)
+                yield chunk
+        except Exception:
+            # Reading a closed upstream response fails; that is expected once interrupted.
+            if self.trailer is None:
+                raise
+        if self.trailer is not None:
+            if self.trailer:
+                yield self.trailer
+            return
+        self.completed = True
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.upstream.aclose()
+            if self.on_close:
+                self.on_close(self.completed)
@@ -0,0 +1,191 @@
+# # Per-key rate limits
+#
+# Each API key of the gateway has a budget in tokens per minute and a cap on concurrent requests, so one batch
+# client cannot crowd out interactive users of the same deployment. Keys are configured in `GATEWAY_API_KEYS`, a
+# JSON object keyed by API key:
+#
+#   {"sk-chat-ui": {"name": "chat-ui", "tokens_per_minute": 200000, "max_concurrent": 32},
+#    "sk-batch": {"name": "batch", "tokens_per_minute": 50000, "max_concurrent": 4, "priority": "batch"}}
+#
+# Budgets are per key. A key without a `name` is labelled in metrics and errors by a short hash of the key rather
+# than the key itself; names must be unique.
+#
+# A request reserves its prompt tokens (counted with the model's tokenizer) plus its `max_tokens` from the key's
+# token bucket before it is forwarded. Once the response is done the reservation is reconciled with the tokens
+# actually used, taken from the response `usage` or counted from the streamed chunks.
+
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from llm_hosting.traces import DEFAULT_COMPLETION_TOKENS, prompt_text
+
+CHAT_MESSAGE_OVERHEAD = 4  # role and separator tokens the chat template adds per message
+CONCURRENCY_RETRY_AFTER = 1.0
+
+
+class RateLimited(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class KeyPolicy:
+    name: str
+    tokens_per_minute: Optional[int] = None  # None: unlimited
+    max_concurrent: Optional[int] = None  # None: unlimited
+    priority: Optional[str] = None  # "interactive" or "batch"; None: the client's X-Priority header decides
+
+
+def key_label(api_key: str) -> str:
+    return "key-" + hashlib.sha256(api_key.encode()).hexdigest()[:8]
+
+
+def load_api_keys(value: Optional[str] = None) -> Dict[str, KeyPolicy]:
+    value = value if value is not None else os.environ.get("GATEWAY_API_KEYS")
+    if not value:
+        return {}
+    policies = {key: KeyPolicy(**{"name": key_label(key), **policy}) for key, policy in json.loads(value).items()}
+    names = [p.name for p in policies.values()]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"GATEWAY_API_KEYS: names used by more than one key: {duplicates}")
+    return policies
+
+
+class TokenBucket:
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.level = float(tokens_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `tokens` are available. A request larger than the whole bucket only needs a full bucket.
+    def wait_for(self, tokens: int, now: float) -> float:
+        self._refill(now)
+        needed = min(tokens, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, tokens: int):
+        self.level -= tokens  # may go into debt, which later requests pay off
+
+    def give(self, tokens: int):
+        self.level = min(self.capacity, self.level + tokens)
+
+
+@dataclass
+class Reservation:
+    api_key: str
+    policy: KeyPolicy
+    tokens: int
+
+
+class RateLimiter:
+    def __init__(self, policies: Dict[str, KeyPolicy]):
+        self.policies = policies
+        # Keyed by API key, so keys never share a budget.
+        self.buckets = {key: TokenBucket(p.tokens_per_minute) for key, p in policies.items() if p.tokens_per_minute}
+        self.in_flight: Dict[str, int] = {key: 0 for key in policies}
+
+    def policy(self, api_key: Optional[str]) -> Optional[KeyPolicy]:
+        return self.policies.get(api_key or "")
+
+    def acquire(self, api_key: str, tokens: int) -> Reservation:
+        policy = self.policies[api_key]
+        if policy.max_concurrent is not None and self.in_flight[api_key] >= policy.max_concurrent:
+            raise RateLimited("max_concurrent", CONCURRENCY_RETRY_AFTER)
+        bucket = self.buckets.get(api_key)
+        if bucket:
+            wait = bucket.wait_for(tokens, time.monotonic())
+            if wait > 0:
+                raise RateLimited("tokens_per_minute", wait)
+            bucket.take(tokens)
+        self.in_flight[api_key] += 1
+        return Reservation(api_key, policy, tokens)
+
+    # Settles a reservation against the tokens the request actually used.
+    def release(self, reservation: Reservation, used_tokens: int):
+        self.in_flight[reservation.api_key] -= 1
+        bucket = self.buckets.get(reservation.api_key)
+        if bucket:
+            difference = reservation.tokens - used_tokens
+            if difference > 0:
+                bucket.give(difference)
+            else:
+                bucket.take(-difference)
+
+
+# Prompt tokens of a chat, completion, embedding or rerank request, and the most it can generate.
+def request_tokens(body: dict, count: Callable[[str], int]) -> Tuple[int, int]:
+    if "messages" in body:
+        prompt = count(prompt_text(body)) + CHAT_MESSAGE_OVERHEAD * len(body["messages"])
+    elif "prompt" in body:
+        prompt = count(prompt_text(body))
+    elif "input" in body:
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if inputs and all(isinstance(item, int) for item in inputs):
+            inputs = [inputs]  # a single input given as token ids
+        prompt = sum(len(item) if isinstance(item, list) else count(item) for item in inputs)
+    elif "query" in body:
+        prompt = sum(count(body["query"] + document) for document in body.get("documents", []))
+    else:
+        prompt = 0
+    if "messages" in body or "prompt" in body:
+        completion = body.get("max_tokens") or body.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS
+    else:
+        completion = 0
+    return prompt, completion
+
+
+# Reads token usage off a response as it streams through: the `usage` object when the engine sends one, or
+# otherwise one token per streamed content chunk (vLLM sends a chunk per token).
+class UsageCounter:
+    def __init__(self, stream: bool):
+        self.stream = stream
+        self.buffer = b""
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.streamed_chunks = 0
+
+    def feed(self, chunk: bytes):
+        self.buffer += chunk
+        if not self.stream:
+            return
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b"data:") or line == b"data: [DONE]":
+                continue
+            try:
+                self._read(json.loads(line[5:]))
+            except ValueError:
+                continue
+
+    def _read(self, payload: dict):
+        usage = payload.get("usage")
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+            self.completion_tokens = usage.get("completion_tokens", self.completion_tokens)
+        for choice in payload.get("choices") or []:
+            if (choice.get("delta") or {}).get("content") or choice.get("text"):
+                self.streamed_chunks += 1
+
+    def total(self, estimated_prompt_tokens: int) -> int:
+        if not self.stream and self.buffer:
+            try:
+                self._read(json.loads(self.buffer))
+            except ValueError:
+                pass
+            self.buffer = b""
+        prompt = self.prompt_tokens if self.prompt_tokens is not None else estimated_prompt_tokens
+        completion = self.completion_tokens if self.completion_tokens is not None else self.streamed_chunks
+        return prompt + completion
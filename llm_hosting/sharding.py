@@ -0,0 +1,100 @@
+# # Sharded batch jobs
+#
+# Splits a batch input into shards of roughly equal work so they can run on separate GPU containers, then merges
+# the shard results back into input order. Work is estimated per request as prompt tokens plus `max_tokens`, and
+# shards are filled longest-first onto whichever shard currently has the least work.
+
+import heapq
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from llm_hosting.batch import DEFAULT_MAX_TOKENS, check_unique_ids, request_id, request_params
+from llm_hosting.traces import estimate_tokens, prompt_text
+
+# Approximate Modal prices in USD per GPU-hour, used for the cost estimate in the throughput report.
+GPU_HOURLY_PRICES = {
+    "T4": 0.59,
+    "L4": 0.80,
+    "A10G": 1.10,
+    "A100-40GB": 2.78,
+    "A100-80GB": 3.40,
+    "H100": 3.95,
+}
+
+
+def request_work(record: dict) -> int:
+    params = request_params(record)
+    return estimate_tokens(prompt_text(params)) + (params.get("max_tokens") or DEFAULT_MAX_TOKENS)
+
+
+def with_id(index: int, record: dict) -> dict:
+    # Shards number their lines from zero, so every request carries its own id from here on.
+    if "custom_id" in record:
+        return record
+    return {"custom_id": request_id(index, record), "body": request_params(record)}
+
+
+def split_shards(records: Iterable[dict], num_shards: int) -> Tuple[List[List[dict]], List[str]]:
+    items = [with_id(index, record) for index, record in enumerate(records)]
+    order = [request_id(index, record) for index, record in enumerate(items)]
+    check_unique_ids(order)
+
+    shards: List[List[dict]] = [[] for _ in range(num_shards)]
+    loads = [(0, shard) for shard in range(num_shards)]
+    for record in sorted(items, key=request_work, reverse=True):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(record)
+        heapq.heappush(loads, (load + request_work(record), shard))
+    return [shard for shard in shards if shard], order
+
+
+def merge_results(shard_outputs: Iterable[Iterable[str]], order: List[str], out) -> int:
+    results: Dict[str, dict] = {}
+    for lines in shard_outputs:
+        for line in lines:
+            line = line.strip()
+            if line:
+                result = json.loads(line)
+                results[result["id"]] = result
+
+    written = 0
+    for index, rid in enumerate(order):
+        if rid in results:
+            result = results[rid]
+            result["index"] = index
+            out.write(json.dumps(result) + "\n")
+            written += 1
+    return written
+
+
+def gpu_price_key(gpu_type: str, gpu_memory: int) -> str:
+    return f"{gpu_type}-{gpu_memory}GB" if gpu_type == "A100" else gpu_type
+
+
+def throughput_report(
+    shard_reports: List[dict],
+    wall_seconds: float,
+    gpu_type: str,
+    gpu_memory: int,
+    gpu_count: int,
+    requests_total: Optional[int] = None,
+) -> dict:
+    requests = sum(r["requests"] for r in shard_reports)
+    prompt_tokens = sum(r["prompt_tokens"] for r in shard_reports)
+    completion_tokens = sum(r["completion_tokens"] for r in shard_reports)
+    container_seconds = sum(r.get("total_seconds", r["seconds"]) for r in shard_reports)
+    gpu_hours = container_seconds * gpu_count / 3600
+    price = GPU_HOURLY_PRICES.get(gpu_price_key(gpu_type, gpu_memory))
+    return {
+        "shards": len(shard_reports),
+        "requests": requests,
+        "requests_total": requests_total if requests_total is not None else requests,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "wall_seconds": round(wall_seconds, 3),
+        "prompts_per_second": round(requests / wall_seconds, 2) if wall_seconds else 0.0,
+        "tokens_per_second": round((prompt_tokens + completion_tokens) / wall_seconds, 2) if wall_seconds else 0.0,
+        "output_tokens_per_second": round(completion_tokens / wall_seconds, 2) if wall_seconds else 0.0,
+        "gpu_hours": round(gpu_hours, 3),
+        "estimated_cost_usd": round(gpu_hours * price, 2) if price is not None else None,
+    }
@@ -0,0 +1,161 @@
+# # Local model snapshots
+#
+# Weights are downloaded into the image at build time. At container start we serve strictly from that
+# directory: the Huggingface hub is never consulted, and a manifest written during the build is checked
+# so that a truncated or incomplete snapshot fails fast instead of half-loading on the GPU.
+
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+MODEL_DIR = "/model"
+DRAFT_MODEL_DIR = "/draft_model"  # speculative decoding draft model, for profiles that have one
+SHARDED_MODEL_DIR = "/model_sharded"  # weights pre-sharded per tensor-parallel rank, for profiles with `preshard`
+LORA_DIR = "/loras"  # one directory per LoRA adapter, for profiles that serve adapters
+MANIFEST_FILE = ".manifest.json"
+DEFAULT_IGNORE_PATTERNS = ["*.pt", "*.bin"]  # Using safetensors
+
+# Environment for the serving process. With these set, transformers / huggingface_hub resolve everything
+# from local files and raise instead of silently going back to the network.
+OFFLINE_ENV = {
+    "HF_HUB_OFFLINE": "1",
+    "TRANSFORMERS_OFFLINE": "1",
+    "HF_DATASETS_OFFLINE": "1",
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _sha256(path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _snapshot_files(model_dir: str) -> List[str]:
+    files = []
+    for root, dirs, names in os.walk(model_dir):
+        # Skip the huggingface_hub download bookkeeping directory.
+        dirs[:] = [d for d in dirs if d != ".cache"]
+        for name in names:
+            if name == MANIFEST_FILE:
+                continue
+            files.append(os.path.relpath(os.path.join(root, name), model_dir))
+    return sorted(files)
+
+
+# `known_sha256` holds hashes already checked during the download, so those files are not read again.
+def build_manifest(model_dir: str, base_model: str, known_sha256: Optional[Dict[str, str]] = None, **info) -> dict:
+    known_sha256 = known_sha256 or {}
+    files = {}
+    for rel_path in _snapshot_files(model_dir):
+        path = os.path.join(model_dir, rel_path)
+        files[rel_path] = {"size": os.path.getsize(path), "sha256": known_sha256.get(rel_path) or _sha256(path)}
+    return {"base_model": base_model, **info, "files": files}
+
+
+def write_manifest(model_dir: str, base_model: str, known_sha256: Optional[Dict[str, str]] = None, **info) -> dict:
+    manifest = build_manifest(model_dir, base_model, known_sha256, **info)
+    with open(os.path.join(model_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(model_dir: str) -> dict:
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        raise SnapshotError(f"No manifest found in {model_dir}; was the image built with download_model_to_folder?")
+    with open(path) as f:
+        return json.load(f)
+
+
+# ### Download the weights
+# We download the files of the model that serving needs with `download_repo` (see `llm_hosting/download.py`):
+# several shards at a time, resumed after dropped connections and checked against the hub's SHA256. Every
+# file's size and SHA256 then goes into the manifest, with the commit the revision resolved to, so the serving
+# container can check what it is about to load.
+#
+# This runs inside `Image.run_function`, so everything it needs is passed in as arguments rather than read
+# from globals: changing an argument is what makes Modal re-run the download step.
+def download_model_to_folder(
+    base_model: str,
+    model_dir: str = MODEL_DIR,
+    ignore_patterns: Optional[List[str]] = None,
+    quant_config: Optional[dict] = None,
+    revision: str = "main",
+):
+    from llm_hosting.download import download_repo
+
+    download = download_repo(
+        base_model,
+        model_dir,
+        revision=revision,
+        ignore_patterns=ignore_patterns if ignore_patterns is not None else DEFAULT_IGNORE_PATTERNS,
+    )
+
+    if quant_config:
+        with open(os.path.join(model_dir, "quant_config.json"), "w") as f:
+            json.dump(quant_config, f)
+
+    manifest = write_manifest(model_dir, base_model, download["sha256"], revision=revision, commit=download["commit"])
+    total_bytes = sum(entry["size"] for entry in manifest["files"].values())
+    print(f"Wrote manifest for {base_model}: {len(manifest['files'])} files, {total_bytes / 1e9:.2f} GB")
+
+
+def lora_path(name: str, lora_dir: str = LORA_DIR) -> str:
+    return os.path.join(lora_dir, name)
+
+
+def verify_snapshot(model_dir: str, check_hashes: bool = False) -> dict:
+    manifest = load_manifest(model_dir)
+
+    missing, mismatched = [], []
+    total_bytes = 0
+    for rel_path, expected in manifest["files"].items():
+        path = os.path.join(model_dir, rel_path)
+        if not os.path.exists(path):
+            missing.append(rel_path)
+            continue
+        size = os.path.getsize(path)
+        total_bytes += size
+        if size != expected["size"] or (check_hashes and _sha256(path) != expected["sha256"]):
+            mismatched.append(rel_path)
+
+    if missing or mismatched:
+        raise SnapshotError(
+            f"Snapshot in {model_dir} does not match its manifest: "
+            f"missing={missing[:5]} mismatched={mismatched[:5]}"
+        )
+
+    return {
+        "base_model": manifest["base_model"],
+        "model_dir": model_dir,
+        "files": len(manifest["files"]),
+        "bytes": total_bytes,
+        "hashes_checked": check_hashes,
+    }
+
+
+# Called at container start, before the server process is launched. Hash checking reads every byte of
+# the weights, so it is opt-in via `VERIFY_SNAPSHOT_HASHES=1`; sizes are always checked.
+def resolve_snapshot(model_dir: str = MODEL_DIR) -> dict:
+    start = time.monotonic()
+    check_hashes = os.environ.get("VERIFY_SNAPSHOT_HASHES") == "1"
+    report = verify_snapshot(model_dir, check_hashes=check_hashes)
+    report["resolve_seconds"] = round(time.monotonic() - start, 3)
+    print(json.dumps({"event": "snapshot_resolved", **report}))
+    return report
+
+
+def serving_env(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(OFFLINE_ENV)
+    if extra:
+        env.update(extra)
+    return env
@@ -0,0 +1,171 @@
+# # Startup supervision
+#
+# The server process is started with its output piped through us. Each line is echoed to the container log
+# and matched against known progress messages, which gives a timeline of where a cold start spends its time:
+# Python imports, weight loading, KV-cache allocation, CUDA graph capture, the HTTP server coming up. The
+# container is only reported ready once `/health` answers and a one-token test request succeeds; the timeline
+# is then printed as a single `startup_timeline` JSON line.
+
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+from llm_hosting.profiles import ModelProfile
+
+# Progress messages printed by each engine, in the order they normally appear. Only the first match of each
+# phase is recorded.
+PHASE_PATTERNS: Dict[str, List] = {
+    "vllm": [
+        ("engine_init", re.compile(r"Initializing an LLM engine")),
+        ("weights_load_started", re.compile(r"Starting to load model")),
+        ("weights_loaded", re.compile(r"Loading model weights took")),
+        ("kv_cache_allocated", re.compile(r"# GPU blocks: \d+")),
+        ("cuda_graph_capture_started", re.compile(r"Capturing the model for CUDA graphs")),
+        ("cuda_graphs_captured", re.compile(r"Graph capturing finished")),
+        ("http_listening", re.compile(r"Uvicorn running on")),
+    ],
+    "outlines": [
+        ("engine_init", re.compile(r"Initializing an LLM engine")),
+        ("weights_loaded", re.compile(r"Loading model weights took")),
+        ("kv_cache_allocated", re.compile(r"# GPU blocks: \d+")),
+        ("http_listening", re.compile(r"Uvicorn running on")),
+    ],
+    "infinity": [
+        ("model_loaded", re.compile(r"model warmed up")),
+        ("batching_ready", re.compile(r"ready to batch requests")),
+        ("http_listening", re.compile(r"Uvicorn running on")),
+    ],
+}
+
+HEALTH_POLL_INTERVAL = 0.5
+REQUEST_TIMEOUT = 60
+
+
+def _process_age(pid: int) -> Optional[float]:
+    # Seconds since `pid` started, from /proc. Used to place the container's own start on the timeline.
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        with open(f"/proc/{pid}/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimeline:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.monotonic()
+        self.phases: List[dict] = []
+        self._lock = threading.Lock()
+
+        container_age = _process_age(1)
+        if container_age is not None:
+            self.phases.append({"phase": "container_start", "t": round(-container_age, 3)})
+        python_age = _process_age(os.getpid())
+        if python_age is not None:
+            self.phases.append({"phase": "python_start", "t": round(-python_age, 3)})
+        self.mark("supervisor_start")
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def mark(self, phase: str, **info):
+        with self._lock:
+            if any(p["phase"] == phase for p in self.phases):
+                return
+            self.phases.append({"phase": phase, "t": round(self.elapsed(), 3), **info})
+
+    def has(self, phase: str) -> bool:
+        return any(p["phase"] == phase for p in self.phases)
+
+    # Phases in time order, each with the time spent since the previous one.
+    def report(self) -> dict:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p["t"])
+        previous = phases[0]["t"] if phases else 0.0
+        for phase in phases:
+            phase["duration"] = round(phase["t"] - previous, 3)
+            previous = phase["t"]
+        return {"deployment": self.name, "phases": phases, "total_seconds": round(previous - phases[0]["t"], 3)}
+
+    def emit(self) -> dict:
+        report = self.report()
+        print(json.dumps({"event": "startup_timeline", **report}))
+        return report
+
+
+def _follow_output(proc: subprocess.Popen, engine: str, timeline: StartupTimeline):
+    patterns = PHASE_PATTERNS.get(engine, [])
+    for line in proc.stdout:
+        print(line, end="", flush=True)
+        if not timeline.has("first_output"):
+            # The server prints nothing until its imports are done.
+            timeline.mark("first_output")
+        for phase, pattern in patterns:
+            if pattern.search(line):
+                timeline.mark(phase)
+
+
+def start_supervised(cmd: List[str], env: Optional[Dict[str, str]], engine: str, timeline: StartupTimeline) -> subprocess.Popen:
+    # Unbuffered, so progress lines reach us when they are printed rather than when a pipe buffer fills.
+    env = {**(env or os.environ), "PYTHONUNBUFFERED": "1"}
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    timeline.mark("process_spawned", pid=proc.pid)
+    threading.Thread(target=_follow_output, args=(proc, engine, timeline), daemon=True).start()
+    return proc
+
+
+def _auth_headers() -> Dict[str, str]:
+    key = os.environ.get("VLLM_API_KEY") or os.environ.get("INFINITY_API_KEY")
+    headers = {"Content-Type": "application/json"}
+    if key:
+        headers["Authorization"] = f"Bearer {key}"
+    return headers
+
+
+def http_json(url: str, body: Optional[dict] = None, timeout: float = REQUEST_TIMEOUT) -> dict:
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers=_auth_headers(), method="POST" if data else "GET")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        payload = response.read()
+    return json.loads(payload) if payload else {}
+
+
+# The smallest request that exercises the whole serving path for a profile.
+def test_request(profile: ModelProfile):
+    if profile.engine == "infinity":
+        if profile.task == "rerank":
+            return "/rerank", {"model": profile.base_model, "query": "ready?", "documents": ["yes"]}
+        return "/embeddings", {"model": profile.base_model, "input": ["ready?"]}
+    if profile.engine == "outlines":
+        return "/generate", {"prompt": "Hello", "max_tokens": 1}
+    return "/v1/completions", {"model": profile.base_model, "prompt": "Hello", "max_tokens": 1}
+
+
+def wait_until_ready(profile: ModelProfile, proc: subprocess.Popen, timeline: StartupTimeline, timeout: float):
+    base_url = f"http://127.0.0.1:{profile.port}"
+    deadline = time.monotonic() + timeout
+
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{profile.name} server exited with code {proc.returncode} during startup")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{profile.name} server did not become healthy within {timeout}s")
+        try:
+            urllib.request.urlopen(f"{base_url}/health", timeout=2).read()
+            break
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(HEALTH_POLL_INTERVAL)
+    timeline.mark("healthy")
+
+    path, body = test_request(profile)
+    http_json(f"{base_url}{path}", body)
+    timeline.mark("test_request_ok")
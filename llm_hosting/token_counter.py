@@ -0,0 +1,56 @@
+# # Token counting
+#
+# Counts prompt tokens with each model's own tokenizer, for budgets that have to be enforced before a request
+# reaches the engine. Only `tokenizer.json` is needed, loaded with the lightweight `tokenizers` package, so the
+# gateway can count for every model without `transformers` or any weights. The files are downloaded at image
+# build time with `download_tokenizers`; models without a `tokenizer.json` (or without the package installed)
+# fall back to the character estimate in `llm_hosting/traces.py`.
+
+import json
+import os
+from typing import Dict, Iterable
+
+from llm_hosting.traces import estimate_tokens
+
+TOKENIZER_DIR = "/tokenizers"
+TOKENIZER_FILE = "tokenizer.json"
+
+
+def tokenizer_path(model: str, tokenizer_dir: str = TOKENIZER_DIR) -> str:
+    return os.path.join(tokenizer_dir, model.replace("/", "--"), TOKENIZER_FILE)
+
+
+def download_tokenizers(models: Iterable[str], tokenizer_dir: str = TOKENIZER_DIR):
+    from huggingface_hub import hf_hub_download
+
+    for model in sorted(set(models)):
+        try:
+            hf_hub_download(model, TOKENIZER_FILE, local_dir=os.path.dirname(tokenizer_path(model, tokenizer_dir)))
+        except Exception as e:
+            print(json.dumps({"event": "tokenizer_missing", "model": model, "error": f"{type(e).__name__}: {e}"}))
+
+
+class TokenCounter:
+    def __init__(self, tokenizer_dir: str = TOKENIZER_DIR):
+        self.tokenizer_dir = tokenizer_dir
+        self.tokenizers: Dict[str, object] = {}
+
+    def tokenizer(self, model: str):
+        if model not in self.tokenizers:
+            path = tokenizer_path(model, self.tokenizer_dir)
+            tokenizer = None
+            if os.path.exists(path):
+                try:
+                    from tokenizers import Tokenizer
+
+                    tokenizer = Tokenizer.from_file(path)
+                except ImportError:
+                    pass
+            self.tokenizers[model] = tokenizer
+        return self.tokenizers[model]
+
+    def count(self, model: str, text: str) -> int:
+        tokenizer = self.tokenizer(model)
+        if tokenizer is None:
+            return estimate_tokens(text)
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
@@ -0,0 +1,105 @@
+# # Request logs
+#
+# Helpers for reading captured OpenAI-style request logs (JSONL). A line is either a bare request body, as sent
+# to `/v1/chat/completions` or `/v1/completions`, or a captured exchange of the form
+# `{"timestamp": ..., "request": {...}, "response": {...}}`. When a response with `usage` was captured its
+# token counts are used; otherwise tokens are estimated from the text.
+
+import json
+import os
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+# Captured logs live outside git (see .gitignore), one file per deployment: `traces/<profile name>.jsonl`.
+TRACES_DIR = os.environ.get("TRACES_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "traces"))
+
+# Used when no request log has been captured for a deployment yet.
+DEFAULT_PROMPT_TOKENS = 1024
+DEFAULT_COMPLETION_TOKENS = 256
+
+CHARS_PER_TOKEN = 4
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def request_body(record: dict) -> dict:
+    return record.get("request", record)
+
+
+def request_usage(record: dict) -> Optional[dict]:
+    response = record.get("response") or {}
+    return response.get("usage") or record.get("usage")
+
+
+def message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def prompt_text(request: dict) -> str:
+    if "messages" in request:
+        return "\n".join(message_text(m) for m in request["messages"])
+    prompt = request.get("prompt", "")
+    return prompt if isinstance(prompt, str) else "".join(prompt)
+
+
+def prompt_tokens(record: dict) -> int:
+    usage = request_usage(record)
+    if usage and usage.get("prompt_tokens"):
+        return usage["prompt_tokens"]
+    return estimate_tokens(prompt_text(request_body(record)))
+
+
+def completion_tokens(record: dict) -> int:
+    usage = request_usage(record)
+    if usage and usage.get("completion_tokens"):
+        return usage["completion_tokens"]
+    return request_body(record).get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+
+
+@dataclass(frozen=True)
+class RequestStats:
+    requests: int
+    avg_prompt_tokens: float
+    avg_completion_tokens: float
+
+    @property
+    def avg_sequence_tokens(self) -> float:
+        return self.avg_prompt_tokens + self.avg_completion_tokens
+
+
+DEFAULT_STATS = RequestStats(0, DEFAULT_PROMPT_TOKENS, DEFAULT_COMPLETION_TOKENS)
+
+
+def request_stats(records: Iterable[dict]) -> RequestStats:
+    count = prompt_total = completion_total = 0
+    for record in records:
+        count += 1
+        prompt_total += prompt_tokens(record)
+        completion_total += completion_tokens(record)
+    if not count:
+        return DEFAULT_STATS
+    return RequestStats(count, prompt_total / count, completion_total / count)
+
+
+def trace_path(deployment: str) -> str:
+    return os.path.join(TRACES_DIR, f"{deployment}.jsonl")
+
+
+def load_request_stats(deployment: str) -> RequestStats:
+    path = trace_path(deployment)
+    if not os.path.exists(path):
+        return DEFAULT_STATS
+    return request_stats(read_jsonl(path))
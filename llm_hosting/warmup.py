@@ -0,0 +1,152 @@
+# # Warm-up
+#
+# The first requests a fresh server sees pay for lazy kernel compilation, tokenizer and detokenizer start-up
+# and an empty prefix cache. After the readiness check passes we replay a handful of representative requests
+# at each of the profile's warm-up batch sizes, and only then report the container ready.
+#
+# Representative requests are sampled from the deployment's captured request log at deploy time and baked
+# into the image as `/warmup.jsonl`; without a log a few built-in prompts are used. The batch sizes come from the
+# same log when its records are timestamped: the typical, busy and peak number of requests in flight at once
+# (estimated as in `llm_hosting/keep_warm.py`), capped at `max_num_seqs`. They are baked into
+# `/warmup_batch_sizes.json`; without such a log the profile's `warmup_batch_sizes` are used.
+
+import heapq
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+from llm_hosting.keep_warm import Arrival, load_arrivals
+from llm_hosting.profiles import ModelProfile
+from llm_hosting.supervisor import StartupTimeline, http_json
+from llm_hosting.traces import prompt_text, read_jsonl, request_body, trace_path
+
+WARMUP_FILE = "/warmup.jsonl"
+WARMUP_SAMPLE_SIZE = 32
+WARMUP_BATCH_SIZES_FILE = "/warmup_batch_sizes.json"
+CONCURRENCY_PERCENTILES = (0.5, 0.9, 1.0)
+
+BUILTIN_REQUESTS = [
+    {"messages": [{"role": "user", "content": "Write me a python snake game."}]},
+    {"messages": [{"role": "user", "content": "Summarize the plot of Hamlet in three sentences."}]},
+    {"messages": [{"role": "user", "content": "Write a SQL query that returns the ten most recent orders per customer."}]},
+    {"messages": [{"role": "user", "content": "Explain the difference between a process and a thread."}]},
+    {"prompt": "The quick brown fox jumps over the lazy dog."},
+]
+
+
+# Deploy time: pick the requests to bake into the image.
+def sample_warmup_requests(profile: ModelProfile, k: int = WARMUP_SAMPLE_SIZE) -> List[dict]:
+    path = trace_path(profile.name)
+    if not os.path.exists(path):
+        return []
+    requests = [request_body(record) for record in read_jsonl(path)]
+    return random.Random(0).sample(requests, min(k, len(requests)))
+
+
+# Requests in flight at each arrival, counting the arriving one, from arrival times and service times.
+def concurrency_at_arrivals(log: Sequence[Arrival]) -> List[int]:
+    running: List[float] = []  # heap of end times
+    seen = []
+    for arrival in sorted(log, key=lambda a: a.time):
+        while running and running[0] <= arrival.time:
+            heapq.heappop(running)
+        heapq.heappush(running, arrival.time + arrival.service_seconds)
+        seen.append(len(running))
+    return seen
+
+
+# Deploy time: the batch sizes seen in the request log, or None without a timestamped log. Always starts at 1.
+def observed_batch_sizes(log: Sequence[Arrival], max_num_seqs: Optional[int] = None) -> Optional[List[int]]:
+    seen = sorted(concurrency_at_arrivals(log))
+    if not seen:
+        return None
+    sizes = {1} | {seen[min(len(seen) - 1, int(p * len(seen)))] for p in CONCURRENCY_PERCENTILES}
+    return sorted(size if not max_num_seqs else min(size, max_num_seqs) for size in set(sizes))
+
+
+def sample_warmup_batch_sizes(profile: ModelProfile, max_num_seqs: Optional[int] = None) -> Optional[List[int]]:
+    if not profile.warmup_batch_sizes:
+        return None  # warm-up turned off
+    return observed_batch_sizes(load_arrivals(profile.name), max_num_seqs or profile.max_num_seqs)
+
+
+# Image build step.
+def write_warmup_requests(
+    requests: List[dict],
+    path: str = WARMUP_FILE,
+    batch_sizes: Optional[List[int]] = None,
+    batch_sizes_path: str = WARMUP_BATCH_SIZES_FILE,
+):
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+    if batch_sizes:
+        with open(batch_sizes_path, "w") as f:
+            json.dump(batch_sizes, f)
+
+
+def load_warmup_batch_sizes(profile: ModelProfile, path: str = WARMUP_BATCH_SIZES_FILE) -> List[int]:
+    if not profile.warmup_batch_sizes:
+        return []
+    sizes = list(profile.warmup_batch_sizes)
+    if os.path.exists(path):
+        with open(path) as f:
+            sizes = json.load(f) or sizes
+    return [b for b in sizes if not profile.max_num_seqs or b <= profile.max_num_seqs]
+
+
+def load_warmup_requests(path: str = WARMUP_FILE) -> List[dict]:
+    if os.path.exists(path):
+        requests = list(read_jsonl(path))
+        if requests:
+            return requests
+    return BUILTIN_REQUESTS
+
+
+def warmup_call(profile: ModelProfile, request: dict):
+    if profile.engine == "infinity":
+        text = prompt_text(request) or "warm-up"
+        if profile.task == "rerank":
+            return "/rerank", {"model": profile.base_model, "query": text, "documents": [text, "warm-up"]}
+        return "/embeddings", {"model": profile.base_model, "input": [text]}
+
+    max_tokens = min(request.get("max_tokens") or profile.warmup_max_tokens, profile.warmup_max_tokens)
+    if profile.engine == "outlines":
+        return "/generate", {"prompt": prompt_text(request), "max_tokens": max_tokens}
+    if "messages" in request:
+        return "/v1/chat/completions", {"model": profile.base_model, "messages": request["messages"], "max_tokens": max_tokens}
+    return "/v1/completions", {"model": profile.base_model, "prompt": prompt_text(request), "max_tokens": max_tokens}
+
+
+def warm_up(profile: ModelProfile, timeline: StartupTimeline) -> dict:
+    base_url = f"http://127.0.0.1:{profile.port}"
+    requests = load_warmup_requests()
+    batch_sizes = load_warmup_batch_sizes(profile)
+
+    def send(request: dict) -> bool:
+        path, body = warmup_call(profile, request)
+        try:
+            http_json(f"{base_url}{path}", body)
+            return True
+        except Exception as e:
+            # The readiness check already passed; a request the model cannot serve (e.g. chat on a model
+            # without a chat template) should not keep the container from starting.
+            print(f"Warm-up request to {path} failed: {e}")
+            return False
+
+    batches = []
+    for batch_size in batch_sizes:
+        batch = [requests[i % len(requests)] for i in range(batch_size)]
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=batch_size) as pool:
+            results = list(pool.map(send, batch))
+        batches.append(
+            {"batch_size": batch_size, "seconds": round(time.monotonic() - start, 3), "errors": results.count(False)}
+        )
+
+    report = {"requests_available": len(requests), "batch_sizes": batch_sizes, "batches": batches}
+    timeline.mark("warmup_done", **report)
+    return report
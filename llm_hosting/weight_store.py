@@ -0,0 +1,217 @@
+# # Shared weight store
+#
+# Baking weights into each image stores and re-downloads the same Llama 3 8B shards for every deployment that
+# serves it (plain, LoRA, outlines and as the 70B's draft), and again on every image rebuild. Instead, profiles
+# with `weight_store=True` keep their files in the `llm-weights` Modal Volume, addressed by content:
+#
+#   /weights/blobs/sha256/<ab>/<sha256>                       one copy of each distinct file
+#   /weights/snapshots/<org>--<name>/<commit>.json            a repo at a commit: path -> sha256 and size
+#   /weights/tmp/<name>.<uuid>                                downloads and build outputs in progress, one per build
+#
+# At image build time `store_model_snapshot` resolves the profile's revision to a commit, downloads only the files
+# whose hash is not in the store yet, and logs a `weight_store` line with the files and bytes found in the store
+# against those fetched. The image itself only gets the snapshot's directory of symlinks into the blobs and its
+# manifest, which pins the commit; the serving and batch functions mount the volume at `/weights`, so the links
+# resolve and `resolve_snapshot` checks them as before. Nothing is ever deleted from the store.
+#
+# Two builds can fetch the same blob or write the same snapshot at once, so each stages under its own path and
+# renames the finished file into place; the rename is atomic, and the second one just replaces identical content.
+
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from llm_hosting.download import (
+    DOWNLOAD_WORKERS,
+    RepoFile,
+    check_safetensors_index,
+    download_file,
+    file_sha256,
+    list_repo_files,
+    select_files,
+)
+from llm_hosting.snapshot import DEFAULT_IGNORE_PATTERNS, write_manifest
+
+WEIGHTS_DIR = "/weights"
+VOLUME_NAME = "llm-weights"
+
+
+def blob_path(sha256: str, root: str = WEIGHTS_DIR) -> str:
+    return os.path.join(root, "blobs", "sha256", sha256[:2], sha256)
+
+
+def snapshot_path(repo: str, commit: str, root: str = WEIGHTS_DIR) -> str:
+    return os.path.join(root, "snapshots", repo.replace("/", "--"), f"{commit}.json")
+
+
+# A path under `tmp/` that no other build uses.
+def staging_path(name: str, root: str = WEIGHTS_DIR) -> str:
+    path = os.path.join(root, "tmp", f"{name}.{uuid.uuid4().hex}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+# Moves a finished file into the store, or drops it if the store already has the same content. Returns
+# (sha256, size, found in the store).
+def add_blob(path: str, root: str = WEIGHTS_DIR, sha256: Optional[str] = None) -> Tuple[str, int, bool]:
+    sha256 = sha256 or file_sha256(path)
+    blob = blob_path(sha256, root)
+    found = os.path.exists(blob)
+    if found:
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(path, blob)
+    return sha256, os.path.getsize(blob), found
+
+
+# Puts one repo file into the store. LFS files are skipped when their hash is already there; other files (configs
+# and tokenizers, small) are fetched to learn their hash.
+def _store_file(repo: str, commit: str, entry: RepoFile, root: str) -> Tuple[str, int, bool]:
+    if entry.sha256 and os.path.exists(blob_path(entry.sha256, root)):
+        return entry.sha256, entry.size, True
+    staging_name = entry.sha256 or f"{repo.replace('/', '--')}--{commit}--{entry.path.replace('/', '--')}"
+    staging = staging_path(staging_name, root)
+    download_file(repo, commit, entry, staging)
+    return add_blob(staging, root, entry.sha256)
+
+
+# A snapshot already in the store with all of its blobs, or None.
+def load_snapshot(repo: str, commit: str, root: str = WEIGHTS_DIR) -> Optional[dict]:
+    path = snapshot_path(repo, commit, root)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        snapshot = json.load(f)
+    if not all(os.path.exists(blob_path(entry["sha256"], root)) for entry in snapshot["files"].values()):
+        return None
+    return snapshot
+
+
+def _save_snapshot(repo: str, revision: str, commit: str, paths: List[str], stored: List[tuple], root: str) -> dict:
+    snapshot = {
+        "repo": repo,
+        "revision": revision,
+        "commit": commit,
+        "files": {path: {"sha256": sha, "size": size} for path, (sha, size, _) in zip(paths, stored)},
+    }
+    path = snapshot_path(repo, commit, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staging = staging_path(os.path.basename(path), root)
+    with open(staging, "w") as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    os.replace(staging, path)
+    return snapshot
+
+
+# Adds the files serving needs from `repo` at `revision` to the store and returns the snapshot: the commit and,
+# for each path, its hash and size.
+def store_snapshot(
+    repo: str,
+    revision: str = "main",
+    ignore_patterns: Optional[List[str]] = None,
+    root: str = WEIGHTS_DIR,
+    workers: int = DOWNLOAD_WORKERS,
+) -> dict:
+    start = time.monotonic()
+    commit, files = list_repo_files(repo, revision)
+    snapshot = load_snapshot(repo, commit, root)
+    if snapshot is not None:
+        _report(snapshot, len(snapshot["files"]), snapshot_bytes(snapshot), start)
+        return snapshot
+
+    selected = select_files(files, ignore_patterns)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stored = list(pool.map(lambda entry: _store_file(repo, commit, entry, root), selected))
+    snapshot = _save_snapshot(repo, revision, commit, [entry.path for entry in selected], stored, root)
+    hits = [size for _, size, found in stored if found]
+    _report(snapshot, len(hits), sum(hits), start)
+    return snapshot
+
+
+# Adds every file under `src_dir` (files produced at build time rather than downloaded) to the store as the
+# snapshot of `repo` at `commit`; `src_dir` is emptied.
+def store_directory(src_dir: str, repo: str, revision: str, commit: str, root: str = WEIGHTS_DIR) -> dict:
+    start = time.monotonic()
+    paths = sorted(
+        os.path.relpath(os.path.join(dirpath, name), src_dir)
+        for dirpath, _, names in os.walk(src_dir)
+        for name in names
+    )
+    stored = [add_blob(os.path.join(src_dir, path), root) for path in paths]
+    shutil.rmtree(src_dir)
+    snapshot = _save_snapshot(repo, revision, commit, paths, stored, root)
+    hits = [size for _, size, found in stored if found]
+    _report(snapshot, len(hits), sum(hits), start)
+    return snapshot
+
+
+def snapshot_bytes(snapshot: dict) -> int:
+    return sum(entry["size"] for entry in snapshot["files"].values())
+
+
+def _report(snapshot: dict, hit_files: int, hit_bytes: int, start: float):
+    total = snapshot_bytes(snapshot)
+    print(json.dumps({
+        "event": "weight_store",
+        "repo": snapshot["repo"],
+        "revision": snapshot["revision"],
+        "commit": snapshot["commit"],
+        "files": len(snapshot["files"]),
+        "hit_files": hit_files,
+        "bytes": total,
+        "hit_bytes": hit_bytes,
+        "fetched_bytes": total - hit_bytes,
+        "hit_rate": round(hit_bytes / total, 4) if total else 1.0,
+        "seconds": round(time.monotonic() - start, 3),
+    }), flush=True)
+
+
+# Lays the snapshot out in `model_dir` as symlinks into the store, which resolve wherever the volume is mounted
+# at `root`.
+def link_snapshot(snapshot: dict, model_dir: str, root: str = WEIGHTS_DIR):
+    if os.path.isdir(model_dir):
+        shutil.rmtree(model_dir)
+    for path, entry in snapshot["files"].items():
+        link = os.path.join(model_dir, path)
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(blob_path(entry["sha256"], root), link)
+    check_safetensors_index(model_dir)
+
+
+# Makes what a build step added to the store visible to later steps and to the serving containers.
+def commit_volume(volume_name: Optional[str] = VOLUME_NAME):
+    if volume_name:
+        from modal import Volume
+
+        Volume.from_name(volume_name).commit()
+
+
+# ### Store the weights
+# The image build step for profiles with `weight_store=True`, in place of `download_model_to_folder`, with the
+# volume mounted at `root`. Like it, everything is passed in as arguments so that changing one re-runs the step.
+def store_model_snapshot(
+    base_model: str,
+    model_dir: str,
+    ignore_patterns: Optional[List[str]] = None,
+    quant_config: Optional[dict] = None,
+    revision: str = "main",
+    root: str = WEIGHTS_DIR,
+    volume_name: Optional[str] = VOLUME_NAME,
+):
+    snapshot = store_snapshot(
+        base_model, revision, ignore_patterns if ignore_patterns is not None else DEFAULT_IGNORE_PATTERNS, root
+    )
+    commit_volume(volume_name)
+    link_snapshot(snapshot, model_dir, root)
+    if quant_config:
+        with open(os.path.join(model_dir, "quant_config.json"), "w") as f:
+            json.dump(quant_config, f)
+    known: Dict[str, str] = {path: entry["sha256"] for path, entry in snapshot["files"].items()}
+    manifest = write_manifest(model_dir, base_model, known, revision=revision, commit=snapshot["commit"])
+    print(f"Linked {base_model}@{snapshot['commit'][:12]} into {model_dir}: {len(manifest['files'])} files, "
+          f"{snapshot_bytes(snapshot) / 1e9:.2f} GB in the weight store")
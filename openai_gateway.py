@@ -0,0 +1,40 @@
+# # OpenAI-compatible gateway
+#
+# A single endpoint in front of every vLLM and Infinity deployment, routing by the `model` field (see
+# `llm_hosting/gateway.py`). It runs on CPU and stays warm, so clients keep one base URL and the gateway keeps
+# pooled HTTP/2 connections to each model's server. Conversations stick to the vLLM container holding their prefix
+# cache, found through the replica registry the containers write to, and those containers are kept in the
+# deployment's warm pool while they hold conversations.
+
+from modal import App, Image, Secret, asgi_app
+
+from llm_hosting.affinity import hold_warm_pool, read_registry
+from llm_hosting.gateway import create_app, load_routes
+from llm_hosting.token_counter import TOKENIZER_DIR, download_tokenizers
+
+image = (
+    Image.debian_slim(python_version="3.10")
+    .pip_install("fastapi", "httpx[http2]", "tokenizers==0.19.1", "huggingface_hub==0.25.0")
+    # Tokenizers of every routed model, for counting prompt tokens against the per-key budgets.
+    .run_function(
+        download_tokenizers,
+        secrets=[Secret.from_name("huggingface")],
+        kwargs={"models": [route.model for route in load_routes({})], "tokenizer_dir": TOKENIZER_DIR},
+    )
+)
+
+app = App("openai-gateway", image=image)
+
+
+# A single container, so every API key's budget is enforced in one place and every conversation's replica is
+# chosen in one place.
+@app.function(
+    allow_concurrent_inputs=1000,
+    concurrency_limit=1,
+    keep_warm=1,
+    container_idle_timeout=300,
+    secrets=[Secret.from_dotenv()],
+)
+@asgi_app()
+def gateway():
+    return create_app(replica_source=read_registry, warm_pool_setter=hold_warm_pool)
@@ -0,0 +1,26 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from llm_hosting.admission import AdmissionConfig, AdmissionController, Ticket, create_app
+
+
+def test_metrics_need_the_api_key():
+    controller = AdmissionController(AdmissionConfig(slo_seconds=10, max_queue=4, max_sequences=2))
+    with TestClient(create_app("http://127.0.0.1:9", controller, api_key="secret")) as client:
+        for path in ("/admission/metrics", "/admission/metrics/json"):
+            assert client.get(path).status_code == 401
+            assert client.get(path, headers={"Authorization": "Bearer wrong"}).status_code == 401
+            assert client.get(path, headers={"Authorization": "Bearer secret"}).status_code == 200
+
+
+def test_cold_replica_rejects_on_the_planned_rate():
+    config = AdmissionConfig(slo_seconds=10, max_queue=100, max_sequences=1, planned_tokens_per_second=100)
+    controller = AdmissionController(config)
+    running = Ticket(500)
+    controller._admit(running)  # nothing has finished yet
+
+    assert controller.predicted_wait(Ticket(500), time.monotonic()) == 5.0
+    assert controller.reject_or_none(Ticket(500)) is None
+    rejected = controller.reject_or_none(Ticket(2000))
+    assert rejected.reason == "slo" and rejected.retry_after == 20.0
@@ -0,0 +1,44 @@
+import time
+
+from llm_hosting.affinity import ReplicaDirectory
+
+
+def _directory(max_num_seqs=2, idle_timeout=60, replicas=("a", "b")) -> ReplicaDirectory:
+    directory = ReplicaDirectory(load_factor=100.0)  # only the per-replica cap applies
+    now = time.time()
+    directory.update({
+        f"dep/{r}": {"deployment": "dep", "url": f"http://{r}", "updated": now,
+                     "max_num_seqs": max_num_seqs, "idle_timeout": idle_timeout}
+        for r in replicas
+    })
+    return directory
+
+
+def test_pinned_requests_stop_at_max_num_seqs():
+    directory = _directory(replicas=("a",))
+    leases = [directory.lease("dep", "session:x") for _ in range(3)]
+    assert [r and r.id for r in leases] == ["dep/a", "dep/a", None]  # the third goes to the load-balanced URL
+
+    directory.release(leases[0])
+    assert directory.lease("dep", "session:x").id == "dep/a"
+
+
+def test_full_replica_spills_over_to_the_next_one():
+    directory = _directory()
+    first = directory.lease("dep", "session:x")
+    directory.lease("dep", "session:x")
+    spilled = directory.lease("dep", "session:x")
+    assert spilled is not None and spilled.id != first.id
+
+
+def test_replicas_count_as_pinned_within_their_idle_timeout():
+    directory = _directory(idle_timeout=60)
+    assert directory.pinned("dep") == 0
+
+    replica = directory.lease("dep", "session:x")
+    assert directory.pinned("dep") == 1
+    directory.release(replica)
+    assert directory.pinned("dep") == 1  # still within the idle timeout
+
+    replica.last_leased -= 61
+    assert directory.pinned("dep") == 0
@@ -0,0 +1,113 @@
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from llm_hosting.batch import check_request, error_line, generate_chunk, pending_requests, result_line
+from llm_hosting.sharding import merge_results, split_shards
+
+
+def _output(text="hi"):
+    choice = SimpleNamespace(index=0, text=text, finish_reason="stop", token_ids=[1, 2])
+    return SimpleNamespace(outputs=[choice], prompt_token_ids=[1, 2, 3])
+
+
+def test_chat_request_result_is_a_chat_completion():
+    line = result_line(0, {"custom_id": "a", "body": {"messages": [{"role": "user", "content": "x"}]}}, _output(), "m")
+    assert line["id"] == "a"
+    assert line["response"]["object"] == "chat.completion"
+    assert line["response"]["choices"][0]["message"] == {"role": "assistant", "content": "hi"}
+    assert line["response"]["usage"] == {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+
+
+def test_prompt_request_result_is_a_text_completion():
+    line = result_line(4, {"prompt": "x"}, _output(), "m")
+    assert line["id"] == "line-4"
+    assert line["response"]["object"] == "text_completion"
+    assert line["response"]["choices"][0]["text"] == "hi"
+    assert "message" not in line["response"]["choices"][0]
+
+
+def test_error_line_takes_the_place_of_the_result():
+    line = error_line(2, {"custom_id": "bad", "body": {"messages": "oops"}}, ValueError("no chat template"))
+    assert line["id"] == "bad"
+    assert line["response"] is None
+    assert line["error"]["message"] == "ValueError: no chat template"
+
+
+def test_generated_ids_do_not_collide_with_given_ones():
+    records = [{"custom_id": "3", "body": {"prompt": "a"}}, {"prompt": "b"}, {"prompt": "c"}, {"prompt": "d"}]
+    shards, order = split_shards(records, 2)
+    assert order == ["3", "line-1", "line-2", "line-3"]
+    assert sorted(r["custom_id"] for shard in shards for r in shard) == sorted(order)
+
+
+def test_duplicate_ids_are_refused():
+    with pytest.raises(ValueError, match="Duplicate custom_id"):
+        split_shards([{"custom_id": "x", "prompt": "a"}, {"custom_id": "x", "prompt": "b"}], 2)
+
+
+def test_duplicate_ids_are_refused_without_sharding(tmp_path):
+    input_path = tmp_path / "input.jsonl"
+    records = [{"custom_id": "x", "prompt": "a"}, {"custom_id": "x", "prompt": "b"}]
+    input_path.write_text("".join(json.dumps(r) + "\n" for r in records))
+    with pytest.raises(ValueError, match="Duplicate custom_id"):
+        pending_requests(str(input_path), str(tmp_path / "output.jsonl"))
+
+
+def test_pending_requests_skip_finished_ones(tmp_path):
+    input_path, output_path = tmp_path / "input.jsonl", tmp_path / "output.jsonl"
+    input_path.write_text("".join(json.dumps({"prompt": p}) + "\n" for p in "abc"))
+    output_path.write_text(json.dumps({"id": "line-1"}) + "\n")
+    assert [index for index, _ in pending_requests(str(input_path), str(output_path))] == [0, 2]
+
+
+def test_merge_restores_input_order():
+    order = ["b", "line-1", "a"]
+    outputs = [[json.dumps({"id": "a", "index": 0}), json.dumps({"id": "b", "index": 0})], [json.dumps({"id": "line-1"})]]
+    out = io.StringIO()
+    assert merge_results(outputs, order, out) == 3
+    merged = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(r["id"], r["index"]) for r in merged] == [("b", 0), ("line-1", 1), ("a", 2)]
+
+
+@pytest.mark.parametrize("token_ids, max_tokens", [([], 16), ([1] * 100, 29)])
+def test_requests_the_engine_would_refuse_are_caught_up_front(token_ids, max_tokens):
+    with pytest.raises(ValueError):
+        check_request(token_ids, SimpleNamespace(max_tokens=max_tokens), max_model_len=128)
+    check_request([1] * 100, SimpleNamespace(max_tokens=28), max_model_len=128)
+
+
+class _Engine:
+    def __init__(self):
+        self.aborted = []
+
+    def abort_request(self, request_ids):
+        self.aborted.extend(request_ids)
+
+
+# Like vLLM's offline engine: requests are queued one by one and a bad one raises, leaving the earlier ones queued.
+class _LLM:
+    def __init__(self):
+        self.request_counter = SimpleNamespace(counter=0)
+        self.llm_engine = _Engine()
+        self.calls = 0
+
+    def generate(self, prompts, params, lora_request=None, use_tqdm=False):
+        self.calls += 1
+        for prompt in prompts:
+            self.request_counter.counter += 1
+            if prompt["prompt_token_ids"] == [0]:
+                raise ValueError("refused")
+        return [_output(str(prompt["prompt_token_ids"])) for prompt in prompts]
+
+
+def test_refused_chunk_is_rerun_one_request_at_a_time():
+    llm = _LLM()
+    chunk = [(i, {"prompt": "x"}, token_ids, None) for i, token_ids in enumerate([[1], [0], [2]])]
+    results = generate_chunk(llm, chunk, {})
+    assert [r.outputs[0].text for r in (results[0], results[2])] == ["[1]", "[2]"]
+    assert isinstance(results[1], ValueError)
+    assert llm.calls == 4
+    assert llm.llm_engine.aborted == ["0", "1", "3"]  # what the failed calls had queued
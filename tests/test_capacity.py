@@ -0,0 +1,59 @@
+from dataclasses import replace
+
+import pytest
+
+from llm_hosting.capacity import (
+    CapacityError,
+    check_profile,
+    minimum_gpu_config,
+    model_shape,
+    pinned_model_config,
+    plan_capacity,
+    plan_profile,
+)
+from llm_hosting.profiles import PROFILES
+
+
+def test_llama3_8b_fits_one_a100_40gb():
+    plan = check_profile(PROFILES["vllm-llama3-8b"])
+    assert plan.fits
+    assert plan.tensor_parallel_size == 1
+    assert plan.max_model_len == 8192
+    assert 14 < plan.weight_gib_per_gpu < 16
+    assert plan.kv_cache_blocks == plan.kv_cache_tokens // 16
+    assert plan.max_concurrent_sequences >= 1
+
+
+def test_arctic_refused_on_a100_40gb():
+    profile = replace(PROFILES["vllm-arctic"], gpu_type="A100", gpu_memory=40)
+    assert not plan_profile(profile).fits
+    with pytest.raises(CapacityError, match="8x A100 40GB.*smallest config that fits is 8x A100 80GB"):
+        check_profile(profile)
+
+
+def test_arctic_fits_its_profile():
+    assert check_profile(PROFILES["vllm-arctic"]).fits
+
+
+def test_codeqwen_split_across_two_gpus():
+    profile = PROFILES["vllm-codeqwen-110b-v1.5"]
+    config, weight_bytes = pinned_model_config(profile.base_model)
+    shape = model_shape(config, weight_bytes, profile.quantization)
+
+    two = plan_profile(profile)
+    one = plan_capacity(shape, "A100", 80, 1, profile.max_model_len, profile.gpu_memory_utilization)
+    assert two.fits and two.tensor_parallel_size == 2
+    assert two.weight_gib_per_gpu == pytest.approx(one.weight_gib_per_gpu / 2, abs=0.01)
+    assert shape.kv_bytes_per_token(2) * 2 == shape.kv_bytes_per_token(1)
+    assert two.max_concurrent_sequences > one.max_concurrent_sequences
+
+    # One A100 80GB only holds a single 32k sequence; asking for several derives the two-GPU request.
+    smallest = minimum_gpu_config(shape, profile.max_model_len, min_concurrent_sequences=4)
+    assert (smallest.gpu_count, smallest.gpu_type, smallest.gpu_memory) == (2, "A100", 80)
+
+
+def test_attention_heads_must_divide_across_gpus():
+    config, weight_bytes = pinned_model_config("meta-llama/Meta-Llama-3-8B-Instruct")
+    plan = plan_capacity(model_shape(config, weight_bytes), "A100", 80, 3)
+    assert not plan.fits
+    assert "cannot be split across 3 GPUs" in plan.reason
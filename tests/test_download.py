@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from llm_hosting import download
+from llm_hosting.download import INCOMPLETE_SUFFIX, SAFETENSORS_INDEX, DownloadError, download_repo
+from llm_hosting.mock_hub import make_handler
+
+REPO = "org/model"
+DROP_AFTER_BYTES = 1000
+SHARDS = ["model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors"]
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def hub(tmp_path, monkeypatch):
+    root = tmp_path / "hub"
+    repo_dir = root / REPO
+    _write(str(repo_dir / "config.json"), b'{"model_type": "llama"}')
+    for i, shard in enumerate(SHARDS):
+        _write(str(repo_dir / shard), os.urandom(3500 + i))
+    _write(str(repo_dir / "original" / "consolidated.00.pth"), os.urandom(2000))
+    index = {"weight_map": {"a.weight": SHARDS[0], "b.weight": SHARDS[1]}}
+    _write(str(repo_dir / SAFETENSORS_INDEX), json.dumps(index).encode())
+
+    # Every download is cut off after DROP_AFTER_BYTES, so each shard takes several resumed requests.
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(str(root), DROP_AFTER_BYTES))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("HF_ENDPOINT", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(download, "RETRY_BACKOFF", 0.0)
+    yield repo_dir
+    server.shutdown()
+    server.server_close()
+
+
+def _file_events(output: str) -> dict:
+    events = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    return {e["path"]: e for e in events if e["event"] == "download_file"}
+
+
+def test_dropped_downloads_resume_and_extra_checkpoints_are_skipped(hub, tmp_path, capsys):
+    model_dir = tmp_path / "model"
+    # Left behind by an interrupted earlier run.
+    _write(str(model_dir / (SHARDS[1] + INCOMPLETE_SUFFIX)), (hub / SHARDS[1]).read_bytes()[:500])
+
+    summary = download_repo(REPO, str(model_dir))
+
+    for name in SHARDS + ["config.json", SAFETENSORS_INDEX]:
+        assert (model_dir / name).read_bytes() == (hub / name).read_bytes()
+    assert not (model_dir / "original").exists()
+    assert not list(model_dir.glob(f"*{INCOMPLETE_SUFFIX}"))
+    assert summary["files"] == 4
+    assert summary["skipped_files"] == 1
+    assert summary["fetched_bytes"] == summary["bytes"] - 500
+
+    events = _file_events(capsys.readouterr().out)
+    assert events[SHARDS[0]]["attempts"] == 4  # 3500 bytes, 1000 per connection
+    assert events[SHARDS[1]]["resumed_bytes"] == 500
+    assert events[SHARDS[1]]["attempts"] == 4  # the other 3001 bytes
+
+
+def test_sha256_mismatch_is_rejected(hub, tmp_path):
+    model_dir = tmp_path / "model"
+    # A partial file whose start does not match the hub's: resuming it yields the right size but the wrong hash.
+    _write(str(model_dir / (SHARDS[0] + INCOMPLETE_SUFFIX)), b"\0" * 1500)
+
+    with pytest.raises(DownloadError, match=f"{SHARDS[0]}: SHA256 mismatch"):
+        download_repo(REPO, str(model_dir))
+    assert not (model_dir / SHARDS[0]).exists()
+    assert not (model_dir / (SHARDS[0] + INCOMPLETE_SUFFIX)).exists()  # the next run starts over
+
+    download_repo(REPO, str(model_dir))
+    assert (model_dir / SHARDS[0]).read_bytes() == (hub / SHARDS[0]).read_bytes()
+
+
+def test_shard_missing_from_the_repo_is_reported(hub, tmp_path):
+    index = json.loads((hub / SAFETENSORS_INDEX).read_text())
+    index["weight_map"]["c.weight"] = "model-00003-of-00003.safetensors"
+    _write(str(hub / SAFETENSORS_INDEX), json.dumps(index).encode())
+
+    with pytest.raises(DownloadError, match=r"not downloaded: \['model-00003-of-00003.safetensors'\]"):
+        download_repo(REPO, str(tmp_path / "model"))
+
+
+def test_partial_file_is_not_reported_as_resumed_when_the_range_is_ignored(hub, tmp_path, monkeypatch, capsys):
+    class NoRangeHandler(make_handler(str(hub.parent.parent), None)):
+        def _send_file(self, file_path: str):
+            del self.headers["Range"]  # answers 200 with the whole file
+            super()._send_file(file_path)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NoRangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("HF_ENDPOINT", f"http://127.0.0.1:{server.server_address[1]}")
+    model_dir = tmp_path / "model"
+    _write(str(model_dir / (SHARDS[1] + INCOMPLETE_SUFFIX)), (hub / SHARDS[1]).read_bytes()[:500])
+
+    try:
+        summary = download_repo(REPO, str(model_dir))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert (model_dir / SHARDS[1]).read_bytes() == (hub / SHARDS[1]).read_bytes()
+    assert summary["fetched_bytes"] == summary["bytes"]
+    assert _file_events(capsys.readouterr().out)[SHARDS[1]]["resumed_bytes"] == 0
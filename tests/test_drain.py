@@ -0,0 +1,93 @@
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+import uvicorn
+
+from llm_hosting import admission, mock_server
+from llm_hosting.admission import AdmissionConfig, AdmissionController, drain_admission_proxy
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not met")
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(app) -> str:
+        port = _free_port()
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        server.install_signal_handlers = lambda: None
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        _wait_for(lambda: server.started)
+        servers.append((server, thread))
+        return f"http://127.0.0.1:{port}"
+
+    yield start
+    for server, thread in servers:
+        server.should_exit = True
+        thread.join(10)
+
+
+def _stream(url: str, max_tokens: int) -> list:
+    body = {"model": "mock", "prompt": "hello", "max_tokens": max_tokens, "stream": True}
+    with httpx.stream("POST", f"{url}/v1/completions", json=body, timeout=30) as response:
+        return [line for line in response.iter_lines() if line.startswith("data: ")]
+
+
+def test_drain_finishes_short_streams_aborts_long_ones_and_turns_away_the_queue(serve, monkeypatch):
+    monkeypatch.setattr(admission, "SHUTDOWN_CLOSE_SECONDS", 1.0)
+    config = mock_server.MockConfig(ttft=0.05, token_delay=0.02)
+    engine = serve(mock_server.create_app(config))
+    controller = AdmissionController(AdmissionConfig(slo_seconds=60, max_queue=8, max_sequences=2))
+    proxy_app = admission.create_app(engine, controller)
+    proxy = serve(proxy_app)
+
+    with ThreadPoolExecutor(3) as pool:
+        long = pool.submit(_stream, proxy, 2000)  # 40s of tokens, cut off at the end of the grace period
+        short = pool.submit(_stream, proxy, 10)  # done well within it
+        _wait_for(lambda: sum(controller.inflight_requests.values()) == 2)
+        queued = pool.submit(
+            httpx.post, f"{proxy}/v1/completions", json={"model": "mock", "prompt": "hi", "max_tokens": 5}, timeout=30
+        )
+        _wait_for(lambda: sum(len(q) for q in controller.queues.values()) == 1)
+
+        report = drain_admission_proxy(proxy_app, grace_seconds=1.5)
+
+        rejected = queued.result()
+        assert rejected.status_code == 503
+        assert rejected.headers["Retry-After"] == "1"
+        assert rejected.json()["error"]["code"] == "draining"
+
+        short_lines = short.result()
+        assert short_lines[-1] == "data: [DONE]"
+        assert json.loads(short_lines[-2][6:])["choices"][0]["finish_reason"] != "abort"
+
+        long_lines = long.result()
+        assert long_lines[-1] == "data: [DONE]"
+        assert json.loads(long_lines[-2][6:])["choices"][0]["finish_reason"] == "abort"
+
+    assert report["in_flight"] == 2
+    assert report["drained"] == 1
+    assert report["aborted"] == 1
+    assert report["rejected_queued"] == 1
+    shutdown = controller.metrics.to_json()["counters"]["admission_shutdown_requests_total"]
+    assert {s["labels"]["outcome"]: s["value"] for s in shutdown} == {"drained": 1, "aborted": 1}
+    assert report["drain_seconds"] < config.token_delay * 2000
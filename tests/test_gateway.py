@@ -0,0 +1,9 @@
+from llm_hosting.gateway import load_routes
+from llm_hosting.profiles import PROFILES
+
+
+def test_lora_profile_without_adapters_gets_no_route():
+    assert PROFILES["vllm-llama3-8b-lora"].missing_adapters
+    names = {route.name for route in load_routes({}, "ws")}
+    assert "vllm-llama3-8b-lora" not in names
+    assert "vllm-llama3-8b" in names
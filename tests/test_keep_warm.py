@@ -0,0 +1,17 @@
+from dataclasses import replace
+
+from llm_hosting.keep_warm import Arrival, candidate_policies
+from llm_hosting.profiles import PROFILES
+
+
+def test_candidates_are_distinct_and_fixed_listed_once():
+    profile = replace(PROFILES["vllm-llama3-8b"], container_idle_timeout=15, max_num_seqs=8)
+    # A busy hour every day of one week, quiet otherwise.
+    log = [Arrival(day * 86400 + 9 * 3600 + i * 60, 2.0) for day in range(7) for i in range(60)]
+    policies = candidate_policies(profile, log)
+
+    keys = [(p.idle_timeout, p.warm_pool) for p in policies]
+    assert len(keys) == len(set(keys))
+    assert policies[0].name == "fixed"
+    assert "idle=15" not in [p.name for p in policies]
+    assert any(p.warm_pool for p in policies)
@@ -0,0 +1,31 @@
+from dataclasses import replace
+
+import pytest
+
+from llm_hosting.launcher import check_vllm_flags, vllm_command
+from llm_hosting.profiles import PROFILES
+
+
+def test_lora_profile_without_adapters_is_refused():
+    with pytest.raises(ValueError, match="no LoRA adapters declared"):
+        check_vllm_flags(PROFILES["vllm-llama3-8b-lora"])
+
+
+def test_lora_profile_serves_its_adapters():
+    profile = replace(PROFILES["vllm-llama3-8b-lora"], lora_adapters={"sql": "org/sql-lora"})
+    cmd = vllm_command(profile)
+    assert "--enable-lora" in cmd
+    assert cmd[cmd.index("--lora-modules") + 1] == "sql=/loras/sql"
+
+
+def test_chunked_prefill_with_prefix_caching_is_refused():
+    profile = replace(PROFILES["vllm-llama3-8b"], enable_chunked_prefill=True, enable_prefix_caching=True)
+    with pytest.raises(ValueError, match="chunked prefill cannot be combined with prefix caching"):
+        check_vllm_flags(profile)
+
+
+def test_speculative_decoding_with_prefix_caching_is_refused():
+    profile = replace(PROFILES["vllm-llama-3-70b-spec"], enable_prefix_caching=True)
+    with pytest.raises(ValueError, match="prefix caching cannot be combined with speculative decoding"):
+        check_vllm_flags(profile)
+    check_vllm_flags(PROFILES["vllm-llama-3-70b-spec"])
@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+
+from llm_hosting.mock_server import MockConfig, create_app
+
+
+def test_embeddings_and_rerank_share_the_concurrency_limit():
+    app = create_app(MockConfig(max_concurrency=1, reject_when_full=True, embedding_delay=0.3))
+    with TestClient(app) as client, ThreadPoolExecutor(2) as pool:
+        embedding = {"model": "mock", "input": ["a"]}
+        rerank = {"model": "mock", "query": "q", "documents": ["a"]}
+        first = pool.submit(client.post, "/v1/embeddings", json=embedding)
+        second = pool.submit(client.post, "/rerank", json=rerank)
+        assert sorted([first.result().status_code, second.result().status_code]) == [200, 429]
+        stats = client.get("/mock/stats").json()
+        assert stats["max_in_flight"] == 1 and stats["in_flight"] == 0 and stats["rejected"] == 1
+
+
+def test_streaming_slot_is_freed():
+    app = create_app(MockConfig(max_concurrency=1, reject_when_full=True, ttft=0.0, token_delay=0.0))
+    with TestClient(app) as client:
+        for _ in range(3):
+            body = {"model": "mock", "prompt": "hi", "max_tokens": 3, "stream": True}
+            assert client.post("/v1/completions", json=body).status_code == 200
+        assert client.get("/mock/stats").json()["in_flight"] == 0
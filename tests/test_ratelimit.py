@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from llm_hosting.ratelimit import RateLimited, RateLimiter, key_label, load_api_keys, request_tokens
+
+
+def test_keys_with_a_shared_prefix_have_their_own_budgets():
+    policies = load_api_keys(json.dumps({
+        "sk-proj-aaaaaaaa": {"max_concurrent": 1},
+        "sk-proj-bbbbbbbb": {"max_concurrent": 1},
+    }))
+    assert {p.name for p in policies.values()} == {key_label("sk-proj-aaaaaaaa"), key_label("sk-proj-bbbbbbbb")}
+    assert not any(p.name.startswith("sk-") for p in policies.values())
+
+    limiter = RateLimiter(policies)
+    limiter.acquire("sk-proj-aaaaaaaa", 10)
+    limiter.acquire("sk-proj-bbbbbbbb", 10)
+    with pytest.raises(RateLimited, match="max_concurrent"):
+        limiter.acquire("sk-proj-aaaaaaaa", 10)
+
+
+def test_duplicate_names_are_refused():
+    with pytest.raises(ValueError, match="chat"):
+        load_api_keys(json.dumps({"sk-a": {"name": "chat"}, "sk-b": {"name": "chat"}}))
+
+
+def test_release_settles_the_reservation():
+    limiter = RateLimiter(load_api_keys(json.dumps({"sk-a": {"tokens_per_minute": 100}})))
+    reservation = limiter.acquire("sk-a", 100)
+    with pytest.raises(RateLimited, match="tokens_per_minute"):
+        limiter.acquire("sk-a", 50)
+    limiter.release(reservation, 40)
+    limiter.release(limiter.acquire("sk-a", 50), 50)
+    assert limiter.in_flight["sk-a"] == 0
+
+
+@pytest.mark.parametrize(
+    "embedding_input, tokens",
+    [("four words of text", 4), (["two words", "and three more"], 5), ([1, 2, 3], 3), ([[1, 2], [3, 4, 5]], 5)],
+)
+def test_embedding_inputs_count_text_and_token_ids(embedding_input, tokens):
+    assert request_tokens({"input": embedding_input}, lambda text: len(text.split())) == (tokens, 0)
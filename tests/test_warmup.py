@@ -0,0 +1,36 @@
+import json
+from dataclasses import replace
+
+from llm_hosting.keep_warm import Arrival
+from llm_hosting.profiles import PROFILES
+from llm_hosting.warmup import (
+    concurrency_at_arrivals,
+    load_warmup_batch_sizes,
+    observed_batch_sizes,
+    write_warmup_requests,
+)
+
+
+def test_concurrency_counts_overlapping_requests():
+    log = [Arrival(0, 10), Arrival(1, 10), Arrival(2, 1), Arrival(20, 1)]
+    assert concurrency_at_arrivals(log) == [1, 2, 3, 1]
+
+
+def test_observed_batch_sizes_follow_the_log():
+    # Bursts of 12 overlapping requests every minute.
+    log = [Arrival(minute * 60 + i * 0.1, 5.0) for minute in range(30) for i in range(12)]
+    sizes = observed_batch_sizes(log)
+    assert sizes[0] == 1 and sizes[-1] == 12
+    assert observed_batch_sizes(log, max_num_seqs=8)[-1] == 8
+    assert observed_batch_sizes([]) is None
+
+
+def test_baked_sizes_replace_the_profile_fallback(tmp_path):
+    profile = replace(PROFILES["vllm-llama3-8b"], max_num_seqs=16)
+    path = tmp_path / "sizes.json"
+    assert load_warmup_batch_sizes(profile, str(path)) == [1, 8]  # fallback, capped at max_num_seqs
+
+    write_warmup_requests([], str(tmp_path / "warmup.jsonl"), [1, 4, 12], str(path))
+    assert json.loads(path.read_text()) == [1, 4, 12]
+    assert load_warmup_batch_sizes(profile, str(path)) == [1, 4, 12]
+    assert load_warmup_batch_sizes(replace(profile, warmup_batch_sizes=()), str(path)) == []
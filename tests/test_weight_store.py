@@ -0,0 +1,48 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from llm_hosting import download
+from llm_hosting.download import file_sha256
+from llm_hosting.mock_hub import make_handler
+from llm_hosting.weight_store import blob_path, staging_path, store_snapshot
+
+REPO = "org/model"
+SHARD = "model.safetensors"
+
+
+@pytest.fixture
+def hub(tmp_path, monkeypatch):
+    repo_dir = tmp_path / "hub" / REPO
+    repo_dir.mkdir(parents=True)
+    (repo_dir / "config.json").write_text(json.dumps({"model_type": "llama"}))
+    (repo_dir / SHARD).write_bytes(os.urandom(5000))
+
+    # Cut off every 1000 bytes, so the two builds' downloads of the shard overlap.
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(str(tmp_path / "hub"), 1000))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("HF_ENDPOINT", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(download, "RETRY_BACKOFF", 0.0)
+    yield repo_dir
+    server.shutdown()
+    server.server_close()
+
+
+def test_staging_paths_are_unique_per_call(tmp_path):
+    assert staging_path("blob", str(tmp_path)) != staging_path("blob", str(tmp_path))
+
+
+def test_concurrent_builds_of_the_same_repo_do_not_share_staging_files(hub, tmp_path):
+    root = str(tmp_path / "weights")
+    with ThreadPoolExecutor(2) as pool:
+        snapshots = list(pool.map(lambda _: store_snapshot(REPO, root=root), range(2)))
+
+    assert snapshots[0]["files"] == snapshots[1]["files"]
+    for path, entry in snapshots[0]["files"].items():
+        assert open(blob_path(entry["sha256"], root), "rb").read() == (hub / path).read_bytes()
+        assert file_sha256(blob_path(entry["sha256"], root)) == entry["sha256"]
+    assert os.listdir(os.path.join(root, "tmp")) == []
@@ -2,85 +2,35 @@
 #
 # In this example, we show how to run basic inference, using [`vLLM`](https://github.com/vllm-project/vllm)
 # to take advantage of PagedAttention, which speeds up sequential inferences with optimized key-value caching.
+#
+# The image, GPU and serving flags come from the `vllm-duckdb-nsql-7b` profile in `llm_hosting/profiles.py`.
 
-import os
-import subprocess
-import secrets
-
-
-from modal import Image, Secret, App, enter, gpu, method, web_server
-
-MODEL_DIR = "/model"
-BASE_MODEL = "motherduckdb/DuckDB-NSQL-7B-v0.1"
+from modal import App, web_server
 
-# ## Define a container image
+from llm_hosting.deploy import batch_job, batch_options, build_image, run_batch_job, server_options
+from llm_hosting.launcher import launch_server
+from llm_hosting.profiles import PROFILES
 
+PROFILE = PROFILES["vllm-duckdb-nsql-7b"]
 
-# We want to create a Modal image which has the model weights pre-saved to a directory. The benefit of this
-# is that the container no longer has to re-download the model from Huggingface - instead, it will take
-# advantage of Modal's internal filesystem for faster cold starts.
-#
-# ### Download the weights
-# We can download the model to a particular directory using the HuggingFace utility function `snapshot_download`.
-#
-# Tip: avoid using global variables in this function. Changes to code outside this function will not be detected and the download step will not re-run.
-def download_model_to_folder():
-    from huggingface_hub import snapshot_download
-    from transformers.utils import move_cache
+app = App(PROFILE.name, image=build_image(PROFILE))
 
-    os.makedirs(MODEL_DIR, exist_ok=True)
-
-    snapshot_download(
-        BASE_MODEL,
-        local_dir=MODEL_DIR,
-        ignore_patterns=["*.pt", "*.bin"],  # Using safetensors
-    )
-    move_cache()
 
+# Run a web server on port 8000 and expose vLLM OpenAI compatible server
+@app.function(**server_options(PROFILE))
+@web_server(PROFILE.port, startup_timeout=PROFILE.startup_timeout)
+def openai_compatible_server():
+    launch_server(PROFILE)
 
-# ### Image definition
-# We'll start from a recommended Docker Hub image and install `vLLM`.
-# Then we'll use `run_function` to run the function defined above to ensure the weights of
-# the model are saved within the container image.
-image = (
-    Image.from_registry("nvidia/cuda:12.1.1-devel-ubuntu22.04", add_python="3.10")
-    .pip_install(
-        "vllm==0.6.1.post2",
-        "wheel==0.44.0",
-        "packaging==24.1",
-        "huggingface_hub==0.25.0",
-        "hf-transfer==0.1.8",
-        "torch==2.4.0",
-    )
-    .apt_install("git")
-    .run_commands(
-        "pip install flash-attn==2.6.3 --no-build-isolation",
-    )
-    # Use the barebones hf-transfer package for maximum download speeds. No progress bar, but expect 700MB/s.
-    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
-    .run_function(
-        download_model_to_folder,
-        secrets=[Secret.from_name("huggingface")],
-        timeout=60 * 20,
-    )
-)
 
-app = App("vllm-duckdb-nsql-7b", image=image)
-GPU_CONFIG = gpu.A100(size="40GB", count=1)
+# Offline batch inference over a JSONL file of OpenAI-style requests (see `llm_hosting/batch.py`), split across
+# `--shards` GPU containers:
+#   modal run vllm_duckdb_nsql_7b.py::batch --input-path requests.jsonl --output-path results.jsonl --shards 8
+@app.function(**batch_options(PROFILE))
+def batch_inference(input_name: str, output_name: str) -> dict:
+    return batch_job(PROFILE, input_name, output_name)
 
 
-# Run a web server on port 8000 and expose vLLM OpenAI compatible server
-@app.function(
-    allow_concurrent_inputs=100,
-    container_idle_timeout=15,
-    gpu=GPU_CONFIG,
-    secrets=[
-        Secret.from_name("huggingface"),
-        Secret.from_dotenv(),
-    ],
-)
-@web_server(8000, startup_timeout=300)
-def openai_compatible_server():
-    target = BASE_MODEL
-    cmd = f"python -m vllm.entrypoints.openai.api_server --model {target} --port 8000"
-    subprocess.Popen(cmd, shell=True)
+@app.local_entrypoint()
+def batch(input_path: str, output_path: str, shards: int = 1):
+    run_batch_job(batch_inference, PROFILE, input_path, output_path, shards)